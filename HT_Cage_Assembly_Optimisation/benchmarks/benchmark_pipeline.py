@@ -0,0 +1,409 @@
+import argparse
+import itertools as it
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from functools import partial
+from pathlib import Path
+from uuid import uuid4
+
+import stk
+from pathos.multiprocessing import ProcessingPool as Pool
+from rdkit import Chem
+
+here = Path(__file__).resolve().parent
+sys.path.append(str(here.parent))
+for directory in ('cage_assembly_optimisation', 'pywindow'):
+    sys.path.append(str(here.parent / directory))
+
+import cage_opt_100ns as cage_opt
+import P1_pw_analysis_100ns as pw_analysis
+from cage_utilities.databases import get_cage_db
+
+benchmarks = ('key_computation', 'db', 'dispatch', 'pywindow')
+
+aldehyde = Chem.MolFromSmarts('[CX3H1](=O)[#6]')
+
+
+class StandInOptimiser:
+    """
+    Stands in for the MacroModel optimisation of a cage.
+
+    The cage is returned unchanged after `delay` seconds, so the cost of
+    everything around the optimisation can be timed.
+    """
+
+    def __init__(self, delay=0):
+        self.delay = delay
+
+    def optimize(self, mol):
+        if self.delay:
+            time.sleep(self.delay)
+        return mol
+
+
+def stand_in_optimiser(identifier, settings=None, delay=0):
+    """
+    Returns a :class:`.StandInOptimiser`, with the signature of
+    `cage_opt_100ns.get_optimiser`.
+    """
+    return StandInOptimiser(delay)
+
+
+def get_precursors(precursors_path, n_amines, n_aldehydes):
+    """
+    Returns a mini-library of building blocks from `precursors.json`.
+
+    The smallest di-topic amines and tri-topic aldehydes are used, so
+    every amine can be combined with every aldehyde.
+
+    Returns
+    -------
+    amines : list of stk.BuildingBlock
+        `n_amines` di-topic amines.
+
+    aldehydes : list of stk.BuildingBlock
+        `n_aldehydes` tri-topic aldehydes.
+    """
+    with open(precursors_path, 'r') as f:
+        precursors = json.load(f)
+
+    def smallest(names, is_aldehyde, n):
+        smiles = [
+            precursors[i] for i in names
+            if Chem.MolFromSmiles(precursors[i]).HasSubstructMatch(aldehyde)
+            == is_aldehyde
+        ]
+        smiles.sort(key=lambda i: Chem.MolFromSmiles(i).GetNumHeavyAtoms())
+        return smiles[:n]
+
+    amines = [
+        stk.BuildingBlock(i, [stk.PrimaryAminoFactory()])
+        for i in smallest(
+            [i for i in precursors if i.startswith('Di')], False, n_amines
+        )
+    ]
+    aldehydes = [
+        stk.BuildingBlock(i, [stk.AldehydeFactory()])
+        for i in smallest(
+            [i for i in precursors if i.startswith('Tri')], True, n_aldehydes
+        )
+    ]
+    return amines, aldehydes
+
+
+def timed(function, items, repeats=1):
+    """
+    Returns the time taken to call `function` on every item.
+    """
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for item in items:
+            function(item)
+    total = time.perf_counter() - start
+    calls = repeats * len(items)
+    return {
+        'calls': calls,
+        'total_s': total,
+        'per_call_ms': 1000 * total / calls,
+    }
+
+
+def benchmark_key_computation(cages, repeats):
+    """
+    Times the keys computed for every cage put in or looked up from
+    the database.
+    """
+    molecules = [cage for _, cage in cages]
+    building_blocks = [
+        bb for cage in molecules for bb in cage.get_building_blocks()
+    ]
+    return {
+        'cage_key': timed(cage_opt.get_cage_key, molecules, repeats),
+        'building_block_smiles': timed(
+            cage_opt.get_cage_key, building_blocks, repeats
+        ),
+        'inchi_key': timed(
+            stk.InchiKey().get_key, building_blocks, repeats
+        ),
+    }
+
+
+def get_benchmark_db(db_url, topology):
+    return get_cage_db(
+        db_url,
+        collection_name=topology,
+        key_makers=(
+            stk.MoleculeKeyMaker(
+                key_name='cage_key', get_key=cage_opt.get_cage_key,
+            ),
+        ),
+        database='cage_benchmark',
+    )
+
+
+def benchmark_db(db_url, cages, repeats):
+    """
+    Times putting every cage in the database and getting it back by
+    its `cage_key`.
+    """
+    dbs = {
+        topology: get_benchmark_db(db_url, topology)
+        for topology in cage_opt.topologies
+    }
+    put = timed(lambda i: dbs[i[0]].put(i[1]), cages)
+    keys = [
+        (topology, {'cage_key': cage_opt.get_cage_key(cage)})
+        for topology, cage in cages
+    ]
+    get = timed(lambda i: dbs[i[0]].get(i[1]), keys, repeats)
+    return {
+        'put': {**put, 'per_s': put['calls'] / put['total_s']},
+        'get': {**get, 'per_s': get['calls'] / get['total_s']},
+    }
+
+
+def benchmark_dispatch(combinations, db_url, processes, delay):
+    """
+    Times `cage_opt` over every combination with the stand-in optimiser,
+    in this process and on a process pool.
+
+    The difference between the pool time and the serial time divided
+    between the processes is the cost of dispatching the tasks and
+    sending the cages back.
+    """
+    func = partial(
+        cage_opt.cage_opt,
+        db_url=db_url,
+        topologies=cage_opt.topologies,
+        overwrite=True,
+        optimiser_factory=partial(stand_in_optimiser, delay=delay),
+    )
+    identifiers = [uuid4().int for _ in combinations]
+
+    start = time.perf_counter()
+    for combination, identifier in zip(combinations, identifiers):
+        func(combination, identifier)
+    serial = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pool = Pool(processes=processes)
+    pool_start = time.perf_counter() - start
+    for _ in pool.uimap(func, combinations, identifiers):
+        pass
+    parallel = time.perf_counter() - start
+    pool.close()
+    pool.join()
+    pool.clear()
+
+    tasks = len(combinations)
+    return {
+        'tasks': tasks,
+        'processes': processes,
+        'optimiser_delay_s': delay,
+        'serial_s': serial,
+        'pool_s': parallel,
+        'pool_start_s': pool_start,
+        'overhead_per_task_ms': (
+            1000 * max(0, parallel - serial / processes) * processes / tasks
+        ),
+    }
+
+
+def benchmark_pywindow(db_url, cage_keys, processes, cache_path):
+    """
+    Times the porosity analysis of every cage put by `benchmark_db`,
+    without and then with cached results.
+    """
+    pw_analysis.db_url = db_url
+    pw_analysis.database = 'cage_benchmark'
+    pw_analysis.cache_path = cache_path
+    results = {}
+    for run in ('cold', 'cached'):
+        start = time.perf_counter()
+        analysed = list(pw_analysis.parallel_cage_analysis(
+            cage_keys, calc_dir='.', processes=processes,
+        ))
+        total = time.perf_counter() - start
+        cages = len(analysed) * len(pw_analysis.topologies)
+        results[run] = {
+            'cages': cages,
+            'total_s': total,
+            'per_s': cages / total,
+        }
+    return results
+
+
+def get_metadata(args):
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=here,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'processes': args.p,
+        'repeats': args.repeats,
+    }
+
+
+def main(args):
+    output = Path(args.o).resolve()
+    precursors_path = Path(args.precursors).resolve()
+    with tempfile.TemporaryDirectory() as calc_dir:
+        # cage_opt and the analysis write their files to the working
+        # directory.
+        cwd = os.getcwd()
+        os.chdir(calc_dir)
+        try:
+            db_url = args.db if args.db is not None else str(
+                Path(calc_dir) / 'db'
+            )
+            amines, aldehydes = get_precursors(
+                precursors_path, args.n_amines, args.n_aldehydes
+            )
+            combinations = list(
+                it.product(amines, aldehydes, cage_opt.topologies.values())
+            )
+            start = time.perf_counter()
+            cages = [
+                (
+                    topology,
+                    cage_opt.get_cage([amine, aldehyde_bb], topology_class),
+                )
+                for amine, aldehyde_bb in it.product(amines, aldehydes)
+                for topology, topology_class in cage_opt.topologies.items()
+            ]
+            construction = time.perf_counter() - start
+            cage_keys = sorted(
+                {cage_opt.get_cage_key(cage) for _, cage in cages}
+            )
+
+            results = {
+                'metadata': get_metadata(args),
+                'library': {
+                    'amines': [
+                        Chem.MolToSmiles(i.to_rdkit_mol()) for i in amines
+                    ],
+                    'aldehydes': [
+                        Chem.MolToSmiles(i.to_rdkit_mol()) for i in aldehydes
+                    ],
+                    'pairs': len(cage_keys),
+                    'cages': len(cages),
+                    'construction_s': construction,
+                },
+                'benchmarks': {},
+            }
+            selected = (
+                benchmarks if args.benchmarks is None else args.benchmarks
+            )
+            if 'key_computation' in selected:
+                logging.info('Timing key computation')
+                results['benchmarks']['key_computation'] = (
+                    benchmark_key_computation(cages, args.repeats)
+                )
+            # The pywindow benchmark reads the cages put by the db benchmark.
+            if 'db' in selected or 'pywindow' in selected:
+                logging.info('Timing database puts and gets')
+                results['benchmarks']['db'] = benchmark_db(
+                    db_url, cages, args.repeats
+                )
+            if 'dispatch' in selected:
+                logging.info('Timing dispatch of the cage optimisations')
+                results['benchmarks']['dispatch'] = benchmark_dispatch(
+                    combinations, db_url, args.p, args.optimiser_delay
+                )
+            if 'pywindow' in selected:
+                logging.info('Timing the pywindow analysis')
+                results['benchmarks']['pywindow'] = benchmark_pywindow(
+                    db_url,
+                    cage_keys,
+                    args.p,
+                    str(Path(calc_dir) / 'pw_results.sqlite'),
+                )
+        finally:
+            # Leave the temporary directory before it is removed.
+            os.chdir(cwd)
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=4)
+    logging.info(f'Wrote benchmark results to {output}')
+    return results
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    parser = argparse.ArgumentParser(
+        description=(
+            "Benchmarks the cage pipeline on a mini-library with a "
+            "stand-in optimiser."
+        )
+    )
+    parser.add_argument(
+        "-db",
+        help=(
+            "URL for MongoDB, or a path for a local database. A temporary "
+            "local database is used if not given."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "-p", help="Number of CPU cores to use.", default=4, type=int,
+    )
+    parser.add_argument(
+        "-o",
+        help="Path to the output JSON file.",
+        default='benchmark_results.json',
+    )
+    parser.add_argument(
+        "-precursors",
+        help="Path to precursors.json.",
+        default=str(here.parent / 'precursors.json'),
+    )
+    parser.add_argument(
+        "-n_amines", help="Number of di-topic amines.", default=4, type=int,
+    )
+    parser.add_argument(
+        "-n_aldehydes",
+        help="Number of tri-topic aldehydes.",
+        default=4,
+        type=int,
+    )
+    parser.add_argument(
+        "-repeats",
+        help="Number of times the key and get benchmarks are repeated.",
+        default=3,
+        type=int,
+    )
+    parser.add_argument(
+        "-optimiser_delay",
+        help="Seconds the stand-in optimiser spends on each cage.",
+        default=0,
+        type=float,
+    )
+    parser.add_argument(
+        "-benchmarks",
+        help="The benchmarks to run. All are run if not given.",
+        nargs='+',
+        choices=benchmarks,
+        default=None,
+    )
+    args = parser.parse_args()
+    main(args)
@@ -15,6 +15,14 @@ from uuid import uuid4
 from pathos.multiprocessing import ProcessingPool as Pool
 import stko
 import json
+import sys
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from cage_utilities.databases import (
+    get_cage_db,
+    get_molecule_db,
+    is_local_db,
+)
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -31,34 +39,49 @@ else:
     macromodel_path = 'PATH/schrodinger2021-3'
 print(macromodel_path)
 
-def get_db(db_url, collection_name):
+topologies = {
+    "2+3": stk.cage.TwoPlusThree,
+    "4+6": stk.cage.FourPlusSix,
+    "6+9": stk.cage.SixPlusNine,
+    "8+12": stk.cage.EightPlusTwelve,
+}
+
+# Settings of the MacroModel optimisation of each cage.
+optimiser_settings = {
+    "force_field": 16,
+    "temperature": 700,
+    "conformers": 50,
+    "simulation_time": 100000,
+    "time_step": 1,
+    "eq_time": 100,
+}
+
+def get_db(db_url, collection_name, position_matrix_encoding=None):
     standardize_smiles_km = stk.MoleculeKeyMaker(
         key_name="cage_key", get_key=get_cage_key,
     )
-    jsonizer = stk.ConstructedMoleculeJsonizer(
-        key_makers=(standardize_smiles_km,)
-    )
-    client = get_client(db_url)
-    db = stk.ConstructedMoleculeMongoDb(
-        client,
-        constructed_molecule_collection=f"{collection_name}_constructed_molecules",
-        position_matrix_collection=f"{collection_name}_position_matrices",
-        building_block_position_matrix_collection=f"{collection_name}_building_block_position_matrices",
+    db = get_cage_db(
+        db_url,
+        collection_name=collection_name,
+        key_makers=(standardize_smiles_km,),
         database="cage_opt_100ns",
-        molecule_collection=collection_name,
-        jsonizer=jsonizer,
+        position_matrix_encoding=position_matrix_encoding,
     )
     return db
     print('made db')
 
 def get_precursors(db_url, collection_name):
-    client = get_client(db_url)
-    db = stk.MoleculeMongoDb(
-        client,
+    db = get_molecule_db(
+        db_url,
         database="cage_precursors",
         molecule_collection=collection_name,
         position_matrix_collection=f"{collection_name.lower()}_postmat",
     )
+    if is_local_db(db_url):
+        # The local database yields its molecules directly.
+        for mol in db.get_all():
+            yield mol
+        return
     for entry in get_client(db_url)["cage_precursors"][
         collection_name
     ].find():
@@ -120,12 +143,6 @@ def main(args):
         )
         for mol in get_precursors(db_url=args.db, collection_name="Dialdehydes")
     ]
-    topologies = {
-        "2+3": stk.cage.TwoPlusThree,
-        "4+6": stk.cage.FourPlusSix,
-        "6+9": stk.cage.SixPlusNine,
-        "8+12": stk.cage.EightPlusTwelve,
-    }
     # Check molecules are Kekulized
     for mol in it.chain(triamines, dialdehydes):
         for bond in mol.to_rdkit_mol().GetBonds():
@@ -174,6 +191,7 @@ def main(args):
                     identifier=identifier,
                     run_name=run_name,
                     topology_str=topology_str,
+                    position_matrix_encoding=args.position_matrix_encoding,
                 )
                 logging.info(f"Writing {cage}")
                 print('res not none so opt cages not in db')
@@ -181,40 +199,58 @@ def main(args):
                 print('cage in db optimised')
     pool.close()
 
-def cage_opt(combination, identifier, db_url, topologies):
-    p1, p2, topology = combination
-    cage = get_cage([p1, p2], topology)
-    topology_str = list(topologies.keys())[
-        list(topologies.values()).index(topology)
-    ]
-    opt = stko.OptimizerSequence(
+def get_optimiser(identifier, settings=None):
+    """
+    Returns the restricted FF, unrestricted FF and MD optimisation of a
+    cage, with `settings` replacing entries of `optimiser_settings`.
+    """
+    settings = {**optimiser_settings, **(settings or {})}
+    return stko.OptimizerSequence(
         stko.MacroModelForceField(
             output_dir=f"{identifier}_FF_Restricted",
             macromodel_path=macromodel_path,
-            force_field=16,
+            force_field=settings["force_field"],
             restricted=True,
         ),
         stko.MacroModelForceField(
             output_dir=f"{identifier}_FF_Unrestricted",
             macromodel_path=macromodel_path,
-            force_field=16,
+            force_field=settings["force_field"],
             restricted=False,
         ),
         stko.MacroModelMD(
             output_dir=f"{identifier}_MD",
             macromodel_path=macromodel_path,
-            temperature=700,
-            conformers=50,
-            simulation_time=100000,
-            time_step=1,
-            eq_time=100,
+            temperature=settings["temperature"],
+            conformers=settings["conformers"],
+            simulation_time=settings["simulation_time"],
+            time_step=settings["time_step"],
+            eq_time=settings["eq_time"],
         ),
     )
+
+def cage_opt(
+    combination,
+    identifier,
+    db_url,
+    topologies,
+    settings=None,
+    overwrite=False,
+    optimiser_factory=get_optimiser,
+):
+    p1, p2, topology = combination
+    cage = get_cage([p1, p2], topology)
+    topology_str = list(topologies.keys())[
+        list(topologies.values()).index(topology)
+    ]
+    opt = optimiser_factory(identifier, settings)
     print('done the MD opt')
     # For debugging
     collection_name = f"{topology_str}"
-    # Check if cage already in database
-    if cage_in_db(cage, db_url=db_url, collection_name=collection_name,):
+    # Check if cage already in database, unless it is being replaced
+    if not overwrite and cage_in_db(
+        cage, db_url=db_url, collection_name=collection_name,
+    ):
         return
     cage.write(f"{identifier}_Unopt.mol")
     try:
@@ -256,9 +292,19 @@ def get_cage_key(mol):
     print('help the key')
 
 def write_cage(
-    mol, db_url, collection_name, identifier, run_name, topology_str
+    mol,
+    db_url,
+    collection_name,
+    identifier,
+    run_name,
+    topology_str,
+    position_matrix_encoding=None,
 ):
-    db = get_db(db_url=db_url, collection_name=collection_name)
+    db = get_db(
+        db_url=db_url,
+        collection_name=collection_name,
+        position_matrix_encoding=position_matrix_encoding,
+    )
     db.put(mol)
     # Update run JSON file
     if Path(f"Run_{run_name}.json").exists():
@@ -276,9 +322,22 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Precursor optimisation script."
     )
-    parser.add_argument("-db", help="Contains URL for MongoDB.", required=True)
+    parser.add_argument(
+        "-db",
+        help="Contains URL for MongoDB, or a path for a local database.",
+        required=True,
+    )
     parser.add_argument(
         "-p", help="Number of CPU cores to use.", required=True, type=int,
     )
+    parser.add_argument(
+        "-position_matrix_encoding",
+        help=(
+            "Store the position matrices of the cages as binary 'float32' "
+            "or zlib compressed float64 ('zlib') instead of JSON."
+        ),
+        choices=("float32", "zlib"),
+        default=None,
+    )
     args = parser.parse_args()
     main(args)
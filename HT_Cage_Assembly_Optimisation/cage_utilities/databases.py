@@ -0,0 +1,340 @@
+import pickle
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+import pymongo
+import stk
+
+from .position_matrices import use_encoded_position_matrices
+
+
+def is_local_db(db_url):
+    """
+    Returns True if `db_url` is a local path rather than a Mongo URL.
+    """
+    return not str(db_url).startswith(('mongodb://', 'mongodb+srv://'))
+
+
+class _LocalStore:
+    """
+    An embedded SQLite file holding pickled molecules of one collection,
+    indexed by their keys.
+    """
+
+    def __init__(self, path, database, collection, key_makers):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        self.path = path / f'{database}.sqlite'
+        self.collection = collection
+        self.key_makers = tuple(key_makers)
+        self._connection = sqlite3.connect(self.path, timeout=60)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS molecules ('
+            'id INTEGER PRIMARY KEY, '
+            'collection TEXT NOT NULL, '
+            'molecule BLOB NOT NULL, '
+            'position_matrix BLOB NOT NULL)'
+        )
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS molecules_collection '
+            'ON molecules (collection)'
+        )
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS keys ('
+            'collection TEXT NOT NULL, '
+            'key_name TEXT NOT NULL, '
+            'key TEXT NOT NULL, '
+            'id INTEGER NOT NULL, '
+            'PRIMARY KEY (collection, key_name, key))'
+        )
+        self._connection.commit()
+
+    def _get_keys(self, molecule):
+        return {
+            key_maker.get_key_name(): key_maker.get_key(molecule)
+            for key_maker in self.key_makers
+        }
+
+    def _find_id(self, key):
+        if len(key) == 0:
+            raise ValueError('At least one key is needed.')
+        ids = set()
+        for key_name, value in key.items():
+            row = self._connection.execute(
+                'SELECT id FROM keys WHERE collection=? AND key_name=? '
+                'AND key=?',
+                (self.collection, key_name, value),
+            ).fetchone()
+            ids.add(None if row is None else row[0])
+        if len(ids) != 1 or None in ids:
+            raise KeyError(
+                f'No molecule found in {self.collection} with key {key}.'
+            )
+        return ids.pop()
+
+    def put(self, molecule):
+        keys = self._get_keys(molecule)
+        # Like a Mongo upsert, a molecule sharing any key is replaced.
+        existing = None
+        for key_name, value in keys.items():
+            row = self._connection.execute(
+                'SELECT id FROM keys WHERE collection=? AND key_name=? '
+                'AND key=?',
+                (self.collection, key_name, value),
+            ).fetchone()
+            if row is not None:
+                existing = row[0]
+                break
+        molecule_blob = pickle.dumps(molecule, pickle.HIGHEST_PROTOCOL)
+        matrix_blob = self.encode_position_matrix(
+            molecule.get_position_matrix()
+        )
+        with self._connection:
+            if existing is None:
+                existing = self._connection.execute(
+                    'INSERT INTO molecules '
+                    '(collection, molecule, position_matrix) VALUES (?, ?, ?)',
+                    (self.collection, molecule_blob, matrix_blob),
+                ).lastrowid
+            else:
+                self._connection.execute(
+                    'UPDATE molecules SET molecule=?, position_matrix=? '
+                    'WHERE id=?',
+                    (molecule_blob, matrix_blob, existing),
+                )
+            for key_name, value in keys.items():
+                self._connection.execute(
+                    'INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?)',
+                    (self.collection, key_name, value, existing),
+                )
+
+    def get(self, key):
+        molecule_id = self._find_id(key)
+        row = self._connection.execute(
+            'SELECT molecule FROM molecules WHERE id=?', (molecule_id, )
+        ).fetchone()
+        return pickle.loads(row[0])
+
+    def get_position_matrix(self, key):
+        molecule_id = self._find_id(key)
+        row = self._connection.execute(
+            'SELECT position_matrix FROM molecules WHERE id=?',
+            (molecule_id, ),
+        ).fetchone()
+        return self.decode_position_matrix(row[0])
+
+    def get_all(self):
+        for row in self._connection.execute(
+            'SELECT molecule FROM molecules WHERE collection=? ORDER BY id',
+            (self.collection, ),
+        ):
+            yield pickle.loads(row[0])
+
+    @staticmethod
+    def encode_position_matrix(position_matrix):
+        return np.ascontiguousarray(
+            position_matrix, dtype=np.float64
+        ).tobytes()
+
+    @staticmethod
+    def decode_position_matrix(data):
+        return np.frombuffer(data, dtype=np.float64).reshape(-1, 3)
+
+
+class _LocalDb:
+    """
+    Methods shared by the local databases.
+    """
+
+    def __init__(
+        self,
+        path,
+        database='stk',
+        molecule_collection='molecules',
+        key_makers=(stk.InchiKey(), ),
+    ):
+        """
+        Initialise a local database.
+
+        Parameters
+        ----------
+        path : str
+            Directory holding the database files. Each `database` is
+            stored as `<path>/<database>.sqlite`.
+
+        database : str
+            The name of the database.
+
+        molecule_collection : str
+            The collection the molecules are stored in.
+
+        key_makers : tuple of stk.MoleculeKeyMaker
+            Make the keys a molecule can be retrieved by.
+        """
+        self._store = _LocalStore(
+            path, database, molecule_collection, key_makers
+        )
+
+    def put(self, molecule):
+        self._store.put(molecule)
+
+    def get(self, key):
+        return self._store.get(key)
+
+    def get_all(self):
+        yield from self._store.get_all()
+
+    def get_position_matrix(self, key):
+        """
+        Returns the position matrix of a molecule without loading it.
+        """
+        return self._store.get_position_matrix(key)
+
+
+class LocalMoleculeDb(_LocalDb, stk.MoleculeDatabase):
+    """
+    A local stand-in for :class:`stk.MoleculeMongoDb`.
+
+    Molecules are stored in an embedded SQLite file, so no Mongo server
+    is needed. Like the Mongo database, molecules are put once and can
+    be retrieved by any of the keys made by `key_makers`.
+    """
+
+
+class LocalConstructedMoleculeDb(_LocalDb, stk.ConstructedMoleculeDatabase):
+    """
+    A local stand-in for :class:`stk.ConstructedMoleculeMongoDb`.
+
+    Constructed molecules, including their building blocks, are stored
+    in an embedded SQLite file, so no Mongo server is needed.
+    """
+
+
+def get_molecule_db(
+    db_url,
+    database,
+    molecule_collection,
+    position_matrix_collection,
+    key_makers=(stk.InchiKey(), ),
+    indices=('InChIKey', ),
+    position_matrix_encoding=None,
+):
+    """
+    Returns a molecule database for `db_url`.
+
+    Parameters
+    ----------
+    db_url : str
+        A Mongo URL, or the path of a directory for a local database.
+
+    database : str
+        The name of the database.
+
+    molecule_collection : str
+        The collection the molecules are stored in.
+
+    position_matrix_collection : str
+        The collection the position matrices are stored in. Only used
+        by Mongo.
+
+    key_makers : tuple of stk.MoleculeKeyMaker
+        Make the keys a molecule can be retrieved by.
+
+    indices : tuple of str
+        The keys to index. Only used by Mongo.
+
+    position_matrix_encoding : str, optional
+        Store the Mongo position matrices in a compact binary encoding,
+        'float32' or 'zlib', see `encode_position_matrix`. Encoded
+        matrices are always decoded when read. Local databases already
+        store binary position matrices.
+
+    Returns
+    -------
+    db : stk.MoleculeMongoDb or LocalMoleculeDb
+        The database.
+    """
+    if is_local_db(db_url):
+        return LocalMoleculeDb(
+            db_url,
+            database=database,
+            molecule_collection=molecule_collection,
+            key_makers=key_makers,
+        )
+    db = stk.MoleculeMongoDb(
+        mongo_client=pymongo.MongoClient(db_url),
+        database=database,
+        molecule_collection=molecule_collection,
+        position_matrix_collection=position_matrix_collection,
+        jsonizer=stk.MoleculeJsonizer(key_makers=key_makers),
+        indices=indices,
+    )
+    return use_encoded_position_matrices(db, position_matrix_encoding)
+
+
+def get_cage_db(
+    db_url,
+    collection_name,
+    key_makers,
+    database='cage_opt_100ns',
+    mongo_client=None,
+    position_matrix_encoding=None,
+):
+    """
+    Returns the database of the cages of one topology.
+
+    Parameters
+    ----------
+    db_url : str
+        A Mongo URL, or the path of a directory for a local database.
+
+    collection_name : str
+        The collection of the topology, for example '4+6'. The Mongo
+        position matrix, building block position matrix and constructed
+        molecule collections are named after it.
+
+    key_makers : tuple of stk.MoleculeKeyMaker
+        Make the keys a cage can be retrieved by.
+
+    database : str
+        The name of the database.
+
+    mongo_client : pymongo.MongoClient, optional
+        The client to use with Mongo. A new one is made if not given.
+
+    position_matrix_encoding : str, optional
+        Store the Mongo position matrices in a compact binary encoding,
+        'float32' or 'zlib', see `encode_position_matrix`. Encoded
+        matrices are always decoded when read. Local databases already
+        store binary position matrices.
+
+    Returns
+    -------
+    db : stk.ConstructedMoleculeMongoDb or LocalConstructedMoleculeDb
+        The database.
+    """
+    if is_local_db(db_url):
+        return LocalConstructedMoleculeDb(
+            db_url,
+            database=database,
+            molecule_collection=collection_name,
+            key_makers=key_makers,
+        )
+    if mongo_client is None:
+        mongo_client = pymongo.MongoClient(db_url)
+    db = stk.ConstructedMoleculeMongoDb(
+        mongo_client=mongo_client,
+        database=database,
+        molecule_collection=collection_name,
+        position_matrix_collection=f'{collection_name}_position_matrices',
+        building_block_position_matrix_collection=(
+            f'{collection_name}_building_block_position_matrices'
+        ),
+        constructed_molecule_collection=(
+            f'{collection_name}_constructed_molecules'
+        ),
+        jsonizer=stk.ConstructedMoleculeJsonizer(key_makers=key_makers),
+    )
+    return use_encoded_position_matrices(db, position_matrix_encoding)
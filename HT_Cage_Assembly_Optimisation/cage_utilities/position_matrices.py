@@ -0,0 +1,192 @@
+import zlib
+
+import numpy as np
+
+# Name of each encoding and the dtype its values are stored as.
+encodings = {
+    'float32': np.dtype('<f4'),
+    'zlib': np.dtype('<f8'),
+}
+
+
+def encode_position_matrix(position_matrix, encoding):
+    """
+    Returns a compact binary encoding of a position matrix.
+
+    Parameters
+    ----------
+    position_matrix : array_like
+        The (n, 3) position matrix.
+
+    encoding : str
+        'float32' stores the raw float32 values, which halves the size
+        and keeps about 7 significant figures. 'zlib' stores the
+        float64 values compressed with zlib, which is lossless.
+
+    Returns
+    -------
+    m : dict
+        The encoding, the shape and the bytes of the matrix, which can
+        be stored as the `m` entry of an stk position matrix document.
+    """
+    if encoding not in encodings:
+        raise ValueError(
+            f'Unknown position matrix encoding {encoding}. '
+            f'Use one of {list(encodings)}.'
+        )
+    matrix = np.ascontiguousarray(position_matrix, dtype=encodings[encoding])
+    data = matrix.tobytes()
+    if encoding == 'zlib':
+        data = zlib.compress(data)
+    return {
+        'encoding': encoding,
+        'shape': list(matrix.shape),
+        'data': data,
+    }
+
+
+def decode_position_matrix(m):
+    """
+    Returns the position matrix of an `m` entry as a float64 array.
+
+    `m` can be made by `encode_position_matrix`, or be the nested list
+    of floats written by the stk jsonizers.
+    """
+    if not isinstance(m, dict):
+        return np.array(m, dtype=np.float64)
+    data = m['data']
+    if m['encoding'] == 'zlib':
+        data = zlib.decompress(data)
+    matrix = np.frombuffer(data, dtype=encodings[m['encoding']])
+    return matrix.reshape(m['shape']).astype(np.float64)
+
+
+class EncodedPositionMatrixCollection:
+    """
+    Wraps a pymongo collection of position matrices.
+
+    Position matrices are encoded with `encode_position_matrix` when
+    they are written, and every document read has its matrix decoded,
+    whether it was encoded or written as plain JSON.
+    """
+
+    def __init__(self, collection, encoding=None):
+        """
+        Initialise the wrapper.
+
+        Parameters
+        ----------
+        collection : pymongo.collection.Collection
+            The collection to wrap.
+
+        encoding : str, optional
+            The encoding used when writing. If None, matrices are
+            written as the plain nested lists stk writes.
+        """
+        self._collection = collection
+        self._encoding = encoding
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    def _encode(self, document):
+        if self._encoding is None or 'm' not in document:
+            return document
+        document = dict(document)
+        document['m'] = encode_position_matrix(
+            document['m'], self._encoding
+        )
+        return document
+
+    def _encode_update(self, update):
+        if '$set' not in update:
+            return self._encode(update)
+        update = dict(update)
+        update['$set'] = self._encode(update['$set'])
+        return update
+
+    @staticmethod
+    def _decode(document):
+        if document is not None and 'm' in document:
+            document['m'] = decode_position_matrix(document['m'])
+        return document
+
+    def update_one(self, filter, update, *args, **kwargs):
+        return self._collection.update_one(
+            filter, self._encode_update(update), *args, **kwargs
+        )
+
+    def update_many(self, filter, update, *args, **kwargs):
+        return self._collection.update_many(
+            filter, self._encode_update(update), *args, **kwargs
+        )
+
+    def replace_one(self, filter, replacement, *args, **kwargs):
+        return self._collection.replace_one(
+            filter, self._encode(replacement), *args, **kwargs
+        )
+
+    def insert_one(self, document, *args, **kwargs):
+        return self._collection.insert_one(
+            self._encode(document), *args, **kwargs
+        )
+
+    def find_one(self, *args, **kwargs):
+        return self._decode(self._collection.find_one(*args, **kwargs))
+
+    def find(self, *args, **kwargs):
+        for document in self._collection.find(*args, **kwargs):
+            yield self._decode(document)
+
+
+def use_encoded_position_matrices(db, encoding=None):
+    """
+    Makes an stk Mongo database read and write encoded position matrices.
+
+    Notes
+    -----
+    stk keeps its collections as private attributes, so they are
+    replaced here by :class:`.EncodedPositionMatrixCollection` wrappers.
+    The molecule documents are unchanged.
+
+    Parameters
+    ----------
+    db : stk.MoleculeMongoDb or stk.ConstructedMoleculeMongoDb
+        The database to change.
+
+    encoding : str, optional
+        The encoding used when writing. If None, matrices are written
+        as plain JSON but encoded matrices can still be read.
+
+    Returns
+    -------
+    db : stk.MoleculeMongoDb or stk.ConstructedMoleculeMongoDb
+        The same database.
+    """
+    if encoding is not None and encoding not in encodings:
+        raise ValueError(
+            f'Unknown position matrix encoding {encoding}. '
+            f'Use one of {list(encodings)}.'
+        )
+    names = [
+        i for i in (
+            '_position_matrices',
+            '_building_block_position_matrices',
+        )
+        if hasattr(db, i)
+    ]
+    if not names:
+        raise AttributeError(
+            f'{type(db).__name__} has no position matrix collection to '
+            'wrap. The installed stk version is not supported.'
+        )
+    for name in names:
+        collection = getattr(db, name)
+        if isinstance(collection, EncodedPositionMatrixCollection):
+            collection = collection._collection
+        setattr(
+            db,
+            name,
+            EncodedPositionMatrixCollection(collection, encoding),
+        )
+    return db
@@ -0,0 +1,260 @@
+import hashlib
+import json
+import logging
+import os
+import time
+import traceback
+from pathlib import Path
+
+
+def _run_node(function, args):
+    """
+    Runs the function of a node, returning errors rather than raising
+    them so they can be reported by the parent process.
+    """
+    try:
+        return True, function(*args)
+    except Exception as err:
+        return False, (
+            f'{type(err).__name__}: {err}\n{traceback.format_exc()}'
+        )
+
+
+class _Node:
+
+    def __init__(self, key, function, args, params, dependencies, on_result):
+        self.key = key
+        self.function = function
+        self.args = tuple(args)
+        self.params = params
+        self.dependencies = tuple(dependencies)
+        self.on_result = on_result
+
+
+class Workflow:
+    """
+    A directed acyclic graph of tasks which are only rerun when they,
+    or a task they depend on, change.
+
+    Notes
+    -----
+    The fingerprint of a node is a hash of its key, its parameters and
+    the fingerprints of the nodes it depends on. The fingerprint of
+    every node which has completed is kept in a JSON state file, so a
+    node is up to date when its stored fingerprint matches. Changing
+    the parameters of a node therefore reruns it and every node
+    downstream of it, and nothing else.
+
+    Nodes must be added after the nodes they depend on.
+    """
+
+    def __init__(self, state_path):
+        """
+        Initialise the workflow.
+
+        Parameters
+        ----------
+        state_path : str
+            Path to the JSON file holding the fingerprints of the
+            completed nodes.
+        """
+        self.state_path = Path(state_path)
+        self._nodes = {}
+        self._fingerprints = {}
+        if self.state_path.exists():
+            with open(self.state_path, 'r') as f:
+                self._state = json.load(f)
+        else:
+            self._state = {}
+
+    def add(
+        self,
+        key,
+        function,
+        args=(),
+        params=None,
+        dependencies=(),
+        on_result=None,
+    ):
+        """
+        Adds a node to the workflow.
+
+        Parameters
+        ----------
+        key : str
+            A unique name of the node, for example
+            'cage/<cage_key>/4+6'.
+
+        function : callable
+            Called with `args` in a worker process to run the node.
+
+        args : tuple
+            The arguments of `function`.
+
+        params : dict, optional
+            Settings of the node which are part of its fingerprint. Must
+            be JSON serialisable.
+
+        dependencies : tuple of str
+            The keys of the nodes this node depends on.
+
+        on_result : callable, optional
+            Called in the parent process with the key and the return
+            value of `function` once the node has run, for example to
+            write its result.
+        """
+        if key in self._nodes:
+            raise ValueError(f'{key} is already in the workflow.')
+        for dependency in dependencies:
+            if dependency not in self._nodes:
+                raise KeyError(
+                    f'{key} depends on {dependency}, which must be added '
+                    'first.'
+                )
+        self._nodes[key] = _Node(
+            key=key,
+            function=function,
+            args=args,
+            params={} if params is None else params,
+            dependencies=dependencies,
+            on_result=on_result,
+        )
+
+    def fingerprint(self, key):
+        """
+        Returns the fingerprint of a node.
+        """
+        if key not in self._fingerprints:
+            node = self._nodes[key]
+            fingerprint = json.dumps(
+                {
+                    'key': key,
+                    'params': node.params,
+                    'dependencies': [
+                        self.fingerprint(i) for i in node.dependencies
+                    ],
+                },
+                sort_keys=True,
+            )
+            self._fingerprints[key] = hashlib.sha1(
+                fingerprint.encode()
+            ).hexdigest()
+        return self._fingerprints[key]
+
+    def outdated(self):
+        """
+        Returns the keys of the nodes which need to run, in the order
+        they were added.
+        """
+        return [
+            key for key in self._nodes
+            if self._state.get(key) != self.fingerprint(key)
+        ]
+
+    def mark_done(self, keys=None):
+        """
+        Records nodes as up to date without running them.
+
+        This is used to adopt results which already exist, such as the
+        cages of a database built before the workflow was used.
+
+        Parameters
+        ----------
+        keys : iterable of str, optional
+            The nodes to mark. All nodes are marked if not given.
+        """
+        keys = self._nodes if keys is None else keys
+        for key in keys:
+            self._state[key] = self.fingerprint(key)
+        self._write_state()
+
+    def _write_state(self):
+        temp_path = self.state_path.with_name(f'.{self.state_path.name}')
+        with open(temp_path, 'w') as f:
+            json.dump(self._state, f, indent=4, sort_keys=True)
+        os.replace(temp_path, self.state_path)
+
+    def run(self, pool=None, poll_interval=0.1):
+        """
+        Runs every outdated node once the nodes it depends on are done.
+
+        Parameters
+        ----------
+        pool : pathos.multiprocessing.ProcessingPool, optional
+            Runs ready nodes in parallel, so nodes of different stages
+            run at the same time. Nodes run one at a time in this
+            process if not given.
+
+        poll_interval : float
+            Seconds to wait between checks for finished nodes.
+
+        Returns
+        -------
+        summary : dict
+            The keys of the nodes which are `done`, `failed`, with
+            their error, and `skipped` because a dependency failed.
+        """
+        outdated = set(self.outdated())
+        waiting = [key for key in self._nodes if key in outdated]
+        summary = {'done': [], 'failed': {}, 'skipped': []}
+        logging.info(
+            f'{len(waiting)} of {len(self._nodes)} workflow nodes to run'
+        )
+
+        def is_ready(key):
+            return all(
+                i not in outdated for i in self._nodes[key].dependencies
+            )
+
+        def finish(key, success, value):
+            node = self._nodes[key]
+            if success and node.on_result is not None:
+                try:
+                    node.on_result(key, value)
+                except Exception as err:
+                    success = False
+                    value = f'{type(err).__name__}: {err}'
+            if success:
+                outdated.discard(key)
+                self._state[key] = self.fingerprint(key)
+                self._write_state()
+                summary['done'].append(key)
+                logging.info(f'{key} done')
+            else:
+                summary['failed'][key] = value
+                logging.error(f'{key} failed: {value}')
+
+        def skip_failed():
+            failed = set(summary['failed']).union(summary['skipped'])
+            for key in list(waiting):
+                if any(
+                    i in failed for i in self._nodes[key].dependencies
+                ):
+                    waiting.remove(key)
+                    summary['skipped'].append(key)
+                    failed.add(key)
+
+        if pool is None:
+            for key in list(waiting):
+                skip_failed()
+                if key not in waiting:
+                    continue
+                waiting.remove(key)
+                node = self._nodes[key]
+                finish(key, *_run_node(node.function, node.args))
+            return summary
+
+        running = {}
+        while waiting or running:
+            for key in [i for i in waiting if is_ready(i)]:
+                waiting.remove(key)
+                node = self._nodes[key]
+                running[key] = pool.apipe(_run_node, node.function, node.args)
+            finished = [key for key, i in running.items() if i.ready()]
+            if not finished:
+                time.sleep(poll_interval)
+                continue
+            for key in finished:
+                finish(key, *running.pop(key).get())
+            skip_failed()
+        return summary
@@ -19,15 +19,13 @@ import logging
 from pymongo.errors import ServerSelectionTimeoutError
 import random
 import logging
+import sys
 from rdkit import Chem
 
-def mongo_client():
-    return MongoClient(
-        'mongodb://path_to_mongo:27017/'
-    )
-db_url = 'mongodb://path_to_mongo:27017/'
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from cage_utilities.databases import get_molecule_db
 
-def quick_conf_search(smiles):
+def quick_conf_search(smiles, num_confs=500, random_seed=0):
     try:
         logging.info(f"Optimising {smiles}")
         mol = Chem.MolFromSmiles(smiles)
@@ -35,9 +33,7 @@ def quick_conf_search(smiles):
         Chem.Kekulize(mol, clearAromaticFlags=True)
         # Perform conformer search using ETKDGv3
         params = Chem.rdDistGeom.ETKDGv3()
-        random_seed = 0
         params.random_seed = random_seed
-        num_confs = 500
         embed_res = Chem.rdDistGeom.EmbedMultipleConfs(mol, num_confs, params)
         if embed_res == -1:
             logging.warning(
@@ -167,63 +163,71 @@ class std_smiles(stk.MoleculeKeyMaker):
     def __repr__(self):
         return 'std_smiles()'
 
-client = mongo_client()
-precursors_triamines = stk.MoleculeMongoDb(
-    mongo_client=client, database='cage_precursors', molecule_collection='Triamines', position_matrix_collection='triamines_postmat',
-    jsonizer=stk.MoleculeJsonizer(
-        key_makers = (stk.InchiKey(), std_smiles())), indices=('SMILES')
-)
-precursors_diamines = stk.MoleculeMongoDb(
-    mongo_client=client, database='cage_precursors', molecule_collection='Diamines', position_matrix_collection='diamines_postmat',
-    jsonizer=stk.MoleculeJsonizer(
-        key_makers = (stk.InchiKey(), std_smiles())), indices=('SMILES')
-)
-precursors_trialdehydes = stk.MoleculeMongoDb(
-    mongo_client=client, database='cage_precursors', molecule_collection='Trialdehydes', position_matrix_collection='trialdehydes_postmat',
-    jsonizer=stk.MoleculeJsonizer(
-        key_makers = (stk.InchiKey(), std_smiles())), indices=('SMILES')
-)
-precursors_dialdehydes = stk.MoleculeMongoDb(
-    mongo_client=client, database='cage_precursors', molecule_collection='Dialdehydes', position_matrix_collection='dialdehydes_postmat',
-    jsonizer=stk.MoleculeJsonizer(
-        key_makers = (stk.InchiKey(), std_smiles())), indices=('SMILES')
-)
-
+def get_precursor_db(db_url, collection_name):
+    """
+    Returns the precursor database of `collection_name`.
 
+    `db_url` is a Mongo URL, or the path of a directory for a local
+    database.
+    """
+    return get_molecule_db(
+        db_url,
+        database='cage_precursors',
+        molecule_collection=collection_name,
+        position_matrix_collection=f'{collection_name.lower()}_postmat',
+        key_makers=(stk.InchiKey(), std_smiles()),
+        indices=('SMILES', ),
+    )
 
 # Create precursor building block and optimise using quick conformer search
 # Make an rdkit molecule then a stk building block again
 # Store in collection of functionality within same precursor molecule mongodb 
 
-Triam = []
-for precursor in triamines:
-    #check why this is needed line 159
-    x = rdkit.MolToSmiles(quick_conf_search(precursor), kekuleSmiles=True)
-    BB = stk.BuildingBlock(x, [stk.PrimaryAminoFactory()])
-    Triam.append(BB)
-for i in Triam:
-    precursors_triamines.put(i)
-
-Diam = []
-for precursor in diamines:
-    x = rdkit.MolToSmiles(quick_conf_search(precursor), kekuleSmiles=True)
-    BB = stk.BuildingBlock(x, [stk.PrimaryAminoFactory()])
-    Diam.append(BB)
-for i in Diam:
-    precursors_diamines.put(i)
-
-Trial = []
-for precursor in trialdehydes:
-    x = rdkit.MolToSmiles(quick_conf_search(precursor), kekuleSmiles=True)
-    BB = stk.BuildingBlock(x, [stk.AldehydeFactory()])
-    Trial.append(BB)
-for i in Trial:
-    precursors_trialdehydes.put(i)
-
-Dial = []
-for precursor in dialdehydes:
-    x = rdkit.MolToSmiles(quick_conf_search(precursor), kekuleSmiles=True)
-    BB = stk.BuildingBlock(x, [stk.AldehydeFactory()])
-    Dial.append(BB) 
-for i in Dial:
-    precursors_dialdehydes.put(i)
+def optimise_precursors(
+    precursors, functional_group_factory, db, **conf_search_settings
+):
+    BBs = []
+    for precursor in precursors:
+        #check why this is needed line 159
+        x = rdkit.MolToSmiles(
+            quick_conf_search(precursor, **conf_search_settings),
+            kekuleSmiles=True,
+        )
+        BB = stk.BuildingBlock(x, [functional_group_factory])
+        BBs.append(BB)
+    for i in BBs:
+        db.put(i)
+
+def main(args):
+    optimise_precursors(
+        triamines,
+        stk.PrimaryAminoFactory(),
+        get_precursor_db(args.db, 'Triamines'),
+    )
+    optimise_precursors(
+        diamines,
+        stk.PrimaryAminoFactory(),
+        get_precursor_db(args.db, 'Diamines'),
+    )
+    optimise_precursors(
+        trialdehydes,
+        stk.AldehydeFactory(),
+        get_precursor_db(args.db, 'Trialdehydes'),
+    )
+    optimise_precursors(
+        dialdehydes,
+        stk.AldehydeFactory(),
+        get_precursor_db(args.db, 'Dialdehydes'),
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Precursor optimisation script."
+    )
+    parser.add_argument(
+        "-db",
+        help="Contains URL for MongoDB, or a path for a local database.",
+        required=True,
+    )
+    args = parser.parse_args()
+    main(args)
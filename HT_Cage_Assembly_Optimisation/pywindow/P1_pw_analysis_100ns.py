@@ -23,6 +23,20 @@ import csv
 import numpy as np
 import pandas as pd
 import logging
+import argparse
+from functools import partial
+from tqdm import tqdm
+from pathos.multiprocessing import ProcessingPool as Pool
+from pw_cache import PoreResultCache, hash_position_matrix, hash_settings
+from pw_sink import CsvResultsSink
+from pw_prescreen import prescreen_cavity
+import pw_report
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from cage_utilities.databases import get_cage_db, is_local_db
+from cage_utilities.position_matrices import decode_position_matrix
 
 
 import warnings
@@ -30,11 +44,35 @@ warnings.filterwarnings('ignore')
 
 def mongo_client(url):
     return MongoClient(
-        'mongodb://path_to_mongo:27017/'
+        url
     )
 
 db_url = 'mongodb://path_to_mongo:27017/'
 
+database = 'cage_opt_100ns'
+
+cache_path = 'pw_results.sqlite'
+
+topologies = ('2+3', '4+6', '6+9', '8+12')
+
+# Everything that changes the pywindow results of a cage.
+# Changing any of these invalidates the cached results.
+pw_settings = {
+    'pywindow_version': getattr(pw, '__version__', None),
+    'pore_diameter': 'calculate_pore_diameter_opt',
+    'pore_volume': 'calculate_pore_volume_opt',
+    'windows': 'calculate_windows',
+    'min_window_diameter': 0,
+    'max_window_diameter': 1000,
+    # Set to None to run pywindow on every cage.
+    'prescreen': {
+        'min_atoms': 20,
+        'min_pore_diameter': 1.0,
+        'search_fraction': 0.5,
+        'grid_spacing': 0.75,
+    },
+}
+
 def unqiue_cage_key(mol):
     k = ""
     if isinstance(mol, stk.ConstructedMolecule):
@@ -49,125 +87,248 @@ def unqiue_cage_key(mol):
     
 cage_key = stk.MoleculeKeyMaker(key_name='cage_key', get_key=unqiue_cage_key)
 
-db23_10ns = stk.ConstructedMoleculeMongoDb(
-    mongo_client=mongo_client(db_url), 
-    database='cage_opt_100ns', 
-    molecule_collection='2+3', 
-    position_matrix_collection='2+3_position_matrices', 
-    building_block_position_matrix_collection= '2+3_building_block_position_matrices',
-    constructed_molecule_collection='2+3_constructed_molecules',
-    jsonizer=stk.ConstructedMoleculeJsonizer(key_makers = [cage_key]),
-)
-
-db46_10ns = stk.ConstructedMoleculeMongoDb(
-    mongo_client=mongo_client(db_url), 
-    database='cage_opt_100ns',
-    molecule_collection='4+6', 
-    position_matrix_collection='4+6_position_matrices', 
-    building_block_position_matrix_collection= '4+6_building_block_position_matrices',
-    constructed_molecule_collection='4+6_constructed_molecules',
-    jsonizer=stk.ConstructedMoleculeJsonizer(key_makers = [cage_key]),
-)
-
-db69_10ns = stk.ConstructedMoleculeMongoDb(
-    mongo_client=mongo_client(db_url), 
-    database='cage_opt_100ns',
-    molecule_collection='6+9', 
-    position_matrix_collection='6+9_position_matrices', 
-    building_block_position_matrix_collection= '6+9_building_block_position_matrices',
-    constructed_molecule_collection='6+9_constructed_molecules',
-    jsonizer=stk.ConstructedMoleculeJsonizer(key_makers = [cage_key]),
-)
-
-db812_10ns = stk.ConstructedMoleculeMongoDb(
-    mongo_client=mongo_client(db_url), 
-    database='cage_opt_100ns',
-    molecule_collection='8+12', 
-    position_matrix_collection='8+12_position_matrices',
-    building_block_position_matrix_collection= '8+12_building_block_position_matrices',
-    constructed_molecule_collection='8+12_constructed_molecules',
-    jsonizer=stk.ConstructedMoleculeJsonizer(key_makers = [cage_key]),
-)
+_clients = {}
+_dbs = {}
+_caches = {}
 
-def get_cages(smiles_code):
-    smiles_code_l = [smiles_code]
-    molecules_test = []
-    for i in smiles_code_l:
-        try:
-            a = db23_10ns.get({'cage_key': i})
-            molecules_test.append(a)
-        except KeyError:
-            a = None
-        try:
-            b = db46_10ns.get({'cage_key': i})
-            molecules_test = molecules_test+[b]
-        except KeyError:
-            b = None
-        try:
-            c = db69_10ns.get({'cage_key': i})
-            molecules_test = molecules_test+[c]
-        except KeyError:
-            c = None 
+def get_client():
+    """
+    Returns the Mongo client of the current process.
+
+    MongoClient is not fork-safe, so each worker process of the
+    analysis pool opens its own client on first use.
+    """
+    key = os.getpid()
+    if key not in _clients:
+        _clients[key] = mongo_client(db_url)
+    return _clients[key]
+
+def get_result_cache():
+    """
+    Returns the pywindow result cache of the current process.
+    """
+    key = os.getpid()
+    if key not in _caches:
+        _caches[key] = PoreResultCache(cache_path)
+    return _caches[key]
+
+def get_db(topology):
+    """
+    Returns the cage database of `topology` for the current process.
+    """
+    key = (os.getpid(), topology)
+    if key not in _dbs:
+        _dbs[key] = get_cage_db(
+            db_url,
+            collection_name=topology,
+            key_makers=(cage_key, ),
+            database=database,
+            mongo_client=None if is_local_db(db_url) else get_client(),
+        )
+    return _dbs[key]
+
+def get_cage(smiles_code, topology):
+    """
+    Returns the cage of `topology` with the `cage_key` `smiles_code`,
+    or None if the cage is not in the database.
+    """
+    try:
+        return get_db(topology).get({'cage_key': smiles_code})
+    except KeyError:
+        return None
+
+def get_matrix_hash(smiles_code, topology):
+    """
+    Returns a hash of the stored position matrix of a cage.
+
+    Only the position matrix document is read, so this is much cheaper
+    than rebuilding the cage with `get_cage`.
+
+    Returns
+    -------
+    matrix_hash : str or None
+        The hash of the position matrix, or None if the cage is not
+        in the database.
+    """
+    if is_local_db(db_url):
         try:
-            d = db812_10ns.get({'cage_key': i})
-            molecules_test = molecules_test+[d]
+            return hash_position_matrix(
+                get_db(topology).get_position_matrix(
+                    {'cage_key': smiles_code}
+                )
+            )
         except KeyError:
-            d = None
-    cage_topology = {'smiles': (smiles_code),
-                    '2+3': (
-                        a
-                        ),
-                    '4+6': (
-                        b
-                        ),
-                    '6+9': (
-                        c
-                        ),
-                    '8+12': (
-                        d
-                        )
-                    }
+            return None
+    collection = get_client()[database][
+        f'{topology}_position_matrices'
+    ]
+    document = collection.find_one({'cage_key': smiles_code}, {'m': 1})
+    if document is None:
+        return None
+    return hash_position_matrix(decode_position_matrix(document['m']))
+
+def get_cages(smiles_code):
+    cage_topology = {'smiles': (smiles_code)}
+    for topology in topologies:
+        cage_topology[topology] = get_cage(smiles_code, topology)
     
     return cage_topology
 
-def pw_function(smiles_code, calc_dir, topology):
-    cage_dict = get_cages(smiles_code)
-    name = cage_dict['smiles']
-    molecule = cage_dict[topology]
-    results = {}
+def molecule_to_molsys(molecule, system_id='system'):
+    """
+    Returns a pywindow molecular system of an stk molecule.
+
+    The system is built directly from the position matrix and the
+    atom types of `molecule`, so no xyz file is written or parsed.
+
+    Parameters
+    ----------
+    molecule : stk.Molecule
+        The molecule to convert.
+
+    system_id : str
+        The id given to the pywindow molecular system.
+
+    Returns
+    -------
+    molsys : pywindow.MolecularSystem
+        The molecular system of `molecule`.
+    """
+    system = {
+        'elements': np.array(
+            [atom.__class__.__name__ for atom in molecule.get_atoms()]
+        ),
+        'coordinates': np.array(
+            molecule.get_position_matrix(), dtype=np.float64
+        ),
+    }
+    return pw.MolecularSystem.load_system(system, system_id=system_id)
+
+def empty_results(topology, molecular_weight=0, status=pw_report.ok, error=None):
+    """
+    Returns the results of a cage without a pore.
+    """
+    return {
+        'topology': topology,
+        'molecular_weight': molecular_weight,
+        'pore_diameter_opt': 0,
+        'pore_volume_opt': 0,
+        'windows': (),
+        'status': status,
+        'error': error,
+    }
+
+def pw_function(smiles_code, calc_dir, topology, write_files=False):
+    """
+    Returns the pywindow results of a cage.
+
+    Every result has a `status`, one of 'ok', 'missing' (the cage is
+    not in the database), 'non_porous' (rejected by the pre-screen),
+    'fetch_failed', 'conversion_failed', 'prescreen_failed' or
+    'pywindow_failed'. For the failures, `error` holds the exception
+    class. `timings` holds the seconds spent in each
+    step of the analysis and `cached` is True for a cached result.
+    Only 'ok' and 'non_porous' results are cached.
+    """
+    name = smiles_code
+    timer = pw_report.StepTimer()
 
     xyz_file = os.path.join(f'{name}_{topology}.xyz')
-    json_file = os.path.join(f'{name}_{topology}.json')
     pdb_file = os.path.join(f'{name}_{topology}.pdb')
 
+    settings_hash = hash_settings(pw_settings)
+    try:
+        with timer.step('cache'):
+            matrix_hash = get_matrix_hash(smiles_code, topology)
+            if matrix_hash is not None:
+                results = get_result_cache().get(
+                    smiles_code, topology, matrix_hash, settings_hash
+                )
+            else:
+                results = None
+        if results is not None:
+            logging.info(f'loading cached results of {name}_{topology}')
+            results['windows'] = tuple(results['windows'])
+            results['cached'] = True
+            results['timings'] = timer.timings
+            return results
+
+        with timer.step('fetch'):
+            molecule = get_cage(smiles_code, topology)
+    except Exception as err:
+        logging.error(f'fetching {name}_{topology} failed: {err!r}')
+        results = empty_results(
+            topology,
+            status=pw_report.fetch_failed,
+            error=type(err).__name__,
+        )
+        results['timings'] = timer.timings
+        return results
+
     if molecule == None:
-        results = {
-                'topology': topology,
-                'molecular_weight': 0,
-                'pore_diameter_opt':0,
-                'pore_volume_opt':0,
-                'windows':(),
-                'windows':(),
-            }
-    elif molecule != None:
-        pass
-
-    # Read in host from xyz file.
-    molecule.write(xyz_file)
-    if os.path.exists(json_file):
-        logging.info(f'loading {json_file}')
-        with open(json_file, 'r') as f:
-            results = json.load(f)
-    else:
-        logging.info(f'running pywindow on {name}:')
-        molsys = pw.MolecularSystem.load_file(xyz_file)
-        mol = molsys.system_to_molecule()
-        mol_mass = mol.molecular_weight()
+        results = empty_results(topology, status=pw_report.missing)
+        results['timings'] = timer.timings
+        return results
+
+    results = None
+    try:
+        with timer.step('conversion'):
+            if write_files:
+                molecule.write(xyz_file)
+            logging.info(f'running pywindow on {name}:')
+            molsys = molecule_to_molsys(
+                molecule, system_id=f'{name}_{topology}'
+            )
+            mol = molsys.system_to_molecule()
+            mol_mass = mol.molecular_weight()
+    except Exception as err:
+        logging.error(f'converting {name}_{topology} failed: {err!r}')
+        results = empty_results(
+            topology,
+            status=pw_report.conversion_failed,
+            error=type(err).__name__,
+        )
+    if results is None:
+        try:
+            with timer.step('prescreen'):
+                if pw_settings['prescreen'] is not None:
+                    screen = prescreen_cavity(
+                        molsys.system['elements'],
+                        molsys.system['coordinates'],
+                        **pw_settings['prescreen'],
+                    )
+                else:
+                    screen = {'porous': True}
+        except Exception as err:
+            logging.error(f'pre-screening {name}_{topology} failed: {err!r}')
+            results = empty_results(
+                topology,
+                mol_mass,
+                status=pw_report.prescreen_failed,
+                error=type(err).__name__,
+            )
+    if results is None and not screen['porous']:
+        # Skip the expensive pywindow optimisations of a cage which
+        # clearly has no cavity.
+        logging.info(f"{name}_{topology} is not porous: {screen['reason']}")
+        results = empty_results(
+            topology, mol_mass, status=pw_report.non_porous
+        )
+    elif results is None:
         try:
-            mol.calculate_pore_diameter_opt()
-            mol.calculate_pore_volume_opt()
-            mol.calculate_windows()
+            with timer.step('pore_diameter'):
+                mol.calculate_pore_diameter_opt()
+            with timer.step('pore_volume'):
+                mol.calculate_pore_volume_opt()
+            with timer.step('windows'):
+                mol.calculate_windows()
             mol.calculate_centre_of_mass()
+            win_list = [
+                i for i in mol.properties['windows']['diameters']
+                if pw_settings['min_window_diameter']
+                < i
+                < pw_settings['max_window_diameter']
+            ]
             results = {
                 'topology': topology,
                 'molecular_weight': mol_mass,
@@ -177,65 +338,127 @@ def pw_function(smiles_code, calc_dir, topology):
                 'pore_volume_opt': (
                     mol.properties['pore_volume_opt']
                 ),
-                'windows': tuple(
-                    i for i in mol.properties['windows']['diameters']
-                ),
+                'windows': tuple(win_list),
+                'status': pw_report.ok,
+                'error': None,
             }
-            win_list = list(results['windows'])
-            for i in win_list:
-                if i >= 1000 or i == 0:
-                    win_list.remove(i)
-                results = {
-                    'topology': topology,
-                    'molecular_weight': mol_mass,
-                    'pore_diameter_opt': (
-                        mol.properties['pore_diameter_opt']['diameter']
-                ),
-                    'pore_volume_opt': (
-                        mol.properties['pore_volume_opt']
-                ),
-                    'windows': tuple(
-                    win_list
-                ),
-            }                    
-            mol.dump_molecule(
-                pdb_file,
-                include_coms=True,
-                override=True,
+            if write_files:
+                with timer.step('dump'):
+                    mol.dump_molecule(
+                        pdb_file,
+                        include_coms=True,
+                        override=True,
+                    )
+        except Exception as err:
+            logging.error(f'pywindow failed on {name}_{topology}: {err!r}')
+            results = empty_results(
+                topology,
+                mol_mass,
+                status=pw_report.pywindow_failed,
+                error=type(err).__name__,
             )
-        except Exception:
-            results = {
-                'topology': topology,
-                'molecular_weight': mol_mass,
-                'pore_diameter_opt': 0,
-                'pore_volume_opt':0,
-                'windows':(),
-                'windows':(),
-            }
 
+    # Failures are not cached, so that the next run retries them.
+    if results['status'] in (pw_report.ok, pw_report.non_porous):
+        if matrix_hash is None:
+            matrix_hash = hash_position_matrix(
+                molecule.get_position_matrix()
+            )
+        get_result_cache().put(
+            smiles_code, topology, matrix_hash, settings_hash, results
+        )
+    results['cached'] = False
+    results['timings'] = timer.timings
     return results
-def full_cage_analysis(smiles_code, calc_dir):
+
+def write_cage_analysis(cage_full_analysis):
+    with open(f"{cage_full_analysis['cage']}.json", 'w') as f:
+        json.dump(cage_full_analysis, f, indent=4)
+
+def full_cage_analysis(smiles_code, calc_dir, write_files=False):
     ""  
     "conduct get_pw_result for all topologies and return a dictionary of the results."
-    cage_dict = get_cages(smiles_code)
-    name = cage_dict['smiles']
-    
-    results23 = pw_function(smiles_code, calc_dir, '2+3')
-    results46 = pw_function(smiles_code, calc_dir, '4+6')
-    results69 = pw_function(smiles_code, calc_dir, '6+9')
-    results812 = pw_function(smiles_code, calc_dir, '8+12')
-
-    cage_full_analysis = {'cage': name,
-                            '2+3': results23,
-                            '4+6': results46,
-                            '6+9': results69,
-                            '8+12': results812
-                         }
-
-    with open(f'{name}.json', 'w') as f:
-        json.dump(cage_full_analysis, f, indent=4)
+    cage_full_analysis = {'cage': smiles_code}
+    for topology in topologies:
+        cage_full_analysis[topology] = pw_function(
+            smiles_code, calc_dir, topology, write_files=write_files,
+        )
+
+    write_cage_analysis(cage_full_analysis)
 
     return cage_full_analysis
+
+def pw_task(task, calc_dir, write_files):
+    smiles_code, topology = task
+    return smiles_code, topology, pw_function(
+        smiles_code, calc_dir, topology, write_files=write_files,
+    )
+
+def parallel_cage_analysis(
+    smiles_codes,
+    calc_dir,
+    processes,
+    write_files=False,
+    report=None,
+):
+    """
+    Runs `pw_function` over every (cage_key, topology) pair in parallel.
+
+    Parameters
+    ----------
+    smiles_codes : iterable of str
+        The `cage_key` of each precursor pair to analyse.
+
+    calc_dir : str
+        The calculation directory passed on to `pw_function`.
+
+    processes : int
+        Number of worker processes to use.
+
+    write_files : bool
+        Toggles writing the xyz and pdb files of each cage.
+
+    report : pw_report.RunReport, optional
+        If given, every result is added to it as it arrives.
+
+    Yields
+    ------
+    cage_full_analysis : dict
+        The results of all topologies of a precursor pair, in the same
+        form as `full_cage_analysis`, as soon as the last topology of
+        the pair has finished.
+    """
+    smiles_codes = list(smiles_codes)
+    tasks = [(i, topology) for i in smiles_codes for topology in topologies]
+    pending = {i: {} for i in smiles_codes}
+    func = partial(pw_task, calc_dir=calc_dir, write_files=write_files)
+
+    if processes > 1:
+        pool = Pool(processes=processes)
+        results = pool.uimap(func, tasks)
+    else:
+        pool = None
+        results = map(func, tasks)
+    for smiles_code, topology, results_topology in tqdm(
+        results,
+        total=len(tasks),
+        desc="Analysing cages",
+    ):
+        pending[smiles_code][topology] = results_topology
+        if report is not None:
+            report.add(smiles_code, results_topology)
+        if len(pending[smiles_code]) == len(topologies):
+            pair_results = pending.pop(smiles_code)
+            cage_full_analysis = {'cage': smiles_code}
+            for i in topologies:
+                cage_full_analysis[i] = pair_results[i]
+            write_cage_analysis(cage_full_analysis)
+            logging.info(f"Finished {smiles_code}")
+            yield cage_full_analysis
+    if pool is not None:
+        pool.close()
+        pool.join()
+        pool.clear()
     
 
 
@@ -291,10 +514,163 @@ P1 = ["Nc1nc(N)nc(N)n1,O=Cc1cccc(C=O)c1",
       "NC1CC(N)CC(N)C1,O=Cc1c2ccccc2c(C=O)c2ccccc12"
      ]
 
-P1_dict = []
-for i in P1:
-    x = full_cage_analysis(i, '/path_to_calc_dir/')
-    P1_dict = P1_dict+[x]
+def stream_cage_analysis(
+    cage_keys,
+    sink,
+    calc_dir,
+    processes,
+    write_files=False,
+    extra_columns=None,
+):
+    """
+    Analyses the precursor pairs not yet in `sink`, writing each pair
+    to `sink` as soon as all of its topologies are done.
+
+    Parameters
+    ----------
+    cage_keys : iterable of str
+        The `cage_key` of each precursor pair to analyse.
+
+    sink : CsvResultsSink or ParquetResultsStore
+        Where the results are written. Pairs already in the sink are
+        skipped.
+
+    calc_dir : str
+        The calculation directory passed on to `pw_function`.
 
-df = pd.DataFrame(data=P1_dict)
-df.to_csv('P1_pw_100ns.csv',index=False)
+    processes : int
+        Number of worker processes to use.
+
+    write_files : bool
+        Toggles writing the xyz and pdb files of each cage.
+
+    extra_columns : dict, optional
+        Maps a `cage_key` to a dictionary of additional columns written
+        in front of its results.
+
+    Returns
+    -------
+    None
+
+    Notes
+    -----
+    A summary of the statuses, error classes and step timings of the
+    run is written next to the output, as `<output>_summary.json`.
+    """
+    if extra_columns is None:
+        extra_columns = {}
+    cage_keys = list(cage_keys)
+    report = pw_report.RunReport()
+    done = sink.completed()
+    todo = [i for i in cage_keys if i not in done]
+    logging.info(
+        f'{len(cage_keys) - len(todo)} precursor pairs already analysed, '
+        f'{len(todo)} to go'
+    )
+    try:
+        for cage_full_analysis in parallel_cage_analysis(
+            todo,
+            calc_dir=calc_dir,
+            processes=processes,
+            write_files=write_files,
+            report=report,
+        ):
+            sink.write({
+                **extra_columns.get(cage_full_analysis['cage'], {}),
+                **cage_full_analysis,
+            })
+    finally:
+        sink.close()
+        report.write(
+            sink.path.with_name(f'{sink.path.stem}_summary.json')
+        )
+
+def get_sink(path, row_group_size):
+    """
+    Returns the results sink for an output path.
+
+    A path ending in `.csv` gives a `CsvResultsSink`. Any other path is
+    used as the directory of a columnar `ParquetResultsStore`.
+    """
+    if str(path).endswith('.csv'):
+        return CsvResultsSink(path, row_group_size=row_group_size)
+    # pyarrow is only needed for the columnar store.
+    from pw_store import ParquetResultsStore
+    return ParquetResultsStore(path, row_group_size=row_group_size)
+
+def add_analysis_arguments(parser):
+    """
+    Adds the command line arguments shared by the analysis scripts.
+    """
+    parser.add_argument(
+        "-db",
+        help="Contains URL for MongoDB, or a path for a local database.",
+        default=db_url,
+    )
+    parser.add_argument(
+        "-p", help="Number of CPU cores to use.", default=1, type=int,
+    )
+    parser.add_argument(
+        "-calc_dir", help="Calculation directory.", default='/path_to_calc_dir/',
+    )
+    parser.add_argument(
+        "-cache",
+        help="Path to the SQLite cache of pywindow results.",
+        default=cache_path,
+    )
+    parser.add_argument(
+        "-write_files",
+        help="Write the xyz and pdb file of each cage.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-no_prescreen",
+        help="Run the full pywindow analysis on every cage.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-row_group_size",
+        help="Number of precursor pairs written to the output at once.",
+        default=16,
+        type=int,
+    )
+
+def configure(args):
+    """
+    Applies the parsed command line arguments to the module settings.
+    """
+    global cache_path, db_url
+    cache_path = args.cache
+    db_url = args.db
+    if args.no_prescreen:
+        pw_settings['prescreen'] = None
+
+def main(args):
+    configure(args)
+    stream_cage_analysis(
+        P1,
+        sink=get_sink(args.o, row_group_size=args.row_group_size),
+        calc_dir=args.calc_dir,
+        processes=args.p,
+        write_files=args.write_files,
+    )
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    parser = argparse.ArgumentParser(
+        description="Pywindow porosity analysis script."
+    )
+    add_analysis_arguments(parser)
+    parser.add_argument(
+        "-o",
+        help=(
+            "Path to the output CSV file, or to a columnar results store "
+            "directory if it does not end in .csv."
+        ),
+        default='P1_pw_100ns.csv',
+    )
+    args = parser.parse_args()
+    main(args)
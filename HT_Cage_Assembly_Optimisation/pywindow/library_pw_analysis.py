@@ -0,0 +1,158 @@
+import argparse
+import itertools as it
+import json
+import logging
+import re
+from pathlib import Path
+
+import rdkit.Chem.AllChem as rdkit
+import stk
+
+import P1_pw_analysis_100ns as pw_analysis
+
+here = Path(__file__).resolve().parent
+precursors_path = here.parent / 'precursors.json'
+combination_map_path = (
+    here.parents[1] / 'precursor_combination_map_to_exp_data.json'
+)
+
+aldehyde = rdkit.MolFromSmarts('[CX3H1](=O)[#6]')
+
+
+def get_precursor_key(smiles):
+    """
+    Returns the standardised SMILES of a precursor.
+
+    The SMILES is put through `stk` and `standardize_smiles` the same way
+    as the building blocks of the constructed cages, so that precursors
+    written in any notation match the `cage_key` in the database.
+    """
+    return pw_analysis.unqiue_cage_key(stk.BuildingBlock(smiles))
+
+
+def get_combination_cage_key(combination, precursors):
+    """
+    Returns the `cage_key` of a precursor combination such as 'A1'.
+
+    The letter names the tri-topic precursor and the number the di-topic
+    precursor, as in `precursors.json`. The tri-topic precursor comes
+    first in the `cage_key`, as it does in the constructed cages. Each
+    SMILES is standardised with `get_precursor_key`.
+    """
+    match = re.fullmatch(r'([A-Z])(\d+)', combination)
+    if match is None:
+        raise ValueError(f'{combination} is not a precursor combination.')
+    tritopic, ditopic = match.groups()
+    return ','.join(
+        get_precursor_key(precursors[name])
+        for name in (f'Tri{tritopic}', f'Di{ditopic}')
+    )
+
+
+def get_library(precursors_path, combination_map_path=None):
+    """
+    Returns the `cage_key` of every precursor combination of the library.
+
+    Parameters
+    ----------
+    precursors_path : str
+        Path to `precursors.json`.
+
+    combination_map_path : str, optional
+        Path to `precursor_combination_map_to_exp_data.json`. If given,
+        the combinations in the map are used. Otherwise every tri-topic
+        precursor is combined with every complementary di-topic one.
+
+    Returns
+    -------
+    library : dict
+        Maps each combination name to its `cage_key`.
+    """
+    with open(precursors_path, 'r') as f:
+        precursors = json.load(f)
+
+    if combination_map_path is not None:
+        with open(combination_map_path, 'r') as f:
+            combinations = json.load(f)
+        return {
+            combination: get_combination_cage_key(combination, precursors)
+            for combination in combinations
+        }
+
+    def is_aldehyde(name):
+        mol = rdkit.MolFromSmiles(precursors[name])
+        return mol.HasSubstructMatch(aldehyde)
+
+    tritopic = [i for i in precursors if i.startswith('Tri')]
+    ditopic = [i for i in precursors if i.startswith('Di')]
+    library = {}
+    for tri, di in it.product(tritopic, ditopic):
+        # Only amines and aldehydes can be combined.
+        if is_aldehyde(tri) == is_aldehyde(di):
+            continue
+        combination = f"{tri[len('Tri'):]}{di[len('Di'):]}"
+        library[combination] = get_combination_cage_key(
+            combination, precursors
+        )
+    return library
+
+
+def main(args):
+    pw_analysis.configure(args)
+    library = get_library(
+        precursors_path=args.precursors,
+        combination_map_path=(
+            None if args.all_combinations else args.combination_map
+        ),
+    )
+    logging.info(f'{len(library)} precursor combinations in the library')
+    pw_analysis.stream_cage_analysis(
+        library.values(),
+        sink=pw_analysis.get_sink(args.o, row_group_size=args.row_group_size),
+        calc_dir=args.calc_dir,
+        processes=args.p,
+        write_files=args.write_files,
+        extra_columns={
+            cage_key: {'combination': combination}
+            for combination, cage_key in library.items()
+        },
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    parser = argparse.ArgumentParser(
+        description="Pywindow porosity analysis of the full cage library."
+    )
+    pw_analysis.add_analysis_arguments(parser)
+    parser.add_argument(
+        "-o",
+        help=(
+            "Path to the output CSV file, or to a columnar results store "
+            "directory if it does not end in .csv."
+        ),
+        default='library_pw_100ns.csv',
+    )
+    parser.add_argument(
+        "-precursors",
+        help="Path to precursors.json.",
+        default=str(precursors_path),
+    )
+    parser.add_argument(
+        "-combination_map",
+        help="Path to precursor_combination_map_to_exp_data.json.",
+        default=str(combination_map_path),
+    )
+    parser.add_argument(
+        "-all_combinations",
+        help=(
+            "Combine every complementary pair in precursors.json instead "
+            "of using the combination map."
+        ),
+        action="store_true",
+    )
+    args = parser.parse_args()
+    main(args)
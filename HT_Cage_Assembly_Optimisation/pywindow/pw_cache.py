@@ -0,0 +1,99 @@
+import hashlib
+import json
+import sqlite3
+
+import numpy as np
+
+
+def hash_position_matrix(position_matrix):
+    """
+    Returns a hash of a position matrix.
+
+    Parameters
+    ----------
+    position_matrix : array_like
+        The (n, 3) position matrix of a molecule.
+
+    Returns
+    -------
+    hash : str
+        The hex digest of the matrix as float64 values.
+    """
+    matrix = np.ascontiguousarray(position_matrix, dtype=np.float64)
+    return hashlib.sha1(matrix.tobytes()).hexdigest()
+
+
+def hash_settings(settings):
+    """
+    Returns a hash of a dictionary of pywindow settings.
+    """
+    return hashlib.sha1(
+        json.dumps(settings, sort_keys=True).encode()
+    ).hexdigest()
+
+
+class PoreResultCache:
+    """
+    Stores pywindow results in a single SQLite file.
+
+    Results are keyed by the `cage_key`, the topology, a hash of the
+    position matrix of the cage and a hash of the pywindow settings,
+    so a re-optimised cage or a change of settings is never served a
+    stale result.
+    """
+
+    def __init__(self, path):
+        """
+        Initialise the cache.
+
+        Parameters
+        ----------
+        path : str
+            Path to the SQLite file. It is created if it does not exist.
+        """
+        self.path = path
+        self._connection = sqlite3.connect(path, timeout=60)
+        # WAL lets the worker processes read while another one writes.
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'cage_key TEXT NOT NULL, '
+            'topology TEXT NOT NULL, '
+            'matrix_hash TEXT NOT NULL, '
+            'settings_hash TEXT NOT NULL, '
+            'results TEXT NOT NULL, '
+            'PRIMARY KEY (cage_key, topology, matrix_hash, settings_hash))'
+        )
+        self._connection.commit()
+
+    def get(self, cage_key, topology, matrix_hash, settings_hash):
+        """
+        Returns the cached results, or None if there are none.
+        """
+        row = self._connection.execute(
+            'SELECT results FROM results WHERE cage_key=? AND topology=? '
+            'AND matrix_hash=? AND settings_hash=?',
+            (cage_key, topology, matrix_hash, settings_hash),
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def put(self, cage_key, topology, matrix_hash, settings_hash, results):
+        """
+        Stores the results of a cage, replacing any previous entry.
+        """
+        with self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                (
+                    cage_key,
+                    topology,
+                    matrix_hash,
+                    settings_hash,
+                    json.dumps(results),
+                ),
+            )
+
+    def close(self):
+        self._connection.close()
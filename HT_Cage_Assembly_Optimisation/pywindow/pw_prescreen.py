@@ -0,0 +1,159 @@
+import numpy as np
+
+# Bondi van der Waals radii in Angstrom.
+vdw_radii = {
+    'H': 1.10,
+    'C': 1.70,
+    'N': 1.55,
+    'O': 1.52,
+    'F': 1.47,
+    'S': 1.80,
+    'Cl': 1.75,
+    'Br': 1.85,
+}
+
+atomic_masses = {
+    'H': 1.008,
+    'C': 12.011,
+    'N': 14.007,
+    'O': 15.999,
+    'F': 18.998,
+    'S': 32.06,
+    'Cl': 35.45,
+    'Br': 79.904,
+}
+
+default_vdw_radius = 1.70
+default_atomic_mass = 12.011
+
+
+def _lookup(table, elements, default):
+    return np.array(
+        [table.get(i.capitalize(), default) for i in elements],
+        dtype=np.float64,
+    )
+
+
+def void_diameters(points, coordinates, radii, chunk_size=256):
+    """
+    Returns the diameter of the largest empty sphere at each point.
+
+    Parameters
+    ----------
+    points : numpy.ndarray
+        The (m, 3) points to test.
+
+    coordinates : numpy.ndarray
+        The (n, 3) atom coordinates.
+
+    radii : numpy.ndarray
+        The (n, ) van der Waals radii of the atoms.
+
+    chunk_size : int
+        Number of points handled at once, which bounds the memory used
+        by the (chunk_size, n) distance matrix.
+
+    Returns
+    -------
+    diameters : numpy.ndarray
+        The (m, ) diameters. Negative values mean the point lies inside
+        an atom.
+    """
+    diameters = np.empty(len(points), dtype=np.float64)
+    for start in range(0, len(points), chunk_size):
+        chunk = points[start:start+chunk_size]
+        distances = np.linalg.norm(
+            chunk[:, np.newaxis, :] - coordinates[np.newaxis, :, :],
+            axis=2,
+        )
+        diameters[start:start+chunk_size] = 2 * np.min(
+            distances - radii[np.newaxis, :], axis=1
+        )
+    return diameters
+
+
+def prescreen_cavity(
+    elements,
+    coordinates,
+    min_atoms=20,
+    min_pore_diameter=1.0,
+    search_fraction=0.5,
+    grid_spacing=0.75,
+):
+    """
+    Checks cheaply whether a cage can have a cavity at all.
+
+    Notes
+    -----
+    The largest empty sphere is searched for on a grid around the
+    centre of mass, within `search_fraction` of the median distance
+    of the atoms from the centre of mass. A cage is only rejected when
+    no point of the grid has room for a sphere of `min_pore_diameter`,
+    so the full pywindow optimisation still runs on every cage that
+    might be porous.
+
+    Parameters
+    ----------
+    elements : sequence of str
+        The element symbol of each atom.
+
+    coordinates : numpy.ndarray
+        The (n, 3) atom coordinates.
+
+    min_atoms : int
+        Cages with fewer atoms than this are rejected.
+
+    min_pore_diameter : float
+        The smallest pore diameter, in Angstrom, counted as a cavity.
+
+    search_fraction : float
+        Radius of the searched region, as a fraction of the median atom
+        distance from the centre of mass.
+
+    grid_spacing : float
+        Spacing of the search grid in Angstrom.
+
+    Returns
+    -------
+    screen : dict
+        Whether the cage passed (`porous`), the `reason` it was rejected,
+        the number of atoms, the empty diameter at the centre of mass and
+        the largest empty diameter found.
+    """
+    coordinates = np.asarray(coordinates, dtype=np.float64)
+    n_atoms = len(coordinates)
+    screen = {
+        'porous': True,
+        'reason': None,
+        'n_atoms': n_atoms,
+        'com_void_diameter': 0,
+        'max_void_diameter': 0,
+    }
+    if n_atoms < min_atoms:
+        screen['porous'] = False
+        screen['reason'] = 'too_few_atoms'
+        return screen
+
+    radii = _lookup(vdw_radii, elements, default_vdw_radius)
+    masses = _lookup(atomic_masses, elements, default_atomic_mass)
+    com = masses @ coordinates / masses.sum()
+
+    search_radius = search_fraction * np.median(
+        np.linalg.norm(coordinates - com, axis=1)
+    )
+    steps = np.arange(
+        -search_radius, search_radius + grid_spacing, grid_spacing
+    )
+    grid = np.stack(np.meshgrid(steps, steps, steps), axis=-1).reshape(-1, 3)
+    grid = grid[np.linalg.norm(grid, axis=1) <= search_radius] + com
+    # The centre of mass is the first point searched.
+    diameters = void_diameters(np.vstack([com, grid]), coordinates, radii)
+    com_void = diameters[0]
+    max_void = diameters.max()
+
+    screen['com_void_diameter'] = float(com_void)
+    screen['max_void_diameter'] = float(max_void)
+    if max_void < min_pore_diameter:
+        screen['porous'] = False
+        screen['reason'] = 'no_cavity'
+    return screen
@@ -0,0 +1,127 @@
+import json
+import logging
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+# Status of the results of a cage.
+ok = 'ok'
+missing = 'missing'
+non_porous = 'non_porous'
+fetch_failed = 'fetch_failed'
+conversion_failed = 'conversion_failed'
+prescreen_failed = 'prescreen_failed'
+pywindow_failed = 'pywindow_failed'
+
+
+class StepTimer:
+    """
+    Times the steps of the analysis of one cage.
+    """
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def step(self, name):
+        """
+        Adds the time spent in the `with` block to step `name`.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = (
+                self.timings.get(name, 0) + time.perf_counter() - start
+            )
+
+
+class RunReport:
+    """
+    Aggregates the status, error class and step timings of every result
+    of an analysis run.
+    """
+
+    def __init__(self, slowest=10):
+        """
+        Initialise the report.
+
+        Parameters
+        ----------
+        slowest : int
+            Number of slowest cages listed in the summary.
+        """
+        self.slowest = slowest
+        self._statuses = Counter()
+        self._errors = Counter()
+        self._cached = 0
+        self._steps = defaultdict(list)
+        self._totals = []
+        self._start = time.perf_counter()
+
+    def add(self, smiles_code, results):
+        """
+        Adds the results of one cage to the report.
+        """
+        self._statuses[results.get('status', ok)] += 1
+        if results.get('error') is not None:
+            self._errors[results['error']] += 1
+        if results.get('cached'):
+            self._cached += 1
+        timings = results.get('timings', {})
+        for step, seconds in timings.items():
+            self._steps[step].append(seconds)
+        self._totals.append(
+            (sum(timings.values()), smiles_code, results['topology'])
+        )
+
+    def summary(self):
+        """
+        Returns the summary of the run as a dictionary.
+        """
+        steps = {}
+        for step, seconds in self._steps.items():
+            steps[step] = {
+                'count': len(seconds),
+                'total_s': sum(seconds),
+                'mean_s': sum(seconds) / len(seconds),
+                'max_s': max(seconds),
+            }
+        slowest = sorted(self._totals, reverse=True)[:self.slowest]
+        return {
+            'results': len(self._totals),
+            'wall_time_s': time.perf_counter() - self._start,
+            'cached': self._cached,
+            'statuses': dict(self._statuses),
+            'errors': dict(self._errors),
+            'steps': steps,
+            'slowest': [
+                {'cage_key': key, 'topology': topology, 'total_s': total}
+                for total, key, topology in slowest
+            ],
+        }
+
+    def write(self, path):
+        """
+        Writes the summary to a JSON file and logs it.
+        """
+        summary = self.summary()
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=4)
+        logging.info(
+            f"{summary['results']} results in {summary['wall_time_s']:.1f} s "
+            f"({summary['cached']} cached)"
+        )
+        logging.info(f"statuses: {summary['statuses']}")
+        if summary['errors']:
+            logging.info(f"errors: {summary['errors']}")
+        for step, timing in sorted(
+            summary['steps'].items(),
+            key=lambda x: x[1]['total_s'],
+            reverse=True,
+        ):
+            logging.info(
+                f"{step}: {timing['total_s']:.1f} s total, "
+                f"{timing['mean_s']:.3f} s mean over {timing['count']}"
+            )
+        return summary
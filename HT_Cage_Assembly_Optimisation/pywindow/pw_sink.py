@@ -0,0 +1,80 @@
+import logging
+import os
+from pathlib import Path
+
+import pandas as pd
+
+
+class CsvResultsSink:
+    """
+    Appends the results of precursor pairs to a CSV file in row groups.
+
+    Rows are buffered and appended to the file every `row_group_size`
+    rows, so a crash loses at most one row group. Running the analysis
+    again with the same file resumes from the rows already written.
+    """
+
+    def __init__(self, path, row_group_size=16, key='cage'):
+        """
+        Initialise the sink.
+
+        Parameters
+        ----------
+        path : str
+            Path to the CSV file.
+
+        row_group_size : int
+            Number of rows buffered before they are appended.
+
+        key : str
+            The column identifying a precursor pair.
+        """
+        self.path = Path(path)
+        self.row_group_size = row_group_size
+        self.key = key
+        self._rows = []
+
+    def completed(self):
+        """
+        Returns the keys of the rows already written.
+
+        An incomplete last line, left by a crash during a write, is
+        removed first.
+        """
+        if not self.path.exists() or self.path.stat().st_size == 0:
+            return set()
+        with open(self.path, 'rb+') as f:
+            data = f.read()
+            if not data.endswith(b'\n'):
+                logging.warning(
+                    f'Removing incomplete last row of {self.path}'
+                )
+                f.truncate(data.rfind(b'\n') + 1)
+        if self.path.stat().st_size == 0:
+            return set()
+        return set(pd.read_csv(self.path, usecols=[self.key])[self.key])
+
+    def write(self, row):
+        """
+        Adds a row, appending the row group to file once it is full.
+        """
+        self._rows.append(row)
+        if len(self._rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Appends all buffered rows to file.
+        """
+        if not self._rows:
+            return
+        header = not self.path.exists() or self.path.stat().st_size == 0
+        df = pd.DataFrame(data=self._rows)
+        with open(self.path, 'a', newline='') as f:
+            f.write(df.to_csv(index=False, header=header))
+            f.flush()
+            os.fsync(f.fileno())
+        self._rows = []
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,293 @@
+import argparse
+import json
+import os
+from pathlib import Path
+from urllib.parse import quote
+from uuid import uuid4
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+topologies = ('2+3', '4+6', '6+9', '8+12')
+
+schema = pa.schema([
+    ('cage_key', pa.string()),
+    ('combination', pa.string()),
+    ('tritopic', pa.string()),
+    ('ditopic', pa.string()),
+    ('topology', pa.string()),
+    ('molecular_weight', pa.float64()),
+    ('pore_diameter_opt', pa.float64()),
+    ('pore_volume_opt', pa.float64()),
+    ('num_windows', pa.int32()),
+    ('windows', pa.list_(pa.float64())),
+    ('status', pa.string()),
+    ('error', pa.string()),
+    ('time_s', pa.float64()),
+])
+
+
+def to_rows(cage_full_analysis):
+    """
+    Returns one row per topology of the results of a precursor pair.
+
+    Parameters
+    ----------
+    cage_full_analysis : dict
+        The results of a precursor pair, as made by `full_cage_analysis`,
+        optionally with a 'combination' entry.
+
+    Returns
+    -------
+    rows : list of dict
+        The rows of the pair, matching `schema`.
+    """
+    cage_key = cage_full_analysis['cage']
+    tritopic, ditopic = cage_key.split(',')
+    rows = []
+    for topology in topologies:
+        results = cage_full_analysis[topology]
+        windows = [float(i) for i in results['windows']]
+        rows.append({
+            'cage_key': cage_key,
+            'combination': cage_full_analysis.get('combination'),
+            'tritopic': tritopic,
+            'ditopic': ditopic,
+            'topology': topology,
+            'molecular_weight': float(results['molecular_weight']),
+            'pore_diameter_opt': float(results['pore_diameter_opt']),
+            'pore_volume_opt': float(results['pore_volume_opt']),
+            'num_windows': len(windows),
+            'windows': windows,
+            'status': results.get('status'),
+            'error': results.get('error'),
+            'time_s': sum(results.get('timings', {}).values()),
+        })
+    return rows
+
+
+class ParquetResultsStore:
+    """
+    A columnar store of pywindow results with one row per
+    (cage_key, topology).
+
+    Notes
+    -----
+    The store is a directory of Parquet files partitioned by topology
+    (`topology=2%2B3/part-....parquet`). Every flush adds new files, so
+    the store can be appended to while the analysis runs and resumed
+    after a crash. Files are written under a hidden name and renamed
+    once complete, so a crash never leaves a corrupt file in the store.
+    A crash between the files of one flush can leave a pair with only
+    some of its topologies. Such a pair is not `completed`, so it is
+    analysed again on resume, and its old rows are removed when its new
+    ones are written.
+
+    It has the same interface as `CsvResultsSink` and takes the same
+    per-pair results.
+    """
+
+    def __init__(self, path, row_group_size=16, key='cage'):
+        """
+        Initialise the store.
+
+        Parameters
+        ----------
+        path : str
+            Path to the store directory.
+
+        row_group_size : int
+            Number of precursor pairs buffered before they are written.
+
+        key : str
+            The entry identifying a precursor pair in the results.
+        """
+        self.path = Path(path)
+        self.row_group_size = row_group_size
+        self.key = key
+        self._pairs = []
+        # Pairs with only some of their topologies in the store.
+        self._partial = set()
+
+    def completed(self):
+        """
+        Returns the `cage_key` of every precursor pair with all of its
+        `topologies` in the store.
+        """
+        if not self.path.exists():
+            return set()
+        table = load_results(
+            self.path, columns=['cage_key', 'topology'], as_table=True
+        )
+        found = {}
+        for cage_key, topology in zip(
+            table.column('cage_key').to_pylist(),
+            table.column('topology').to_pylist(),
+        ):
+            found.setdefault(cage_key, set()).add(topology)
+        complete = {
+            cage_key
+            for cage_key, pair_topologies in found.items()
+            if pair_topologies >= set(topologies)
+        }
+        self._partial = set(found) - complete
+        return complete
+
+    def write(self, row):
+        """
+        Adds the results of a precursor pair, writing the buffered pairs
+        once `row_group_size` is reached.
+        """
+        self._pairs.append(row)
+        if len(self._pairs) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all buffered precursor pairs to the store.
+        """
+        if not self._pairs:
+            return
+        rewritten = self._partial & {pair[self.key] for pair in self._pairs}
+        if rewritten:
+            self._remove_pairs(rewritten)
+            self._partial -= rewritten
+        rows = [i for pair in self._pairs for i in to_rows(pair)]
+        table = pa.Table.from_pylist(rows, schema=schema)
+        name = f'part-{uuid4().hex}.parquet'
+        for topology in topologies:
+            partition = table.filter(ds.field('topology') == topology)
+            partition = partition.drop_columns(['topology'])
+            directory = self.path / f"topology={quote(topology, safe='')}"
+            directory.mkdir(parents=True, exist_ok=True)
+            pq.write_table(partition, directory / f'.{name}')
+            os.replace(directory / f'.{name}', directory / name)
+        self._pairs = []
+
+    def _remove_pairs(self, cage_keys):
+        """
+        Rewrites the files holding rows of `cage_keys` without them.
+        """
+        value_set = pa.array(sorted(cage_keys), type=pa.string())
+        for path in sorted(self.path.glob('topology=*/part-*.parquet')):
+            keys = pq.read_table(
+                path, columns=['cage_key'], partitioning=None
+            )
+            if not pc.any(pc.is_in(keys['cage_key'], value_set)).as_py():
+                continue
+            table = pq.read_table(path, partitioning=None)
+            table = table.filter(
+                pc.invert(pc.is_in(table['cage_key'], value_set))
+            )
+            if table.num_rows == 0:
+                path.unlink()
+                continue
+            hidden = path.with_name(f'.{path.name}')
+            pq.write_table(table, hidden)
+            os.replace(hidden, path)
+
+    def close(self):
+        self.flush()
+
+
+def _dataset(path):
+    return ds.dataset(
+        path,
+        format='parquet',
+        partitioning=ds.partitioning(
+            pa.schema([('topology', pa.string())]), flavor='hive'
+        ),
+    )
+
+
+def load_results(
+    path,
+    topology=None,
+    precursor=None,
+    columns=None,
+    as_table=False,
+):
+    """
+    Loads pywindow results from a `ParquetResultsStore`.
+
+    Only the partitions and row groups matching the filters are read.
+
+    Parameters
+    ----------
+    path : str
+        Path to the store directory.
+
+    topology : str or iterable of str, optional
+        Only load results of these topologies.
+
+    precursor : str or iterable of str, optional
+        Only load results of cages made from these precursors, given by
+        SMILES as in the `cage_key`.
+
+    columns : list of str, optional
+        Only load these columns.
+
+    as_table : bool
+        Toggles returning a pyarrow table instead of a pandas DataFrame.
+
+    Returns
+    -------
+    results : pandas.DataFrame or pyarrow.Table
+        One row per (cage_key, topology).
+    """
+    expression = None
+    if topology is not None:
+        topology = [topology] if isinstance(topology, str) else list(topology)
+        expression = ds.field('topology').isin(topology)
+    if precursor is not None:
+        precursor = (
+            [precursor] if isinstance(precursor, str) else list(precursor)
+        )
+        precursor_expression = (
+            ds.field('tritopic').isin(precursor)
+            | ds.field('ditopic').isin(precursor)
+        )
+        expression = (
+            precursor_expression
+            if expression is None
+            else expression & precursor_expression
+        )
+    table = _dataset(path).to_table(columns=columns, filter=expression)
+    if as_table:
+        return table
+    return table.to_pandas()
+
+
+def main(args):
+    store = ParquetResultsStore(args.o, row_group_size=args.row_group_size)
+    done = store.completed()
+    for path in args.i:
+        with open(path, 'r') as f:
+            cage_full_analysis = json.load(f)
+        if cage_full_analysis['cage'] in done:
+            continue
+        store.write(cage_full_analysis)
+    store.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=(
+            "Adds per-pair JSON results of full_cage_analysis to a "
+            "columnar results store."
+        )
+    )
+    parser.add_argument(
+        "-i", help="Per-pair JSON result files.", nargs='+', required=True,
+    )
+    parser.add_argument("-o", help="Path to the store directory.", required=True)
+    parser.add_argument(
+        "-row_group_size",
+        help="Number of precursor pairs written at once.",
+        default=64,
+        type=int,
+    )
+    args = parser.parse_args()
+    main(args)
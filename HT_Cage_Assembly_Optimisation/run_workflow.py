@@ -0,0 +1,329 @@
+import argparse
+import json
+import logging
+import sys
+from pathlib import Path
+from uuid import uuid4
+
+import rdkit.Chem.AllChem as rdkit
+import stk
+from pathos.multiprocessing import ProcessingPool as Pool
+
+here = Path(__file__).resolve().parent
+for directory in (
+    'precursor_optimisation',
+    'cage_assembly_optimisation',
+    'pywindow',
+):
+    sys.path.append(str(here / directory))
+
+import cage_opt_100ns as cage_opt
+import library_pw_analysis
+import P1_pw_analysis_100ns as pw_analysis
+import precursors_opt
+import pw_report
+from cage_utilities.workflow import Workflow
+
+# Settings of the conformer search of each precursor.
+conf_search_settings = {
+    'num_confs': 500,
+    'random_seed': 0,
+}
+
+aldehyde = rdkit.MolFromSmarts('[CX3H1](=O)[#6]')
+
+
+def get_collection(name, smiles):
+    """
+    Returns the precursor collection of a precursor of `precursors.json`,
+    for example 'Triamines'.
+    """
+    is_aldehyde = rdkit.MolFromSmiles(smiles).HasSubstructMatch(aldehyde)
+    topicity = 'Tri' if name.startswith('Tri') else 'Di'
+    return f"{topicity}{'aldehydes' if is_aldehyde else 'amines'}"
+
+
+def get_functional_group_factory(collection_name):
+    if collection_name.endswith('aldehydes'):
+        return stk.AldehydeFactory()
+    return stk.PrimaryAminoFactory()
+
+
+def optimise_precursor(smiles, collection_name, db_url, settings):
+    """
+    Optimises one precursor and puts it in the precursor database.
+    """
+    precursors_opt.optimise_precursors(
+        [smiles],
+        get_functional_group_factory(collection_name),
+        precursors_opt.get_precursor_db(db_url, collection_name),
+        **settings,
+    )
+
+
+def get_building_block(smiles, collection_name, db_url):
+    """
+    Returns an optimised precursor from the precursor database.
+    """
+    db = precursors_opt.get_precursor_db(db_url, collection_name)
+    # The InChIKey does not depend on how the SMILES is written.
+    key = stk.InchiKey().get_key(stk.BuildingBlock(smiles))
+    return stk.BuildingBlock.init_from_molecule(
+        db.get({'InChIKey': key}),
+        functional_groups=[get_functional_group_factory(collection_name)],
+    )
+
+
+def optimise_cage(cage_key, topology, collection_names, db_url, settings):
+    """
+    Assembles and optimises one cage, replacing any stored version.
+    """
+    building_blocks = [
+        get_building_block(smiles, collection_name, db_url)
+        for smiles, collection_name in zip(
+            cage_key.split(','), collection_names
+        )
+    ]
+    result = cage_opt.cage_opt(
+        (*building_blocks, cage_opt.topologies[topology]),
+        uuid4().int,
+        db_url,
+        cage_opt.topologies,
+        settings=settings,
+        overwrite=True,
+    )
+    if result is None:
+        raise RuntimeError(f'Optimisation of {cage_key} {topology} failed.')
+    return result
+
+
+def analyse_cage(cage_key, topology, calc_dir, write_files):
+    """
+    Runs the pywindow analysis of one cage.
+    """
+    results = pw_analysis.pw_function(
+        cage_key, calc_dir, topology, write_files=write_files
+    )
+    # Missing cages and failed fetches are retried by the next run.
+    if results['status'] in (pw_report.missing, pw_report.fetch_failed):
+        raise RuntimeError(
+            f"Analysis of {cage_key} {topology} gave {results['status']}."
+        )
+    return results
+
+
+def build_workflow(args, library, precursors, settings):
+    """
+    Returns the workflow of the precursors, cages and porosity results
+    of a library.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        The command line arguments.
+
+    library : dict
+        Maps each combination name to its `cage_key`, built from the
+        standardised precursor SMILES as by `library_pw_analysis`.
+
+    precursors : dict
+        Maps each precursor name to its SMILES, as in `precursors.json`.
+
+    settings : dict
+        The 'precursor' conformer search and 'cage' optimiser settings.
+
+    Returns
+    -------
+    workflow : Workflow
+        The workflow, with one node per precursor, and per cage and
+        porosity result of each topology.
+
+    report : pw_report.RunReport
+        Collects the porosity results of the nodes which run.
+    """
+    workflow = Workflow(args.state)
+    run_name = uuid4().int
+    report = pw_report.RunReport()
+
+    # Nodes are keyed by the standardised SMILES, as the cages are in the
+    # cage database.
+    collections = {
+        library_pw_analysis.get_precursor_key(smiles): (
+            get_collection(name, smiles)
+        )
+        for name, smiles in precursors.items()
+    }
+    used = {smiles for i in library.values() for smiles in i.split(',')}
+    for smiles in sorted(used):
+        workflow.add(
+            key=f'precursor/{smiles}',
+            function=optimise_precursor,
+            args=(smiles, collections[smiles], args.db, settings['precursor']),
+            params={
+                'collection': collections[smiles],
+                'settings': settings['precursor'],
+            },
+        )
+
+    def write_cage(key, result):
+        cage, collection_name, identifier, topology_str = result
+        cage_opt.write_cage(
+            mol=cage,
+            db_url=args.db,
+            collection_name=collection_name,
+            identifier=identifier,
+            run_name=run_name,
+            topology_str=topology_str,
+            position_matrix_encoding=args.position_matrix_encoding,
+        )
+
+    def add_results(key, results):
+        # SMILES can contain '/', so the topology is split from the end.
+        cage_key = key[len('porosity/'):].rsplit('/', 1)[0]
+        report.add(cage_key, results)
+
+    for cage_key in library.values():
+        tritopic, ditopic = cage_key.split(',')
+        for topology in cage_opt.topologies:
+            workflow.add(
+                key=f'cage/{cage_key}/{topology}',
+                function=optimise_cage,
+                args=(
+                    cage_key,
+                    topology,
+                    (collections[tritopic], collections[ditopic]),
+                    args.db,
+                    settings['cage'],
+                ),
+                params={'settings': settings['cage']},
+                dependencies=(
+                    f'precursor/{tritopic}',
+                    f'precursor/{ditopic}',
+                ),
+                on_result=write_cage,
+            )
+            workflow.add(
+                key=f'porosity/{cage_key}/{topology}',
+                function=analyse_cage,
+                args=(cage_key, topology, args.calc_dir, args.write_files),
+                params={'settings': pw_analysis.pw_settings},
+                dependencies=(f'cage/{cage_key}/{topology}', ),
+                on_result=add_results,
+            )
+    return workflow, report
+
+
+def main(args):
+    pw_analysis.configure(args)
+    with open(args.precursors, 'r') as f:
+        precursors = json.load(f)
+    library = library_pw_analysis.get_library(
+        precursors_path=args.precursors,
+        combination_map_path=(
+            None if args.all_combinations else args.combination_map
+        ),
+    )
+    settings = {
+        'precursor': dict(conf_search_settings),
+        'cage': dict(cage_opt.optimiser_settings),
+    }
+    if args.settings is not None:
+        with open(args.settings, 'r') as f:
+            for stage, stage_settings in json.load(f).items():
+                settings[stage].update(stage_settings)
+
+    workflow, report = build_workflow(args, library, precursors, settings)
+    if args.mark_done:
+        workflow.mark_done()
+        logging.info('Marked every node of the workflow as up to date.')
+        return
+    outdated = workflow.outdated()
+    if args.dry_run:
+        for key in outdated:
+            print(key)
+        return
+
+    if args.p > 1:
+        with Pool(processes=args.p) as pool:
+            summary = workflow.run(pool=pool)
+        pool.close()
+    else:
+        summary = workflow.run()
+    logging.info(
+        f"{len(summary['done'])} nodes done, {len(summary['failed'])} "
+        f"failed and {len(summary['skipped'])} skipped"
+    )
+    state_path = Path(args.state)
+    summary['porosity'] = report.write(
+        state_path.with_name(f'{state_path.stem}_porosity_summary.json')
+    )
+    with open(
+        state_path.with_name(f'{state_path.stem}_summary.json'), 'w'
+    ) as f:
+        json.dump(summary, f, indent=4)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    parser = argparse.ArgumentParser(
+        description=(
+            "Runs precursor optimisation, cage optimisation and porosity "
+            "analysis, recomputing only what is out of date."
+        )
+    )
+    pw_analysis.add_analysis_arguments(parser)
+    parser.add_argument(
+        "-state",
+        help="Path to the JSON file recording the completed nodes.",
+        default='workflow_state.json',
+    )
+    parser.add_argument(
+        "-settings",
+        help=(
+            "JSON file of 'precursor' conformer search and 'cage' "
+            "optimiser settings, replacing the defaults."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "-precursors",
+        help="Path to precursors.json.",
+        default=str(library_pw_analysis.precursors_path),
+    )
+    parser.add_argument(
+        "-combination_map",
+        help="Path to precursor_combination_map_to_exp_data.json.",
+        default=str(library_pw_analysis.combination_map_path),
+    )
+    parser.add_argument(
+        "-all_combinations",
+        help=(
+            "Combine every complementary pair in precursors.json instead "
+            "of using the combination map."
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "-position_matrix_encoding",
+        help="Binary encoding of the stored cage position matrices.",
+        choices=("float32", "zlib"),
+        default=None,
+    )
+    parser.add_argument(
+        "-mark_done",
+        help=(
+            "Record every node as up to date without running it, to adopt "
+            "the contents of an existing database."
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "-dry_run",
+        help="Print the nodes which are out of date and exit.",
+        action="store_true",
+    )
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,21 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip('stk')
+pytest.importorskip('rdkit')
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'pywindow'))
+
+library_pw_analysis = pytest.importorskip('library_pw_analysis')
+
+
+def test_non_canonical_precursor_key():
+    raw = {'TriA': 'Nc1nc(N)nc(N)n1', 'Di22': 'NC1=NON=C1N'}
+    canonical = {'TriA': 'Nc1nc(N)nc(N)n1', 'Di22': 'Nc1nonc1N'}
+    cage_key = library_pw_analysis.get_combination_cage_key('A22', raw)
+    assert cage_key == library_pw_analysis.get_combination_cage_key(
+        'A22', canonical
+    )
+    assert cage_key != f"{raw['TriA']},{raw['Di22']}"
@@ -0,0 +1,47 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip('pyarrow')
+
+sys.path.append(str(Path(__file__).resolve().parents[1] / 'pywindow'))
+
+import pw_store
+
+
+def get_pair(cage_key):
+    return {
+        'cage': cage_key,
+        **{
+            topology: {
+                'molecular_weight': 100.0,
+                'pore_diameter_opt': 5.0,
+                'pore_volume_opt': 50.0,
+                'windows': [2.0],
+                'status': 'ok',
+            }
+            for topology in pw_store.topologies
+        },
+    }
+
+
+def test_resume_after_partial_flush(tmp_path):
+    store = pw_store.ParquetResultsStore(tmp_path)
+    store.write(get_pair('a,b'))
+    store.write(get_pair('c,d'))
+    store.flush()
+    # A crash part way through a flush leaves a topology unwritten.
+    next((tmp_path / 'topology=8%2B12').glob('part-*.parquet')).unlink()
+
+    store = pw_store.ParquetResultsStore(tmp_path)
+    assert store.completed() == set()
+    for cage_key in ('a,b', 'c,d'):
+        store.write(get_pair(cage_key))
+    store.close()
+
+    results = pw_store.load_results(tmp_path)
+    counts = results.groupby(['cage_key', 'topology']).size()
+    assert len(counts) == 2 * len(pw_store.topologies)
+    assert (counts == 1).all()
+    assert store.completed() == {'a,b', 'c,d'}
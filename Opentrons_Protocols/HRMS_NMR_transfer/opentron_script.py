@@ -0,0 +1,42 @@
+import sys
+from pathlib import Path
+from opentrons import protocol_api
+
+# The engine is in the parent directory, locally and on the robot.
+try:
+    sys.path.append(str(Path(__file__).resolve().parent.parent))
+except NameError:
+    pass
+sys.path.append("/root/Opentrons_Code")
+
+from protocol_engine import run_protocol
+
+# metadata
+metadata = {
+    "protocolName": "HRMS_NMR_transfer",
+    "author": "Name <opentrons@example.com>",
+    "description": "High-Throughput Run Transfer 20uL for HRMS and 500uL for NMR",
+    "apiLevel": "2.9",
+}
+
+# Directory of move_commands.json and substance_locations.json. If None,
+# the working directory is used if it has them, otherwise the protocol
+# directory on the robot.
+protocol_dir = None
+# Set to True to resume an interrupted run from progress_journal.json.
+resume = False
+# Set to True to skip, rather than repeat, the interrupted transfer.
+skip_interrupted = False
+
+
+def run(protocol: protocol_api.ProtocolContext):
+    """
+    Run the protocol.
+    """
+    run_protocol(
+        protocol,
+        "HRMS_NMR_transfer",
+        protocol_dir=protocol_dir,
+        resume=resume,
+        skip_interrupted=skip_interrupted,
+    )
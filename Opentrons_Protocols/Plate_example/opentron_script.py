@@ -1,9 +1,15 @@
-from pprint import pprint
-from opentrons import protocol_api
-import json
+import sys
 from pathlib import Path
-from collections import defaultdict
-from opentrons.types import Point
+from opentrons import protocol_api
+
+# The engine is in the parent directory, locally and on the robot.
+try:
+    sys.path.append(str(Path(__file__).resolve().parent.parent))
+except NameError:
+    pass
+sys.path.append("/root/Opentrons_Code")
+
+from protocol_engine import run_protocol
 
 # metadata
 metadata = {
@@ -13,294 +19,24 @@ metadata = {
     "apiLevel": "2.9",
 }
 
-
-class Opentrons:
-    def __init__(
-        self,
-        protocol: protocol_api.ProtocolContext,
-        deck_info: dict,
-    ):
-        """
-        Initialise the Opentrons object.
-
-        Parameters
-        ----------
-        protocol : protocol_api.ProtocolContext
-            The protocol context for the current protocol.
-        deck_info : dict
-            Dictionary of deck information.
-            Contains information of substances and their quantities on the deck.
-
-        Returns
-        -------
-        None
-        """
-        # Set gantry speeds
-        self.protocol = protocol
-        self.protocol.max_speeds["X"] = 250
-        self.protocol.max_speeds["Y"] = 250
-        self.protocol.max_speeds["Z"] = 250
-
-        # TODO: Add dynamic loading of labware
-        # self.tiprack1000 = self.protocol.load_labware(
-        #     "opentrons_96_tiprack_1000ul", 1
-        # )
-        self.tiprack300 = self.protocol.load_labware(
-            "opentrons_96_tiprack_300ul", 2
-        )
-        self.plate = self.protocol.load_labware(
-            "analyticalsales_48_wellplate_2000ul", 4
-        )
-        self.labware = {}
-        self.labware[4] = self.plate
-        # self.labware[1] = self.tiprack1000
-        self.labware[2] = self.tiprack300
-        # Add substances to the deck
-        for deck_number in deck_info:
-            self.labware[int(deck_number)] = self.protocol.load_labware(
-                deck_info[deck_number]["type"], int(deck_number)
-            )
-        # Delete name and type from deck_info
-        for deck_number in deck_info:
-            del deck_info[deck_number]["type"]
-            del deck_info[deck_number]["name"]
-        # Loading pipettes
-        # self.right_pipette = self.protocol.load_instrument(
-            # "p1000_single_gen2", "right", tip_racks=[self.tiprack1000]
-        # )
-        self.left_pipette = protocol.load_instrument(
-            "p300_single_gen2", "left", tip_racks=[self.tiprack300]
-        )
-        # self.right_pipette.flow_rate.aspirate = 40
-        # self.right_pipette.flow_rate.dispense = 40
-        self.left_pipette.flow_rate.aspirate = 70
-        self.left_pipette.flow_rate.dispense = 70
-        self.left_pipette.swelled = False
-        # self.right_pipette.swelled = False
-        # For tracking substance amounts
-        self.substances = defaultdict(list)
-        for position in deck_info:
-            position_int = int(position)
-            for well_plate in deck_info[position]:
-                substance_position = self.labware[position_int][well_plate]
-                substance = deck_info[position][well_plate]
-                substance_name = substance["substance"]
-                amount = substance["amount"]
-                self.substances[substance_name].append(
-                    {
-                        "position": substance_position,
-                        "amount": amount,
-                    }
-                )
-
-    def swell_tip(self, pipette, position):
-        """
-        Swells the tip in the `stock` labware location at a specified location.
-
-        Notes
-        -----
-        Perform before a pipette is used for transfer.
-
-        Parameters
-        ----------
-        pipette : pipette
-            The pipette to be used.
-
-        position:
-            Position to swell the tip in.
-
-        Returns
-        -------
-        None
-
-        """
-        for i in range(1):
-            pipette.aspirate(100, position)
-            self.protocol.delay(10)
-            pipette.move_to(position.top())
-            pipette.dispense(100, location=position)
-        pipette.swelled = True
-
-    def move_without_drip(self, position_to, position_from, pipette, amount):
-        """
-        Transfers substance from one location to another without dripping (hopefully).
-
-        Notes
-        -----
-        Ideally, the swell function will be used before this function is called to reduce the
-        probability of drips.
-
-        Parameters
-        ----------
-        position_to: position
-            Location of the target well plates to move substance to.
-        position_from: position
-            Location of the source well plates to move substance from.
-        amount: float or int
-            Amount of substance to be moved. (in uL)
-
-
-        Returns
-        -------
-        None
-
-        """
-        # Check if pipette swelled before movement
-        pipette.aspirate(amount, position_from)
-        pipette.air_gap(15)
-        pipette.dispense(location=position_to.top(z=2))
-
-    def move_substance(self, amount, substance_name, position_to, pipette):
-        """
-        Moves a specified amount of substance from one location to another.
-
-        Parameters
-        ----------
-        amount : float or int
-            Amount of substance to be moved. (in mL)
-        substance_name : str
-            Name of the substance to be moved.
-        position_to: position
-            Location of the target well plates to move substance to.
-        pipette: pipette
-            The pipette to be used.
-        value:
-
-        Returns
-        -------
-        None
-
-        """
-        # Find the deck location of the substance
-        try:
-            substance_position = self.substances[substance_name][0]["position"]
-        except:
-            pprint(self.substances)
-            print(f"Substance {substance_name} not found.")
-            raise RuntimeError(
-                f"Substance not found in deck. This could be due to the deck being empty, or the amount of {substance_name} needed exceeding the amount placed on the deck."
-            )
-
-        # Perform swelling
-        if pipette.swelled != substance_name:
-            self.swell_tip(
-                pipette=pipette,
-                position=substance_position,
-            )
-            pipette.swelled = substance_name
-            # Check to see if amount of substance is greater than the amount on the deck
-        minimum_volume = 400
-        if amount > (
-            self.substances[substance_name][0]["amount"] - minimum_volume
-        ):
-            print(
-                f"Amount of {substance_name} needed is greater than the amount on the deck.\n"
-                f"Trying again to move after changing the well plate to movw from of {substance_name}."
-            )
-            # Change the well plate to move from
-            self.substances[substance_name].pop(0)
-            if len(self.substances[substance_name]) == 0:
-                raise RuntimeError(
-                    f"No more {substance_name} left on the deck. Please check the deck and try again."
-                )
-            self.move_substance(
-                amount=amount,
-                substance_name=substance_name,
-                position_to=position_to,
-                pipette=pipette,
-            )
-
-        assert pipette.swelled == substance_name
-        # Get amount left on deck
-        # amount_left = self.substances[substance_name][0]["amount"]
-        # Change well bottom clearance to prevent pipette touching the solvent
-        # aspirate_loc = substance_position.bottom()
-        # aspirate_loc = aspirate_loc.move(
-        #     Point(0, 0, -aspirate_loc.point.z + 1)
-        # )
-        self.move_without_drip(
-            pipette=pipette,
-            position_to=position_to,
-            position_from=substance_position,
-            amount=amount,
-        )
-        self.substances[substance_name][0]["amount"] -= amount
+# Directory of move_commands.json and substance_locations.json. If None,
+# the working directory is used if it has them, otherwise the protocol
+# directory on the robot.
+protocol_dir = None
+# Set to True to resume an interrupted run from progress_journal.json.
+resume = False
+# Set to True to skip, rather than repeat, the interrupted transfer.
+skip_interrupted = False
 
 
 def run(protocol: protocol_api.ProtocolContext):
     """
     Run the protocol.
     """
-
-    amount_added = defaultdict(lambda: 0)
-    substance_path = Path("substance_locations.json")
-    move_path = Path("move_commands.json")
-    # Check if root in the directory
-    if not substance_path.is_file():
-        substance_path = Path("/root/Opentrons_Code/Plate1_example/substance_locations.json")
-        move_path = Path("/root/Opentrons_Code/Plate1_example/move_commands.json")
-
-    with open(str(substance_path)) as f:
-        deck_info = json.load(f)
-    ot = Opentrons(protocol=protocol, deck_info=deck_info)
-
-    with open(str(move_path)) as f:
-        move_info = json.load(f)
-
-    # Extract list of moves from the move information
-    moves = []
-    for substance in move_info:
-        for location in substance["location"]:
-            moves.append(
-                {
-                    "substance": substance["substance"],
-                    "location": location,
-                    "amount": substance["amount"],
-                    "plate": substance["plate"],
-                }
-            )
-    added_substances = []
-    positions_added = defaultdict(str)
-    pipette_max_volume = 220
-    for move in moves:
-        location = move["location"]
-        amount = int(move["amount"])
-        plate = int(move["plate"])
-        substance = move["substance"]
-        # Get target well location
-        target_well = ot.labware[plate].wells(location)[0]
-        # Add the first substance to the list
-        num_moves = amount // pipette_max_volume
-        #if amount >= 230:
-        #    print(num_moves)
-        added = 0
-        if len(added_substances) == 0:
-            ot.left_pipette.pick_up_tip()
-            added_substances.append(substance)
-        # Check if substance matches the last substance added
-        elif substance != added_substances[-1]:
-            # Get a new tip
-            ot.left_pipette.drop_tip()
-            ot.left_pipette.pick_up_tip()
-            added_substances.append(substance)
-        for i in range(num_moves + 1):
-            # Check if move is the last move
-            if i == num_moves:
-                amount_to_add = amount - added
-            else:
-                amount_to_add = pipette_max_volume
-            if amount_to_add == 0:
-                continue
-            ot.move_substance(
-                amount=amount_to_add,
-                substance_name=substance,
-                position_to=target_well,
-                pipette=ot.left_pipette,
-            )
-            added += amount_to_add
-            amount_added[location] += amount_to_add
-        positions_added[location] += substance + " "
-    for line in protocol.commands():
-        continue
-    pprint(amount_added)
-    pprint(positions_added)
+    run_protocol(
+        protocol,
+        "Plate_example",
+        protocol_dir=protocol_dir,
+        resume=resume,
+        skip_interrupted=skip_interrupted,
+    )
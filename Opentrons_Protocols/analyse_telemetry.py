@@ -0,0 +1,164 @@
+import argparse
+import json
+from collections import defaultdict
+from pathlib import Path
+
+from protocol_engine import telemetry_name
+
+
+def load_runs(path):
+    """
+    Returns the events of each run in an event log.
+
+    Parameters
+    ----------
+    path : str
+        The path to a `run_telemetry.jsonl`, or to the protocol
+        directory holding it.
+
+    Returns
+    -------
+    runs : list of list of dict
+        The events of each run, split at the "run_start" events.
+    """
+    path = Path(path)
+    if path.is_dir():
+        path = path / telemetry_name
+    runs = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if event["event"] == "run_start" or not runs:
+                runs.append([])
+            runs[-1].append(event)
+    return runs
+
+
+def analyse_run(events):
+    """
+    Breaks down the time of a run by category and command.
+
+    Notes
+    -----
+    The run time is from the start of the first event to the end of the
+    last. Time between commands, such as planning and writing the
+    progress journal, is reported as "other".
+
+    Parameters
+    ----------
+    events : list of dict
+        The events of one run, from `load_runs`.
+
+    Returns
+    -------
+    analysis : dict
+        The `run_s`, the number of `aspirations`, and the `count` and
+        time in s of each `category` and of each "category:event" in
+        `events`.
+    """
+    commands = [i for i in events if i["category"] != "run"]
+    start = min(i["protocol_time"] for i in events)
+    end = max(i["protocol_time"] + i["duration"] for i in events)
+    categories = defaultdict(lambda: {"count": 0, "time_s": 0.0})
+    by_event = defaultdict(lambda: {"count": 0, "time_s": 0.0})
+    for event in commands:
+        for key, totals in (
+            (event["category"], categories),
+            (f"{event['category']}:{event['event']}", by_event),
+        ):
+            totals[key]["count"] += 1
+            totals[key]["time_s"] += event["duration"]
+    categories["other"]["time_s"] = (end - start) - sum(
+        i["duration"] for i in commands
+    )
+    return {
+        "run_s": end - start,
+        "aspirations": len(
+            {i["aspiration"] for i in commands if i["aspiration"] is not None}
+        ),
+        "categories": dict(categories),
+        "events": dict(by_event),
+    }
+
+
+def combine(analyses):
+    """
+    Returns the sum of the analyses of several runs.
+    """
+    combined = {"run_s": 0.0, "aspirations": 0, "categories": {}, "events": {}}
+    for analysis in analyses:
+        combined["run_s"] += analysis["run_s"]
+        combined["aspirations"] += analysis["aspirations"]
+        for key in ("categories", "events"):
+            for name, totals in analysis[key].items():
+                total = combined[key].setdefault(
+                    name, {"count": 0, "time_s": 0.0}
+                )
+                total["count"] += totals["count"]
+                total["time_s"] += totals["time_s"]
+    return combined
+
+
+def main(args):
+    analyses = {}
+    for path in args.i:
+        runs = [analyse_run(i) for i in load_runs(path)]
+        analyses[path] = {"runs": runs, "total": combine(runs)}
+
+    for path, analysis in analyses.items():
+        total = analysis["total"]
+        print(
+            f"{path}: {len(analysis['runs'])} runs, "
+            f"{total['run_s'] / 60:.1f} min, "
+            f"{total['aspirations']} aspirations"
+        )
+        print(
+            f"{'':<4}{'category':<28}{'count':>8}{'time (min)':>12}"
+            f"{'share':>8}"
+        )
+        rows = sorted(
+            total["categories"].items(), key=lambda i: -i[1]["time_s"]
+        )
+        for name, totals in rows:
+            events = sorted(
+                (
+                    (i, j) for i, j in total["events"].items()
+                    if i.split(":")[0] == name
+                ),
+                key=lambda i: -i[1]["time_s"],
+            )
+            for label, row, indent in [(name, totals, 4)] + [
+                (i, j, 6) for i, j in events
+            ]:
+                share = row["time_s"] / total["run_s"] if total["run_s"] else 0
+                print(
+                    f"{'':<{indent}}{label:<{32 - indent}}{row['count']:>8}"
+                    f"{row['time_s'] / 60:>12.2f}{share:>8.1%}"
+                )
+    if args.o is not None:
+        with open(args.o, "w") as f:
+            json.dump(analyses, f, indent=4)
+    return analyses
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=(
+            "Breaks down the time of Opentrons runs by category from "
+            "their event logs."
+        )
+    )
+    parser.add_argument(
+        "-i",
+        help=(
+            "Paths to the event logs, or to the protocol directories "
+            "holding them."
+        ),
+        nargs="+",
+        required=True,
+    )
+    parser.add_argument("-o", help="Path to a JSON file of the analysis.")
+    args = parser.parse_args()
+    main(args)
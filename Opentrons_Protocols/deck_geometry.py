@@ -0,0 +1,212 @@
+import json
+import math
+from collections import defaultdict
+from pathlib import Path
+
+from protocol_config import get_labware
+
+custom_labware_path = Path(__file__).resolve().parent / "Custom_labware"
+
+# Front left corner of each OT-2 deck slot in deck coordinates (mm).
+slot_origins = {
+    1: (0.0, 0.0, 0.0),
+    2: (132.5, 0.0, 0.0),
+    3: (265.0, 0.0, 0.0),
+    4: (0.0, 90.5, 0.0),
+    5: (132.5, 90.5, 0.0),
+    6: (265.0, 90.5, 0.0),
+    7: (0.0, 181.0, 0.0),
+    8: (132.5, 181.0, 0.0),
+    9: (265.0, 181.0, 0.0),
+    10: (0.0, 271.5, 0.0),
+    11: (132.5, 271.5, 0.0),
+    12: (265.0, 271.5, 0.0),
+}
+
+# Where tips are dropped in the fixed trash of slot 12.
+trash_position = (347.84, 351.5, 82.0)
+
+# Height of the standard Opentrons tip racks (mm).
+tiprack_heights = {
+    "opentrons_96_tiprack_20ul": 64.69,
+    "opentrons_96_tiprack_300ul": 64.49,
+    "opentrons_96_tiprack_1000ul": 97.47,
+}
+
+
+def get_tiprack_definition(load_name):
+    """
+    Returns a labware definition of a standard 96 tip rack.
+
+    Only the geometry used by the planners is included.
+    """
+    height = tiprack_heights[load_name]
+    rows = "ABCDEFGH"
+    wells = {}
+    ordering = []
+    for column in range(12):
+        ordering.append([])
+        for row_index, row in enumerate(rows):
+            name = f"{row}{column + 1}"
+            ordering[-1].append(name)
+            wells[name] = {
+                "x": 14.38 + 9 * column,
+                "y": 74.38 - 9 * row_index,
+                "z": height,
+                "depth": 0,
+            }
+    return {
+        "ordering": ordering,
+        "wells": wells,
+        "dimensions": {"zDimension": height},
+        "cornerOffsetFromSlot": {"x": 0, "y": 0, "z": 0},
+        "parameters": {"loadName": load_name},
+    }
+
+
+def load_definition(load_name, labware_path=custom_labware_path):
+    """
+    Returns the definition of a labware.
+
+    Parameters
+    ----------
+    load_name : str
+        The load name of a custom labware, or its file name without
+        `.json`, or a standard Opentrons tip rack.
+
+    labware_path : pathlib.Path
+        The directory of the custom labware definitions.
+
+    Returns
+    -------
+    definition : dict
+        The labware definition.
+    """
+    if load_name in tiprack_heights:
+        return get_tiprack_definition(load_name)
+    path = Path(labware_path) / f"{load_name}.json"
+    if path.is_file():
+        with open(path) as f:
+            return json.load(f)
+    for path in sorted(Path(labware_path).glob("*.json")):
+        with open(path) as f:
+            definition = json.load(f)
+        if definition["parameters"]["loadName"] == load_name:
+            return definition
+    raise KeyError(f"No labware definition found for {load_name}.")
+
+
+class Deck:
+    """
+    The positions of the wells of the labware on an OT-2 deck.
+    """
+
+    def __init__(self, labware, labware_path=custom_labware_path):
+        """
+        Initialise the deck.
+
+        Parameters
+        ----------
+        labware : dict
+            The load name of the labware in each deck slot.
+
+        labware_path : pathlib.Path
+            The directory of the custom labware definitions.
+        """
+        self.labware = {int(slot): name for slot, name in labware.items()}
+        self.definitions = {
+            slot: load_definition(name, labware_path)
+            for slot, name in self.labware.items()
+        }
+        # The gantry moves between labware above the tallest one.
+        self.safe_height = 10 + max(
+            i["dimensions"]["zDimension"] for i in self.definitions.values()
+        )
+
+    def wells(self, slot):
+        """
+        Returns the well names of a labware in Opentrons order, going
+        down each column in turn.
+        """
+        return [
+            well
+            for column in self.definitions[int(slot)]["ordering"]
+            for well in column
+        ]
+
+    def columns(self, slot):
+        """
+        Returns the well names of each column of a labware.
+        """
+        return [list(i) for i in self.definitions[int(slot)]["ordering"]]
+
+    def well_position(self, slot, well):
+        """
+        Returns the deck coordinates of the top centre of a well.
+        """
+        slot = int(slot)
+        definition = self.definitions[slot]
+        offset = definition["cornerOffsetFromSlot"]
+        well = definition["wells"][well]
+        origin = slot_origins[slot]
+        return (
+            origin[0] + offset["x"] + well["x"],
+            origin[1] + offset["y"] + well["y"],
+            origin[2] + offset["z"] + well["z"] + well["depth"],
+        )
+
+    def travel(self, position_from, position_to):
+        """
+        Returns the distance travelled by the pipette between two
+        positions, lifting to the safe height in between.
+
+        Parameters
+        ----------
+        position_from : tuple of float
+            The (x, y, z) position moved from.
+
+        position_to : tuple of float
+            The (x, y, z) position moved to.
+
+        Returns
+        -------
+        distance : dict
+            The horizontal `xy` and vertical `z` distances in mm.
+        """
+        x1, y1, z1 = position_from
+        x2, y2, z2 = position_to
+        xy = math.hypot(x2 - x1, y2 - y1)
+        if xy == 0:
+            return {"xy": 0.0, "z": abs(z2 - z1)}
+        lift = max(self.safe_height, z1, z2)
+        return {"xy": xy, "z": (lift - z1) + (lift - z2)}
+
+
+def get_sources(deck_info):
+    """
+    Returns the source wells of each substance, in the order they are
+    used by `Opentrons.move_substance`.
+    """
+    sources = defaultdict(list)
+    for slot, labware in deck_info.items():
+        for well, substance in labware.items():
+            if well in ("name", "type", "solvent"):
+                continue
+            sources[substance["substance"]].append(
+                {
+                    "slot": int(slot),
+                    "well": well,
+                    "amount": substance["amount"],
+                }
+            )
+    return sources
+
+
+def get_deck(deck_info, config):
+    """
+    Returns the deck of a protocol.
+    """
+    labware = get_labware(config)
+    for slot, info in deck_info.items():
+        labware[int(slot)] = info["type"]
+    return Deck(labware)
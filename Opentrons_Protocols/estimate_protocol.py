@@ -0,0 +1,296 @@
+import argparse
+import json
+import time
+from collections import defaultdict
+
+from deck_geometry import get_deck, trash_position
+from inventory import plan_inventory
+from liquid_classes import default_flow_rates
+from protocol_compiler import compile_protocol, get_run_config
+from protocol_config import (
+    get_draws,
+    get_pipettes,
+    get_tiprack_slots,
+    load_config,
+    protocols,
+)
+from tip_planning import get_new_tips, tips_per_rack
+
+# Default and highest speeds of the gantry axes in mm/s.
+default_speeds = {"X": 600, "Y": 400, "Z": 125}
+
+# Fixed durations in s, measured from OT-2 run logs.
+timings = {
+    # Acceleration and settling of each gantry move.
+    "move_overhead": 0.25,
+    # Pressing onto and ejecting a tip, excluding travel.
+    "pick_up_tip": 3.0,
+    "drop_tip": 2.0,
+    # Starting and stopping the plunger.
+    "plunger_overhead": 0.3,
+    "blow_out": 1.0,
+    # Homing and loading at the start of a run.
+    "setup": 20.0,
+}
+
+
+def get_speeds(config):
+    """
+    Returns the speed of each gantry axis of a protocol in mm/s.
+    """
+    if config["max_speed"] is None:
+        return dict(default_speeds)
+    return {
+        axis: min(config["max_speed"], speed)
+        for axis, speed in default_speeds.items()
+    }
+
+
+def estimate(moves, deck_info, config, plan=None):
+    """
+    Returns an estimate of the duration, tips and volumes of a protocol.
+
+    Notes
+    -----
+    Each pipette is followed through the moves as `run()` makes them,
+    including the chunking of each protocol and the distribute mode of
+    the top-up protocols, and with column-aligned moves made by the
+    multi-channel pipette if the protocol has one. Each gantry move
+    takes the time of its slowest axis, lifting to the safe height
+    between labware, plus a fixed overhead. Plunger steps take their
+    volume divided by the flow rate. Tips are changed as planned by
+    `tip_planning.plan_tips`, and each new tip is swelled.
+
+    Parameters
+    ----------
+    moves : list of dict
+        The moves, as made by `move_planner.expand_moves`.
+
+    deck_info : dict
+        The contents of `substance_locations.json`.
+
+    config : dict
+        The settings of the protocol.
+
+    plan : dict, optional
+        The plan made by `inventory.plan_inventory`, such as a compiled
+        plan. Made if not given, with the tip policies of the moves.
+
+    Returns
+    -------
+    estimate : dict
+        The counts of aspirations, dispenses, air gaps, swells and tips,
+        the tips used from the rack of each pipette, the volume of each
+        substance taken from each source well, the wells which run dry
+        and the estimated time of each category of step in s.
+    """
+    deck = get_deck(deck_info, config)
+    pipettes = get_pipettes(config)
+    speeds = get_speeds(config)
+    if plan is None:
+        plan = plan_inventory(moves, deck_info, config, check=False)
+
+    counts = defaultdict(int)
+    counts["source_switches"] = plan["switches"]
+    seconds = defaultdict(float)
+    consumption = defaultdict(lambda: defaultdict(float))
+    position = None
+
+    def go(position_to):
+        nonlocal position
+        if position is not None and position != position_to:
+            travel = deck.travel(position, position_to)
+            dx = abs(position_to[0] - position[0])
+            dy = abs(position_to[1] - position[1])
+            seconds["travel"] += (
+                max(dx / speeds["X"], dy / speeds["Y"])
+                + travel["z"] / speeds["Z"]
+                + timings["move_overhead"]
+            )
+        position = position_to
+
+    def plunger(volume, category):
+        seconds[category] += volume / flow_rate + timings["plunger_overhead"]
+
+    if "tips" in plan:
+        new_tips = plan["tips"]["new_tip"]
+    else:
+        new_tips = get_new_tips(plan["aspirations"], plan["sources"], config)
+    tiprack_slots = {
+        mount: get_tiprack_slots(settings)
+        for mount, settings in pipettes.items()
+    }
+    # Tip racks shared with earlier protocols start part way.
+    next_tip = {
+        mount: settings.get("starting_tip", 0)
+        for mount, settings in pipettes.items()
+    }
+    tips_used = defaultdict(int)
+    has_tip = set()
+    swelled = {}
+    seconds["setup"] = timings["setup"]
+    for (substance, targets), sources, new_tip in zip(
+        plan["aspirations"], plan["sources"], new_tips
+    ):
+        mount = targets[0][0]["mount"]
+        settings = pipettes[mount]
+        channels = settings.get("channels", 1)
+        flow_rate = (
+            settings["flow_rate"] or default_flow_rates[settings["pipette"]]
+        )
+        if new_tip or mount not in has_tip:
+            if mount in has_tip:
+                go(trash_position)
+                seconds["tips"] += timings["drop_tip"]
+            slots = tiprack_slots[mount]
+            rack = min(next_tip[mount] // tips_per_rack, len(slots) - 1)
+            slot = slots[rack]
+            go(
+                deck.well_position(
+                    slot,
+                    deck.wells(slot)[next_tip[mount] % tips_per_rack],
+                )
+            )
+            seconds["tips"] += timings["pick_up_tip"]
+            next_tip[mount] += channels
+            tips_used[slot] += channels
+            counts["tips"] += channels
+            has_tip.add(mount)
+            swelled.pop(mount, None)
+        source_wells = []
+        for (draw_substance, amount), well in zip(get_draws(targets), sources):
+            if well is None:
+                continue
+            consumption[draw_substance][f"{well[0]}:{well[1]}"] += amount
+            source_wells.append(well)
+        if not source_wells:
+            continue
+        amount = sum(i for _, i in targets)
+        go(deck.well_position(*source_wells[0]))
+        if swelled.get(mount) != substance:
+            plunger(settings["swell_volume"], "swell")
+            seconds["swell"] += settings["swell_delay"]
+            plunger(settings["swell_volume"], "swell")
+            counts["swells"] += 1
+            swelled[mount] = substance
+        plunger(amount, "aspirate")
+        counts["aspirations"] += 1
+        if settings["air_gap"]:
+            plunger(settings["air_gap"], "air_gap")
+            counts["air_gaps"] += 1
+        for i, (move, volume) in enumerate(targets):
+            go(deck.well_position(move["plate"], move["location"]))
+            plunger(volume + settings["air_gap"], "dispense")
+            counts["dispenses"] += 1
+            if settings["air_gap"] and i < len(targets) - 1:
+                plunger(settings["air_gap"], "air_gap")
+                counts["air_gaps"] += 1
+        if settings["blow_out"]:
+            seconds["blow_out"] += timings["blow_out"]
+            counts["blow_outs"] += 1
+
+    return {
+        "moves": len(moves),
+        "counts": dict(counts),
+        "tips_per_rack": {
+            f"slot_{slot}": tips for slot, tips in tips_used.items()
+        },
+        "tips_short": sum(
+            max(0, tips - tips_per_rack * len(tiprack_slots[mount]))
+            for mount, tips in next_tip.items()
+        ),
+        "consumption": {
+            substance: {
+                "total": sum(wells.values()),
+                "wells": dict(wells),
+            }
+            for substance, wells in consumption.items()
+        },
+        "shortfalls": plan["shortfalls"],
+        "seconds": dict(seconds),
+        "total_s": sum(seconds.values()),
+    }
+
+
+def estimate_protocol(protocol_dir, protocol=None):
+    """
+    Returns the estimate of a protocol directory.
+
+    Parameters
+    ----------
+    protocol_dir : str
+        The directory holding `move_commands.json` and
+        `substance_locations.json`.
+
+    protocol : str, optional
+        The name of the protocol settings to use. Defaults to the name
+        of the directory.
+
+    Returns
+    -------
+    estimate : dict
+        The estimate, as made by `estimate`.
+    """
+    compiled = compile_protocol(protocol_dir, protocol, check=False)
+    return estimate(
+        compiled["moves"],
+        compiled["deck_info"],
+        get_run_config(
+            load_config(protocol_dir, compiled["protocol"]), compiled
+        ),
+        plan=compiled,
+    )
+
+
+def main(args):
+    estimates = {}
+    for protocol_dir in args.i:
+        start = time.perf_counter()
+        estimates[protocol_dir] = estimate_protocol(
+            protocol_dir, args.protocol
+        )
+        estimates[protocol_dir]["estimator_ms"] = (
+            1000 * (time.perf_counter() - start)
+        )
+    ranked = sorted(estimates, key=lambda i: estimates[i]["total_s"])
+    print(
+        f"{'protocol':<40}{'time (min)':>12}{'tips':>8}"
+        f"{'aspirations':>13}{'shortfalls':>12}"
+    )
+    for protocol_dir in ranked:
+        result = estimates[protocol_dir]
+        print(
+            f"{protocol_dir:<40}{result['total_s'] / 60:>12.1f}"
+            f"{result['counts'].get('tips', 0):>8}"
+            f"{result['counts'].get('aspirations', 0):>13}"
+            f"{len(result['shortfalls']):>12}"
+        )
+    if args.o is not None:
+        with open(args.o, "w") as f:
+            json.dump(estimates, f, indent=4)
+    return estimates
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=(
+            "Estimates the duration, tips and volumes of Opentrons "
+            "protocols without simulating them."
+        )
+    )
+    parser.add_argument(
+        "-i", help="Paths to the protocol directories.", nargs="+",
+        required=True,
+    )
+    parser.add_argument(
+        "-protocol",
+        help=(
+            "Name of the protocol settings to use. Defaults to the name of "
+            "each protocol directory."
+        ),
+        choices=list(protocols),
+        default=None,
+    )
+    parser.add_argument("-o", help="Path to a JSON file of the estimates.")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,252 @@
+import argparse
+import json
+from collections import defaultdict
+from pathlib import Path
+
+from deck_geometry import get_sources
+from multichannel import group_columns
+from protocol_config import (
+    expand_moves,
+    get_aspirations,
+    get_draws,
+    get_pipettes,
+    load_config,
+    load_protocol,
+    protocols,
+)
+
+
+def get_draw_list(aspirations, config):
+    """
+    Returns every draw from a source well, in the order they are made.
+
+    Parameters
+    ----------
+    aspirations : list of tuple
+        The aspirations, as made by `protocol_config.get_aspirations`.
+
+    config : dict
+        The settings of the protocol.
+
+    Returns
+    -------
+    draws : list of dict
+        The aspiration and channel of each draw, its substance and
+        amount, the `minimum_volume` of the pipette making it, and the
+        source well it is pinned to, if any.
+    """
+    pipettes = get_pipettes(config)
+    draws = []
+    for index, (_, targets) in enumerate(aspirations):
+        move = targets[0][0]
+        # Multi-channel moves must use the wells under their nozzles.
+        pinned = move.get("sources", [None] * len(move.get("channels", [0])))
+        for channel, (substance, amount) in enumerate(get_draws(targets)):
+            draws.append(
+                {
+                    "aspiration": index,
+                    "channel": channel,
+                    "substance": substance,
+                    "amount": amount,
+                    "minimum_volume": (
+                        pipettes[move["mount"]]["minimum_volume"]
+                    ),
+                    "pinned": pinned[channel],
+                }
+            )
+    return draws
+
+
+def get_run(remaining, draws):
+    """
+    Returns the number of consecutive draws a well can supply.
+    """
+    run = 0
+    for draw in draws:
+        if draw["amount"] > remaining - draw["minimum_volume"]:
+            break
+        remaining -= draw["amount"]
+        run += 1
+    return run
+
+
+def assign_substance(draws, wells):
+    """
+    Assigns a source well to each draw of one substance.
+
+    Notes
+    -----
+    The current well is kept while it can supply the next draw. When it
+    cannot, the well which can supply the longest run of the following
+    draws is used, breaking ties by the smallest remaining volume, so
+    full wells are kept for later. Draws pinned to a well use it.
+
+    Parameters
+    ----------
+    draws : list of dict
+        The draws of the substance, in order, as made by `get_draw_list`.
+
+    wells : list of dict
+        The source wells of the substance, as made by
+        `deck_geometry.get_sources`. Their amounts are updated.
+
+    Returns
+    -------
+    assignments : list of dict
+        The source well of each draw, or None if no well can supply it.
+    """
+    assignments = []
+    current = None
+    for i, draw in enumerate(draws):
+        if draw["pinned"] is not None:
+            well = next(
+                (
+                    j for j in wells
+                    if (j["slot"], j["well"]) == tuple(draw["pinned"])
+                ),
+                None,
+            )
+            if well is not None and get_run(well["amount"], [draw]) == 0:
+                well = None
+        elif current is not None and get_run(current["amount"], [draw]):
+            well = current
+        else:
+            runs = [get_run(j["amount"], draws[i:]) for j in wells]
+            best = max(
+                range(len(wells)),
+                key=lambda k: (runs[k], -wells[k]["amount"], -k),
+                default=None,
+            )
+            well = wells[best] if best is not None and runs[best] else None
+        if well is not None:
+            well["amount"] -= draw["amount"]
+            current = well
+        assignments.append(well)
+    return assignments
+
+
+def plan_inventory(moves, deck_info, config, check=True):
+    """
+    Assigns a source well to every draw of a protocol before it is run.
+
+    Parameters
+    ----------
+    moves : list of dict
+        The moves, as made by `move_planner.expand_moves`.
+
+    deck_info : dict
+        The contents of `substance_locations.json`.
+
+    config : dict
+        The settings of the protocol.
+
+    check : bool
+        Toggles raising an error if the deck cannot supply every draw.
+
+    Returns
+    -------
+    plan : dict
+        The `aspirations` of the protocol, the source wells of the draws
+        of each aspiration as (slot, well), the number of well
+        `switches`, the wells opened, the volume left in them and the
+        volume of each substance which cannot be supplied.
+
+    Raises
+    ------
+    RuntimeError
+        If `check` and a draw cannot be supplied from any well without
+        going below the `minimum_volume` of its pipette.
+    """
+    aspirations = get_aspirations(
+        group_columns(moves, deck_info, config), config
+    )
+    draws = get_draw_list(aspirations, config)
+    sources = get_sources(deck_info)
+    by_substance = defaultdict(list)
+    for draw in draws:
+        by_substance[draw["substance"]].append(draw)
+
+    sources_used = [[] for _ in aspirations]
+    shortfalls = defaultdict(float)
+    switches = 0
+    opened = {}
+    for substance, substance_draws in by_substance.items():
+        wells = sources[substance]
+        previous = None
+        assignments = assign_substance(substance_draws, wells)
+        for draw, well in zip(substance_draws, assignments):
+            if well is None:
+                shortfalls[substance] += draw["amount"]
+                source = None
+            else:
+                source = (well["slot"], well["well"])
+                opened[source] = well
+                if previous is not None and source != previous:
+                    switches += 1
+                previous = source
+            sources_used[draw["aspiration"]].append(source)
+
+    if check and shortfalls:
+        raise RuntimeError(
+            "The deck cannot supply the protocol. Missing volumes (uL): "
+            + ", ".join(f"{i}: {j:g}" for i, j in shortfalls.items())
+        )
+    return {
+        "aspirations": aspirations,
+        "sources": sources_used,
+        "switches": switches,
+        "wells_opened": len(opened),
+        "left_in_opened_wells": sum(i["amount"] for i in opened.values()),
+        "remaining": {
+            f"{slot}:{well}": source["amount"]
+            for (slot, well), source in opened.items()
+        },
+        "shortfalls": dict(shortfalls),
+    }
+
+
+def main(args):
+    protocol_dir = Path(args.i)
+    config = load_config(protocol_dir, args.protocol)
+    move_info, deck_info = load_protocol(protocol_dir)
+    plan = plan_inventory(
+        expand_moves(move_info), deck_info, config, check=False
+    )
+    report = {
+        key: value
+        for key, value in plan.items()
+        if key not in ("aspirations", "sources")
+    }
+    for key, value in report.items():
+        if key != "remaining":
+            print(f"{key:>22}: {value}")
+    if args.o is not None:
+        with open(args.o, "w") as f:
+            json.dump(report, f, indent=4)
+    if plan["shortfalls"]:
+        raise RuntimeError("The deck cannot supply the protocol.")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=(
+            "Checks that the deck of an Opentrons protocol can supply "
+            "every move, and assigns the source wells."
+        )
+    )
+    parser.add_argument(
+        "-i", help="Path to the protocol directory.", required=True,
+    )
+    parser.add_argument(
+        "-protocol",
+        help=(
+            "Name of the protocol settings to use. Defaults to the name of "
+            "the protocol directory."
+        ),
+        choices=list(protocols),
+        default=None,
+    )
+    parser.add_argument("-o", help="Path to a JSON report of the plan.")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,298 @@
+from protocol_config import get_draws, get_pipettes
+
+# Default aspirate and dispense flow rates of the pipettes in uL/s.
+default_flow_rates = {
+    "p20_single_gen2": 3.78,
+    "p300_single_gen2": 46.43,
+    "p1000_single_gen2": 137.35,
+    "p20_multi_gen2": 7.6,
+    "p300_multi_gen2": 94.0,
+}
+
+# Settings validated for each solvent, by pipette. Each profile was run
+# around the deck without dripping, with its flow rate in uL/s (None for
+# the default), swelling, air gap and highest gantry speed in mm/s (None
+# for the default). A solvent is found by its `aliases` as a substance
+# name, or by the `solvent` of its labware in `substance_locations.json`.
+liquid_classes = {
+    "chloroform": {
+        "aliases": ["Chloroform", "CDCl3", "CHCl3"],
+        "pipettes": {
+            "p300_single_gen2": [
+                # NMR_transfer
+                {
+                    "flow_rate": 60,
+                    "swell_volume": 100,
+                    "swell_delay": 5,
+                    "air_gap": 15,
+                    "blow_out": False,
+                    "max_speed": 250,
+                },
+                # Plate_example
+                {
+                    "flow_rate": 70,
+                    "swell_volume": 100,
+                    "swell_delay": 10,
+                    "air_gap": 15,
+                    "blow_out": False,
+                    "max_speed": 250,
+                },
+            ],
+            "p20_single_gen2": [
+                # HRMS_transfer
+                {
+                    "flow_rate": None,
+                    "swell_volume": 3,
+                    "swell_delay": 1,
+                    "air_gap": 0,
+                    "blow_out": False,
+                    "max_speed": None,
+                },
+            ],
+        },
+    },
+    "dcm_meoh": {
+        "aliases": ["DCMMeOH", "MeOHDCM", "DCM:MeOH", "MeOH:DCM"],
+        "pipettes": {
+            "p300_single_gen2": [
+                # solvent_topup_MeOHDCM
+                {
+                    "flow_rate": None,
+                    "swell_volume": 100,
+                    "swell_delay": 10,
+                    "air_gap": 15,
+                    "blow_out": True,
+                    "max_speed": 250,
+                },
+            ],
+        },
+    },
+    # The benchmark settings of the README, with the swelling used for
+    # chloroform.
+    "acetonitrile": {
+        "aliases": ["Acetonitrile", "MeCN", "ACN"],
+        "pipettes": {
+            "p300_single_gen2": [
+                {
+                    "flow_rate": 40,
+                    "swell_volume": 100,
+                    "swell_delay": 10,
+                    "air_gap": 15,
+                    "blow_out": False,
+                    "max_speed": 100,
+                },
+            ],
+            "p20_single_gen2": [
+                {
+                    "flow_rate": 3.86,
+                    "swell_volume": 3,
+                    "swell_delay": 1,
+                    "air_gap": 0,
+                    "blow_out": False,
+                    "max_speed": 100,
+                },
+            ],
+        },
+    },
+    "dmso": {
+        "aliases": ["DMSO"],
+        "pipettes": {
+            "p300_single_gen2": [
+                {
+                    "flow_rate": 40,
+                    "swell_volume": 100,
+                    "swell_delay": 10,
+                    "air_gap": 15,
+                    "blow_out": False,
+                    "max_speed": 100,
+                },
+            ],
+            "p20_single_gen2": [
+                {
+                    "flow_rate": 3.86,
+                    "swell_volume": 3,
+                    "swell_delay": 1,
+                    "air_gap": 0,
+                    "blow_out": False,
+                    "max_speed": 100,
+                },
+            ],
+        },
+    },
+}
+
+
+def find_solvent(name):
+    """
+    Returns the liquid class of a solvent or substance name, or None if
+    it is not known.
+    """
+    for solvent, liquid_class in liquid_classes.items():
+        names = [solvent] + liquid_class["aliases"]
+        if name.lower() in (i.lower() for i in names):
+            return solvent
+    return None
+
+
+def get_solvents(deck_info):
+    """
+    Returns the liquid class of each substance on the deck.
+
+    The `solvent` of the labware is used if given, otherwise the name
+    of the substance itself. Substances of unknown solvent are None.
+    """
+    solvents = {}
+    for labware in deck_info.values():
+        for well, substance in labware.items():
+            if well in ("name", "type", "solvent"):
+                continue
+            name = labware.get("solvent", substance["substance"])
+            solvents[substance["substance"]] = find_solvent(name)
+    return solvents
+
+
+def get_profile_cost(profile, pipette, swells, volume):
+    """
+    Returns the plunger and swelling time of a profile in s.
+
+    Parameters
+    ----------
+    profile : dict
+        The settings of the liquid class.
+
+    pipette : str
+        The pipette model.
+
+    swells : int
+        The number of times the tip is swelled.
+
+    volume : float
+        The volume moved in uL, including air gaps.
+    """
+    flow_rate = profile["flow_rate"] or default_flow_rates[pipette]
+    swell = 2 * profile["swell_volume"] / flow_rate + profile["swell_delay"]
+    return swells * swell + 2 * volume / flow_rate
+
+
+def combine_profiles(profiles, pipette):
+    """
+    Returns settings safe for every profile, for a pipette moving
+    several solvents.
+    """
+    if len(profiles) == 1:
+        return dict(profiles[0])
+    slowest = min(
+        profiles, key=lambda i: i["flow_rate"] or default_flow_rates[pipette]
+    )
+    speeds = [i["max_speed"] for i in profiles if i["max_speed"] is not None]
+    return {
+        "flow_rate": slowest["flow_rate"],
+        "swell_volume": max(i["swell_volume"] for i in profiles),
+        "swell_delay": max(i["swell_delay"] for i in profiles),
+        "air_gap": max(i["air_gap"] for i in profiles),
+        "blow_out": any(i["blow_out"] for i in profiles),
+        "max_speed": min(speeds, default=None),
+    }
+
+
+def choose_liquid_classes(aspirations, deck_info, config):
+    """
+    Chooses the validated settings of each pipette for the solvents it
+    moves.
+
+    Notes
+    -----
+    For each solvent, the profile with the least plunger and swelling
+    time for the aspirations of the pipette is used. A pipette moving
+    several solvents uses the slowest settings of their profiles. A
+    pipette moving a substance of unknown solvent, or with no profile
+    for the solvent, keeps the settings of the protocol, as do all the
+    pipettes of a protocol with `"liquid_classes": False`.
+
+    Parameters
+    ----------
+    aspirations : list of tuple
+        The aspirations, as made by `protocol_config.get_aspirations`.
+
+    deck_info : dict
+        The contents of `substance_locations.json`.
+
+    config : dict
+        The settings of the protocol.
+
+    Returns
+    -------
+    chosen : dict
+        The `solvents` and the `settings` to use for each mount with a
+        liquid class.
+    """
+    if not config.get("liquid_classes", True):
+        return {}
+    pipettes = get_pipettes(config)
+    solvents = get_solvents(deck_info)
+    used = {mount: set() for mount in pipettes}
+    swells = {mount: 0 for mount in pipettes}
+    volumes = {mount: 0.0 for mount in pipettes}
+    current = {}
+    for substance, targets in aspirations:
+        mount = targets[0][0]["mount"]
+        used[mount].update(solvents.get(i) for i, _ in get_draws(targets))
+        if current.get(mount) != substance:
+            swells[mount] += 1
+            current[mount] = substance
+        air_gap = pipettes[mount]["air_gap"]
+        volumes[mount] += sum(amount + air_gap for _, amount in targets)
+
+    chosen = {}
+    for mount, mount_solvents in used.items():
+        model = pipettes[mount]["pipette"]
+        if not mount_solvents or None in mount_solvents or any(
+            model not in liquid_classes[i]["pipettes"] for i in mount_solvents
+        ):
+            continue
+        profiles = [
+            min(
+                liquid_classes[i]["pipettes"][model],
+                key=lambda j: (
+                    get_profile_cost(j, model, swells[mount], volumes[mount]),
+                    -(j["max_speed"] or float("inf")),
+                ),
+            )
+            for i in sorted(mount_solvents)
+        ]
+        chosen[mount] = {
+            "solvents": sorted(mount_solvents),
+            "settings": combine_profiles(profiles, model),
+        }
+    return chosen
+
+
+def apply_liquid_classes(config, chosen):
+    """
+    Returns the settings of a protocol with the liquid classes chosen by
+    `choose_liquid_classes`.
+
+    The gantry speed is the lowest of the pipettes, as it is shared.
+    """
+    if not chosen:
+        return config
+    config = dict(config)
+    speeds = []
+    if "pipettes" in config:
+        config["pipettes"] = {
+            mount: dict(settings)
+            for mount, settings in config["pipettes"].items()
+        }
+    for mount in get_pipettes(config):
+        if mount not in chosen:
+            speeds.append(config["max_speed"])
+            continue
+        settings = dict(chosen[mount]["settings"])
+        speeds.append(settings.pop("max_speed"))
+        if "pipettes" in config:
+            config["pipettes"][mount].update(settings)
+        else:
+            config.update(settings)
+    speeds = [i for i in speeds if i is not None]
+    config["max_speed"] = min(speeds, default=None)
+    return config
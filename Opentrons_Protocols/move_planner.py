@@ -0,0 +1,387 @@
+import argparse
+import heapq
+import json
+import math
+from collections import Counter, defaultdict
+from pathlib import Path
+
+from deck_geometry import get_deck, get_sources, trash_position
+from inventory import plan_inventory
+from protocol_config import (
+    expand_moves,
+    get_pipettes,
+    get_tiprack_slots,
+    load_config,
+    load_protocol,
+    protocols,
+)
+from tip_planning import apply_tip_plan, plan_tips, tips_per_rack
+
+
+def plan_metrics(moves, deck_info, config):
+    """
+    Returns the tips, swells, aspirations and travel of a move plan.
+
+    Notes
+    -----
+    The pipettes are followed as `run()` would move them: a pipette
+    picks up a new tip where `tip_planning.plan_tips` plans one, from
+    the tip racks it plans, each new tip is swelled in the source
+    before its first transfer, and every
+    aspiration goes from its source well, as assigned by
+    `inventory.plan_inventory`, to its target wells. Column-aligned
+    moves are made by the multi-channel pipette, if the protocol has
+    one.
+
+    Parameters
+    ----------
+    moves : list of dict
+        The moves, as made by `expand_moves`.
+
+    deck_info : dict
+        The contents of `substance_locations.json`.
+
+    config : dict
+        The settings of the protocol.
+
+    Returns
+    -------
+    metrics : dict
+        The number of tips, swells, aspirations and source well switches,
+        and the horizontal and vertical travel in mm.
+
+    Raises
+    ------
+    RuntimeError
+        If the deck cannot supply the plan.
+    """
+    plan = plan_inventory(moves, deck_info, config)
+    tip_plan = plan_tips(
+        plan["aspirations"], plan["sources"], deck_info, config
+    )
+    config = apply_tip_plan(config, tip_plan)
+    deck = get_deck(deck_info, config)
+    pipettes = get_pipettes(config)
+    metrics = {
+        "moves": len(moves),
+        "tips": 0,
+        "swells": 0,
+        "aspirations": 0,
+        "source_switches": plan["switches"],
+        "travel_xy_mm": 0.0,
+        "travel_z_mm": 0.0,
+    }
+    position = None
+
+    def go(position_to):
+        nonlocal position
+        if position is not None:
+            travel = deck.travel(position, position_to)
+            metrics["travel_xy_mm"] += travel["xy"]
+            metrics["travel_z_mm"] += travel["z"]
+        position = position_to
+
+    # Tip racks shared with earlier protocols start part way.
+    next_tip = {
+        mount: settings.get("starting_tip", 0)
+        for mount, settings in pipettes.items()
+    }
+    has_tip = set()
+    swelled = {}
+    for (substance, targets), sources, new_tip in zip(
+        plan["aspirations"], plan["sources"], tip_plan["new_tip"]
+    ):
+        mount = targets[0][0]["mount"]
+        settings = pipettes[mount]
+        channels = settings.get("channels", 1)
+        if new_tip or mount not in has_tip:
+            if mount in has_tip:
+                go(trash_position)
+            slots = get_tiprack_slots(settings)
+            slot = slots[min(next_tip[mount] // tips_per_rack, len(slots) - 1)]
+            go(
+                deck.well_position(
+                    slot, deck.wells(slot)[next_tip[mount] % tips_per_rack]
+                )
+            )
+            next_tip[mount] += channels
+            metrics["tips"] += channels
+            has_tip.add(mount)
+            swelled.pop(mount, None)
+        source = deck.well_position(*sources[0])
+        if swelled.get(mount) != substance:
+            go(source)
+            metrics["swells"] += 1
+            swelled[mount] = substance
+        go(source)
+        for move, _ in targets:
+            go(deck.well_position(move["plate"], move["location"]))
+        metrics["aspirations"] += 1
+    return metrics
+
+
+def get_well_orders(moves):
+    """
+    Returns the order substances are added to each target well, with
+    repeated additions of one substance merged.
+    """
+    orders = defaultdict(list)
+    for move in moves:
+        order = orders[(move["plate"], move["location"])]
+        if not order or order[-1] != move["substance"]:
+            order.append(move["substance"])
+    return orders
+
+
+def get_substance_order(moves, preserve_well_order=True):
+    """
+    Returns the order the substances are moved in after regrouping.
+
+    Substances keep the order they first appear in. If
+    `preserve_well_order`, a substance is never moved before one added
+    earlier to the same well.
+    """
+    first = {}
+    for move in moves:
+        first.setdefault(move["substance"], len(first))
+    after = defaultdict(set)
+    before = Counter()
+    if preserve_well_order:
+        for order in get_well_orders(moves).values():
+            for a, b in zip(order, order[1:]):
+                if b not in after[a]:
+                    after[a].add(b)
+                    before[b] += 1
+    ready = [(index, i) for i, index in first.items() if before[i] == 0]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        _, substance = heapq.heappop(ready)
+        order.append(substance)
+        for i in after[substance]:
+            before[i] -= 1
+            if before[i] == 0:
+                heapq.heappush(ready, (first[i], i))
+    if len(order) != len(first):
+        raise ValueError(
+            "Wells receive substances in conflicting orders, so the moves "
+            "cannot be grouped by substance without changing the order of "
+            "additions. Use -ignore_well_order to group them anyway."
+        )
+    return order
+
+
+def order_by_travel(moves, deck, start):
+    """
+    Returns moves ordered by nearest neighbour, starting from the target
+    well nearest `start`.
+    """
+    moves = list(moves)
+    ordered = []
+    position = start
+    while moves:
+        nearest = min(
+            range(len(moves)),
+            key=lambda i: math.dist(
+                position[:2],
+                deck.well_position(
+                    moves[i]["plate"], moves[i]["location"]
+                )[:2],
+            ),
+        )
+        move = moves.pop(nearest)
+        position = deck.well_position(move["plate"], move["location"])
+        ordered.append(move)
+    return ordered
+
+
+def optimise_moves(moves, deck_info, config, preserve_well_order=True):
+    """
+    Returns the moves regrouped by substance, with the targets of each
+    substance ordered by travel distance.
+
+    Notes
+    -----
+    The moves are grouped by substance, keeping the order of the groups
+    and of the targets within them, and then also with the targets of
+    each group ordered by nearest neighbour from the first source well.
+    Of these and the original order, the plan using the fewest tips and
+    then the least travel is returned, so the plan never gets worse.
+
+    Parameters
+    ----------
+    moves : list of dict
+        The moves, as made by `expand_moves`.
+
+    deck_info : dict
+        The contents of `substance_locations.json`.
+
+    config : dict
+        The settings of the protocol.
+
+    preserve_well_order : bool
+        Toggles keeping the order substances are added to each well.
+
+    Returns
+    -------
+    moves : list of dict
+        The reordered moves.
+    """
+    deck = get_deck(deck_info, config)
+    sources = get_sources(deck_info)
+    groups = defaultdict(list)
+    for move in moves:
+        groups[move["substance"]].append(move)
+    order = get_substance_order(moves, preserve_well_order)
+
+    grouped = [move for substance in order for move in groups[substance]]
+    nearest = []
+    for substance in order:
+        source = sources.get(substance)
+        if source:
+            start = deck.well_position(source[0]["slot"], source[0]["well"])
+        else:
+            first = groups[substance][0]
+            start = deck.well_position(first["plate"], first["location"])
+        nearest.extend(order_by_travel(groups[substance], deck, start))
+
+    def cost(plan):
+        metrics = plan_metrics(plan, deck_info, config)
+        return (
+            metrics["tips"],
+            metrics["travel_xy_mm"] + metrics["travel_z_mm"],
+        )
+
+    return min((moves, grouped, nearest), key=cost)
+
+
+def is_equivalent(original, optimised, check_well_order=True):
+    """
+    Returns True if two move plans put the same volume of the same
+    substances in every well, with the same tip policies.
+
+    If `check_well_order`, the order substances are added to each well
+    must also be the same.
+    """
+
+    def key(move):
+        return (
+            move["substance"],
+            move["plate"],
+            move["location"],
+            move["amount"],
+            move.get("tip_policy"),
+        )
+
+    if Counter(map(key, original)) != Counter(map(key, optimised)):
+        return False
+    if check_well_order:
+        return get_well_orders(original) == get_well_orders(optimised)
+    return True
+
+
+def to_move_commands(moves):
+    """
+    Returns the contents of a `move_commands.json` for a list of moves.
+
+    Consecutive moves of one substance, amount, plate and tip policy
+    share an entry.
+    """
+    move_info = []
+    for move in moves:
+        if move_info and (
+            move_info[-1]["substance"] == move["substance"]
+            and move_info[-1]["amount"] == move["amount"]
+            and move_info[-1]["plate"] == str(move["plate"])
+            and move_info[-1].get("tip_policy") == move.get("tip_policy")
+        ):
+            move_info[-1]["location"].append(move["location"])
+            continue
+        entry = {
+            "substance": move["substance"],
+            "location": [move["location"]],
+            "amount": move["amount"],
+            "plate": str(move["plate"]),
+        }
+        if "tip_policy" in move:
+            entry["tip_policy"] = move["tip_policy"]
+        move_info.append(entry)
+    return move_info
+
+
+def main(args):
+    protocol_dir = Path(args.i)
+    config = load_config(protocol_dir, args.protocol)
+    move_info, deck_info = load_protocol(protocol_dir)
+    moves = expand_moves(move_info)
+    optimised = optimise_moves(
+        moves,
+        deck_info,
+        config,
+        preserve_well_order=not args.ignore_well_order,
+    )
+    if not is_equivalent(
+        moves, optimised, check_well_order=not args.ignore_well_order
+    ):
+        raise RuntimeError("The optimised plan is not equivalent.")
+
+    report = {
+        "original": plan_metrics(moves, deck_info, config),
+        "optimised": plan_metrics(optimised, deck_info, config),
+    }
+    print(f"{'':>18}{'original':>12}{'optimised':>12}")
+    for metric, value in report["original"].items():
+        print(
+            f"{metric:>18}{value:>12.0f}"
+            f"{report['optimised'][metric]:>12.0f}"
+        )
+
+    output = args.o or protocol_dir / "move_commands_optimised.json"
+    with open(output, "w") as f:
+        json.dump(to_move_commands(optimised), f, indent=4)
+    if args.report is not None:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=4)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=(
+            "Reorders the moves of an Opentrons protocol to use fewer tips "
+            "and less travel."
+        )
+    )
+    parser.add_argument(
+        "-i", help="Path to the protocol directory.", required=True,
+    )
+    parser.add_argument(
+        "-protocol",
+        help=(
+            "Name of the protocol settings to use. Defaults to the name of "
+            "the protocol directory."
+        ),
+        choices=list(protocols),
+        default=None,
+    )
+    parser.add_argument(
+        "-o",
+        help=(
+            "Path to the optimised move commands. Defaults to "
+            "move_commands_optimised.json in the protocol directory."
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "-report", help="Path to a JSON report of the plan metrics.",
+    )
+    parser.add_argument(
+        "-ignore_well_order",
+        help=(
+            "Allow the order substances are added to a well to change, "
+            "keeping only the volumes added."
+        ),
+        action="store_true",
+    )
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,187 @@
+import math
+
+from deck_geometry import get_deck, get_sources
+from protocol_config import get_chunks, get_pipettes, route_moves
+
+# Distance between the nozzles of a multi-channel pipette (mm).
+channel_pitch = 9.0
+
+
+def get_multichannel(config):
+    """
+    Returns the mount and settings of the multi-channel pipette of a
+    protocol, or None if it has none.
+    """
+    for mount, settings in get_pipettes(config).items():
+        if settings.get("channels", 1) > 1:
+            return mount, settings
+    return None
+
+
+def well_at(definition, x, y):
+    """
+    Returns the name of the well of a labware containing a point, or
+    None if the point is not over a well.
+    """
+    for name, well in definition["wells"].items():
+        if well["shape"] == "circular":
+            radius = well["diameter"] / 2
+            if math.hypot(x - well["x"], y - well["y"]) <= radius:
+                return name
+        elif (
+            abs(x - well["x"]) <= well["xDimension"] / 2
+            and abs(y - well["y"]) <= well["yDimension"] / 2
+        ):
+            return name
+    return None
+
+
+def get_channel_wells(deck, slot, well, channels):
+    """
+    Returns the wells under each nozzle of a multi-channel pipette.
+
+    Parameters
+    ----------
+    deck : deck_geometry.Deck
+        The deck of the protocol.
+
+    slot : int
+        The deck slot of the labware.
+
+    well : str
+        The well under the first, back-most, nozzle.
+
+    channels : int
+        The number of nozzles.
+
+    Returns
+    -------
+    wells : list of str
+        The well under each nozzle, from back to front. A well is
+        repeated if several nozzles reach into it, as in a reservoir.
+        None if a nozzle is not over a well.
+    """
+    definition = deck.definitions[int(slot)]
+    first = definition["wells"][well]
+    wells = []
+    for channel in range(channels):
+        name = well_at(
+            definition, first["x"], first["y"] - channel_pitch * channel
+        )
+        if name is None:
+            return None
+        wells.append(name)
+    return wells
+
+
+def group_columns(moves, deck_info, config):
+    """
+    Returns the moves with column-aligned runs made by the multi-channel
+    pipette.
+
+    Notes
+    -----
+    A run of consecutive moves is made as one multi-channel move if
+    there is one move for each nozzle, all of the same amount to the same
+    plate, and the nozzles line up with both the target wells and the
+    current source well of each substance, in the order of the moves.
+    The sources must hold enough above the `minimum_volume` of the
+    multi-channel pipette. Other moves are left to the single-channel
+    pipettes. Sources are followed as the engine uses them, so wells
+    retired by single-channel moves are not used by later columns.
+
+    Parameters
+    ----------
+    moves : list of dict
+        The moves, with one target well each.
+
+    deck_info : dict
+        The contents of `substance_locations.json`.
+
+    config : dict
+        The settings of the protocol.
+
+    Returns
+    -------
+    moves : list of dict
+        The moves, where each multi-channel move has the `mount` of the
+        multi-channel pipette, the target well of its first nozzle, the
+        single-channel moves it replaces as `channels` and the source
+        well of each nozzle as `sources`.
+    """
+    multichannel = get_multichannel(config)
+    if multichannel is None:
+        return list(moves)
+    mount, settings = multichannel
+    channels = settings["channels"]
+    deck = get_deck(deck_info, config)
+    sources = get_sources(deck_info)
+    pipettes = get_pipettes(config)
+
+    def get_column_move(group):
+        if len(group) < channels or any("mount" in i for i in group):
+            return None
+        first = group[0]
+        if any(
+            i["amount"] != first["amount"] or i["plate"] != first["plate"]
+            for i in group
+        ) or first["amount"] < settings.get("min_volume", 0):
+            return None
+        targets = get_channel_wells(
+            deck, first["plate"], first["location"], channels
+        )
+        if targets != [i["location"] for i in group]:
+            return None
+        wells = [sources[i["substance"]] for i in group]
+        if not all(wells):
+            return None
+        slot = wells[0][0]["slot"]
+        if any(i[0]["slot"] != slot for i in wells):
+            return None
+        source_wells = get_channel_wells(
+            deck, slot, wells[0][0]["well"], channels
+        )
+        if source_wells != [i[0]["well"] for i in wells]:
+            return None
+        # Nozzles sharing a reservoir draw from the same well.
+        drawn = {}
+        for well in wells:
+            source = well[0]
+            drawn[id(source)] = drawn.get(id(source), 0) + first["amount"]
+            if drawn[id(source)] > (
+                source["amount"] - settings["minimum_volume"]
+            ):
+                return None
+        for well in wells:
+            well[0]["amount"] -= first["amount"]
+        return {
+            "substance": "|".join(i["substance"] for i in group),
+            "location": first["location"],
+            "amount": first["amount"],
+            "plate": first["plate"],
+            "mount": mount,
+            "channels": group,
+            "sources": [(i[0]["slot"], i[0]["well"]) for i in wells],
+        }
+
+    grouped = []
+    i = 0
+    while i < len(moves):
+        column_move = get_column_move(moves[i:i + channels])
+        if column_move is not None:
+            grouped.append(column_move)
+            i += channels
+            continue
+        move = moves[i]
+        move_settings = pipettes[route_moves([move], config)[0]["mount"]]
+        wells = sources[move["substance"]]
+        for chunk in get_chunks(move["amount"], move_settings):
+            while wells and chunk > (
+                wells[0]["amount"] - move_settings["minimum_volume"]
+            ):
+                wells.pop(0)
+            if wells:
+                wells[0]["amount"] -= chunk
+        grouped.append(move)
+        i += 1
+    return grouped
@@ -0,0 +1,586 @@
+import argparse
+import json
+import math
+import re
+import time
+from collections import defaultdict
+from pathlib import Path
+
+from deck_geometry import load_definition, slot_origins
+from estimate_protocol import estimate
+from liquid_classes import find_solvent
+from protocol_compiler import compile_moves, get_run_config
+from protocol_config import (
+    get_labware,
+    protocols,
+    settings_name,
+    update_config,
+)
+from protocol_engine import robot_code_path
+
+here = Path(__file__).resolve().parent
+combination_map_path = (
+    here.parent / "precursor_combination_map_to_exp_data.json"
+)
+
+# A combination such as "A1" names its tri-topic precursor by the letter
+# and its di-topic precursor by the number, as in `precursors.json`.
+combination_pattern = re.compile(r"([A-Z])(\d+)")
+
+# Times the stocks are topped up for the volume they could not supply
+# before giving up.
+max_attempts = 10
+
+
+def get_precursors(combination):
+    """
+    Returns the tri-topic and di-topic precursor of a combination.
+    """
+    match = combination_pattern.fullmatch(combination)
+    if match is None:
+        raise ValueError(f"{combination} is not a precursor combination.")
+    tritopic, ditopic = match.groups()
+    return f"Tri{tritopic}", f"Di{ditopic}"
+
+
+def get_precursor_key(precursor):
+    """
+    Orders the tri-topic precursors before the di-topic ones, and each
+    by its letter or number.
+    """
+    if precursor.startswith("Tri"):
+        return 0, 0, precursor[len("Tri"):]
+    return 1, int(precursor[len("Di"):]), ""
+
+
+def get_combination_key(combination):
+    """
+    Orders combinations by tri-topic and then di-topic precursor.
+    """
+    return tuple(
+        get_precursor_key(i) for i in get_precursors(combination)
+    )
+
+
+def get_row_wells(load_name):
+    """
+    Returns the wells of a labware, along each row in turn.
+    """
+    ordering = load_definition(load_name)["ordering"]
+    return [
+        column[row]
+        for row in range(max(len(i) for i in ordering))
+        for column in ordering
+        if row < len(column)
+    ]
+
+
+def select_plates(description, combinations=None, combination_map=None):
+    """
+    Returns the combinations of each reaction plate and their wells.
+
+    Notes
+    -----
+    Given `combinations`, or the `combinations` of the description,
+    they are ordered by precursor and packed along the rows of as few
+    reaction plates as hold them. Otherwise the combinations of the
+    `experiment_code`, and `plate_number` if given, of the description
+    are taken from the combination map, with the well of each given
+    by its formulation number along the rows.
+
+    Parameters
+    ----------
+    description : dict
+        The screen description.
+
+    combinations : list of str, optional
+        The combinations to plate, such as "A1".
+
+    combination_map : dict, optional
+        The contents of `precursor_combination_map_to_exp_data.json`.
+
+    Returns
+    -------
+    plates : dict
+        The well of each combination, by plate name.
+
+    Raises
+    ------
+    ValueError
+        If a formulation number has no well in the reaction plate, or
+        two combinations share a well.
+    """
+    wells = get_row_wells(description["reaction_plate"])
+    combinations = combinations or description.get("combinations")
+    if combinations:
+        ordered = sorted(set(combinations), key=get_combination_key)
+        return {
+            f"plate_{i // len(wells) + 1:02d}": dict(
+                zip(ordered[i:i + len(wells)], wells)
+            )
+            for i in range(0, len(ordered), len(wells))
+        }
+
+    plates = defaultdict(dict)
+    for combination, data in combination_map.items():
+        if data["experiment_code"] != description["experiment_code"]:
+            continue
+        plate_number = description.get("plate_number")
+        if plate_number is not None and data["plate_number"] != plate_number:
+            continue
+        index = int(data["formulation_number"]) - 1
+        if index >= len(wells):
+            raise ValueError(
+                f"Formulation {data['formulation_number']} of {combination} "
+                f"has no well in {description['reaction_plate']}."
+            )
+        name = f"{data['experiment_code']}_{data['plate_number']}"
+        if wells[index] in plates[name].values():
+            raise ValueError(
+                f"Two combinations of {name} are in well {wells[index]}."
+            )
+        plates[name][combination] = wells[index]
+    if not plates:
+        raise ValueError("No combinations match the screen description.")
+    return {
+        name: {
+            i: plate[i] for i in sorted(plate, key=get_combination_key)
+        }
+        for name, plate in sorted(plates.items())
+    }
+
+
+def get_volume(description, precursor):
+    """
+    Returns the volume of the stock of a precursor added to each
+    reaction in uL.
+    """
+    volumes = description.get("precursor_volumes", {})
+    if precursor in volumes:
+        return volumes[precursor]
+    if precursor.startswith("Tri"):
+        return description["tritopic_volume"]
+    return description["ditopic_volume"]
+
+
+def build_moves(plate, description, config):
+    """
+    Returns the contents of `move_commands.json` for a reaction plate.
+
+    Each precursor is added to all of its wells by one move, and the
+    `solvent` then brings each reaction to the `reaction_volume` of the
+    description, if given.
+
+    Raises
+    ------
+    ValueError
+        If the precursors of a reaction exceed the `reaction_volume`.
+    """
+    locations = defaultdict(list)
+    added = defaultdict(int)
+    for combination, well in plate.items():
+        for precursor in get_precursors(combination):
+            locations[precursor].append(well)
+            added[well] += get_volume(description, precursor)
+    move_info = [
+        {
+            "substance": precursor,
+            "location": locations[precursor],
+            "amount": get_volume(description, precursor),
+            "plate": config["plate_slot"],
+        }
+        for precursor in sorted(locations, key=get_precursor_key)
+    ]
+    if "reaction_volume" not in description:
+        return move_info
+    solvent = defaultdict(list)
+    for well, volume in added.items():
+        amount = description["reaction_volume"] - volume
+        if amount < 0:
+            raise ValueError(
+                f"The precursors of well {well} exceed the reaction_volume."
+            )
+        if amount > 0:
+            solvent[amount].append(well)
+    move_info += [
+        {
+            "substance": description["solvent"],
+            "location": wells,
+            "amount": amount,
+            "plate": config["plate_slot"],
+        }
+        for amount, wells in solvent.items()
+    ]
+    return move_info
+
+
+def get_demand(move_info):
+    """
+    Returns the volume of each substance the moves take in uL.
+    """
+    demand = defaultdict(float)
+    for move in move_info:
+        demand[move["substance"]] += move["amount"] * len(move["location"])
+    return demand
+
+
+def get_slots(config, slots):
+    """
+    Returns the slots free for the stocks, nearest the reaction plate
+    first.
+    """
+    used = set(get_labware(config))
+    plate = slot_origins[config["plate_slot"]]
+    return sorted(
+        (i for i in slots if i not in used),
+        key=lambda i: (math.dist(slot_origins[i], plate), i),
+    )
+
+
+def place_stocks(wells_needed, description, free_slots):
+    """
+    Returns the contents of `substance_locations.json` for the stock
+    wells needed of each substance.
+
+    Notes
+    -----
+    The precursors fill stock plates along their rows, each in
+    consecutive wells so its source switches are in one place, and the
+    solvent fills the reservoir. Every well is filled to the
+    `stock_volume` or `reservoir_volume` of the description. The stock
+    plates take the free slots in turn, then the reservoir.
+
+    Raises
+    ------
+    ValueError
+        If the stocks need more slots than are free, so the deck would
+        have to be reloaded during the run.
+    """
+    free_slots = list(free_slots)
+    deck_info = {}
+    stock_wells = get_row_wells(description["stock_plate"])
+    labware = None
+    wells = []
+    solvent = description.get("solvent")
+    for substance in sorted(
+        (i for i in wells_needed if i != solvent), key=get_precursor_key
+    ):
+        for _ in range(wells_needed[substance]):
+            if not wells:
+                if not free_slots:
+                    raise ValueError(
+                        "The stocks need more deck slots than are free. Use "
+                        "a larger stock_volume or fewer combinations per "
+                        "plate."
+                    )
+                labware = {"name": "Stock", "type": description["stock_plate"]}
+                if solvent is not None and find_solvent(solvent) is not None:
+                    labware["solvent"] = find_solvent(solvent)
+                deck_info[str(free_slots.pop(0))] = labware
+                wells = list(stock_wells)
+            labware[wells.pop(0)] = {
+                "substance": substance,
+                "amount": description["stock_volume"],
+            }
+    if wells_needed.get(solvent):
+        reservoir_wells = get_row_wells(description["reservoir"])
+        if wells_needed[solvent] > len(reservoir_wells) or not free_slots:
+            raise ValueError(
+                "The reservoir is too small for the solvent. Use a larger "
+                "reservoir_volume or fewer combinations per plate."
+            )
+        deck_info[str(free_slots.pop(0))] = {
+            "name": "Solvent",
+            "type": description["reservoir"],
+            **{
+                well: {
+                    "substance": solvent,
+                    "amount": description["reservoir_volume"],
+                }
+                for well in reservoir_wells[:wells_needed[solvent]]
+            },
+        }
+    return deck_info
+
+
+def trim_stocks(deck_info, remaining, minimum_volume):
+    """
+    Returns the stocks with each opened well filled only with the
+    volume drawn from it and the `minimum_volume`, and the unopened
+    wells left out.
+    """
+    trimmed = {}
+    for slot, labware in deck_info.items():
+        trimmed[slot] = {}
+        for well, content in labware.items():
+            if well in ("name", "type", "solvent"):
+                trimmed[slot][well] = content
+                continue
+            key = f"{slot}:{well}"
+            if key not in remaining:
+                continue
+            used = content["amount"] - remaining[key]
+            trimmed[slot][well] = {
+                "substance": content["substance"],
+                "amount": min(
+                    content["amount"], math.ceil(used + minimum_volume)
+                ),
+            }
+    return {
+        slot: labware
+        for slot, labware in trimmed.items()
+        if set(labware) - {"name", "type", "solvent"}
+    }
+
+
+def plan_plate(plate, description, config, free_slots):
+    """
+    Plans the moves and stocks of one reaction plate.
+
+    Notes
+    -----
+    Each substance starts with the fewest full wells which hold the
+    volume it needs above the `minimum_volume`. The moves are compiled,
+    and a well is added to each substance the deck cannot supply until
+    it can. The stocks are then trimmed to the volume the compiled
+    plan draws from each well, and the plan is compiled again to check
+    the trimmed stocks.
+
+    Parameters
+    ----------
+    plate : dict
+        The well of each combination, from `select_plates`.
+
+    description : dict
+        The screen description.
+
+    config : dict
+        The settings of the protocol.
+
+    free_slots : list of int
+        The slots free for the stocks, in order of use.
+
+    Returns
+    -------
+    plan : dict
+        The `move_commands` and `substance_locations` of the plate, the
+        compiled plan and its estimate.
+
+    Raises
+    ------
+    RuntimeError
+        If the stocks cannot supply the moves, or the deck has no free
+        slots for the tip racks.
+    """
+    move_info = build_moves(plate, description, config)
+    minimum_volume = config["minimum_volume"]
+    wells_needed = {}
+    for substance, volume in get_demand(move_info).items():
+        if substance == description.get("solvent"):
+            usable = description["reservoir_volume"] - minimum_volume
+        else:
+            usable = description["stock_volume"] - minimum_volume
+        wells_needed[substance] = math.ceil(volume / usable)
+    for _ in range(max_attempts):
+        deck_info = place_stocks(wells_needed, description, free_slots)
+        compiled = compile_moves(move_info, deck_info, config)
+        if not compiled["shortfalls"]:
+            break
+        for substance in compiled["shortfalls"]:
+            wells_needed[substance] += 1
+    else:
+        raise RuntimeError(
+            "The stocks cannot supply the plate. Missing volumes (uL): "
+            f"{compiled['shortfalls']}"
+        )
+
+    trimmed = trim_stocks(deck_info, compiled["remaining"], minimum_volume)
+    trimmed_plan = compile_moves(move_info, trimmed, config)
+    # Trimming can change which wells are drawn from, so the full wells
+    # are kept if the trimmed ones fall short.
+    if not trimmed_plan["shortfalls"]:
+        deck_info, compiled = trimmed, trimmed_plan
+    if compiled["tips"]["racks_short"]:
+        raise RuntimeError(
+            f"The plate needs {compiled['tips']['racks_short']} more tip "
+            "racks than there are free deck slots."
+        )
+    result = estimate(
+        compiled["moves"],
+        deck_info,
+        get_run_config(config, compiled),
+        plan=compiled,
+    )
+    return {
+        "combinations": plate,
+        "move_commands": move_info,
+        "substance_locations": deck_info,
+        "switches": compiled["switches"],
+        "wells_opened": compiled["wells_opened"],
+        "estimate": result,
+    }
+
+
+def plan_screen(description, combinations=None, slots=range(1, 12)):
+    """
+    Plans the reaction plates of a screen.
+
+    Parameters
+    ----------
+    description : dict
+        The screen description.
+
+    combinations : list of str, optional
+        The combinations to plate, instead of those of the description.
+
+    slots : list of int
+        The deck slots which can hold stocks.
+
+    Returns
+    -------
+    plan : dict
+        The settings `overrides` of the protocol, and the plan of each
+        reaction plate from `plan_plate`.
+    """
+    combination_map = None
+    if not (combinations or description.get("combinations")):
+        path = description.get("combination_map", combination_map_path)
+        with open(path) as f:
+            combination_map = json.load(f)
+    plates = select_plates(description, combinations, combination_map)
+    protocol = description.get("protocol", "Plate_example")
+    overrides = {"plate": description["reaction_plate"]}
+    config = update_config(protocols[protocol], overrides)
+    free_slots = get_slots(config, slots)
+    return {
+        "protocol": protocol,
+        "overrides": overrides,
+        "plates": {
+            name: plan_plate(plate, description, config, free_slots)
+            for name, plate in plates.items()
+        },
+    }
+
+
+def write_screen(plan, output_dir, robot_dir):
+    """
+    Writes the files and script of each reaction plate of a plan to its
+    own directory, and a summary of the stocks to prepare.
+    """
+    output_dir = Path(output_dir)
+    with open(here / plan["protocol"] / "opentron_script.py") as f:
+        script = f.read()
+    summary = {"protocol": plan["protocol"], "plates": {}}
+    for name, plate in plan["plates"].items():
+        plate_dir = output_dir / name
+        plate_dir.mkdir(parents=True, exist_ok=True)
+        for file_name, content in (
+            ("move_commands.json", plate["move_commands"]),
+            ("substance_locations.json", plate["substance_locations"]),
+            (settings_name, plan["overrides"]),
+        ):
+            with open(plate_dir / file_name, "w") as f:
+                json.dump(content, f, indent=4)
+        with open(plate_dir / "opentron_script.py", "w") as f:
+            f.write(
+                script.replace(
+                    "protocol_dir = None",
+                    f'protocol_dir = "{Path(robot_dir) / name}"',
+                )
+            )
+        summary["plates"][name] = {
+            "combinations": plate["combinations"],
+            "stocks": [
+                {
+                    "slot": int(slot),
+                    "well": well,
+                    "substance": content["substance"],
+                    "amount": content["amount"],
+                }
+                for slot, labware in plate["substance_locations"].items()
+                for well, content in labware.items()
+                if well not in ("name", "type", "solvent")
+            ],
+            "switches": plate["switches"],
+            "wells_opened": plate["wells_opened"],
+            "tips": plate["estimate"]["counts"].get("tips", 0),
+            "time_s": plate["estimate"]["total_s"],
+        }
+    with open(output_dir / "plate_layout.json", "w") as f:
+        json.dump(summary, f, indent=4)
+    return summary
+
+
+def main(args):
+    with open(args.i) as f:
+        description = json.load(f)
+    start = time.perf_counter()
+    plan = plan_screen(description, args.combinations, args.slots)
+    output_dir = Path(args.o or Path(args.i).parent / "layout")
+    robot_dir = args.robot_dir or robot_code_path / output_dir.resolve().name
+    summary = write_screen(plan, output_dir, robot_dir)
+
+    print(
+        f"{'plate':<16}{'combinations':>14}{'stock wells':>13}"
+        f"{'switches':>10}{'tips':>6}{'time (min)':>12}"
+    )
+    for name, plate in summary["plates"].items():
+        print(
+            f"{name:<16}{len(plate['combinations']):>14}"
+            f"{len(plate['stocks']):>13}{plate['switches']:>10}"
+            f"{plate['tips']:>6}{plate['time_s'] / 60:>12.1f}"
+        )
+    for name, plate in summary["plates"].items():
+        print(f"Stocks of {name}:")
+        for stock in plate["stocks"]:
+            print(
+                f"{stock['slot']:>4}  {stock['well']:<4}"
+                f"{stock['substance']:<16}{stock['amount']:>8} uL"
+            )
+    print(f"Planned in {time.perf_counter() - start:.1f} s.")
+    return plan
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=(
+            "Packs precursor combinations onto reaction plates, places "
+            "their stocks and writes the protocol files of each plate."
+        )
+    )
+    parser.add_argument(
+        "-i", help="Path to the screen description.", required=True,
+    )
+    parser.add_argument(
+        "-combinations",
+        help=(
+            "Combinations to plate, such as A1. Defaults to those of the "
+            "screen description."
+        ),
+        nargs="+",
+        default=None,
+    )
+    parser.add_argument(
+        "-o",
+        help=(
+            "Directory to write the plate directories to. Defaults to "
+            "`layout` next to the screen description."
+        ),
+    )
+    parser.add_argument(
+        "-robot_dir",
+        help=(
+            "Directory the plate directories are copied to on the robot. "
+            "Defaults to the name of the output directory in "
+            "/root/Opentrons_Code."
+        ),
+    )
+    parser.add_argument(
+        "-slots",
+        help="Deck slots which can hold stocks.",
+        nargs="+",
+        type=int,
+        default=list(range(1, 12)),
+    )
+    args = parser.parse_args()
+    main(args)
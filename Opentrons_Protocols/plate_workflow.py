@@ -0,0 +1,537 @@
+import argparse
+import json
+import math
+from itertools import permutations
+from pathlib import Path
+
+from deck_geometry import load_definition
+from estimate_protocol import estimate
+from protocol_compiler import compile_moves, get_run_config
+from protocol_config import (
+    get_labware,
+    get_pipettes,
+    protocols,
+    settings_name,
+    update_config,
+)
+from protocol_engine import robot_code_path
+from tip_planning import tips_per_rack
+
+here = Path(__file__).resolve().parent
+
+# Stages of the HT screen, in order. Transfer stages move `volume` from
+# the samples of the `source` plate, holding `stock_volume`, to the
+# `target` plate. Top-up stages add `volume` of a `solvent` to each
+# sample of the `target` plate.
+stages = [
+    {
+        "protocol": "HRMS_transfer",
+        "source": "reaction_plate",
+        "stock_volume": "reaction_volume",
+        "target": "hrms_plate",
+        "volume": "hrms_volume",
+    },
+    {
+        "protocol": "solvent_topup_MeOHDCM",
+        "solvent": "DCMMeOH",
+        "target": "hrms_plate",
+        "volume": "meohdcm_volume",
+    },
+    {
+        "protocol": "solvent_topup_CDCl3",
+        "solvent": "Chloroform",
+        "target": "reaction_plate",
+        "volume": "cdcl3_volume",
+        # The reaction plate is taken off the deck to remove the solvent.
+        "solvent_removal": True,
+    },
+    {
+        "protocol": "NMR_transfer",
+        "source": "reaction_plate",
+        "stock_volume": "cdcl3_volume",
+        "target": "nmr_plate",
+        "volume": "nmr_volume",
+    },
+]
+
+# Labware of the plate description placed on the deck.
+roles = ("reaction_plate", "hrms_plate", "nmr_plate", "reservoir")
+
+# Rough durations of the manual steps in s.
+manual_timings = {
+    # Opening, calibrating and starting a protocol in the app.
+    "protocol_start": 60.0,
+    # Placing one labware on the deck.
+    "labware_placement": 20.0,
+}
+
+
+def get_wells(load_name):
+    """
+    Returns the wells of a labware, down each column in turn.
+    """
+    return [
+        well
+        for column in load_definition(load_name)["ordering"]
+        for well in column
+    ]
+
+
+def get_targets(description):
+    """
+    Returns the well of each sample in each plate of a description.
+    """
+    samples = description.get(
+        "samples", get_wells(description["reaction_plate"])
+    )
+    targets = {"reaction_plate": samples}
+    for role in ("hrms_plate", "nmr_plate"):
+        wells = description.get(
+            role.replace("plate", "wells"), get_wells(description[role])
+        )
+        if len(wells) < len(samples):
+            raise ValueError(f"The {role} has fewer wells than samples.")
+        targets[role] = wells[:len(samples)]
+    return targets
+
+
+def assign_reservoir(description, targets):
+    """
+    Returns the reservoir wells of the solvent of each top-up stage.
+
+    Each well is filled with the `reservoir_volume` of the description,
+    and can be used down to the `minimum_volume` of the stage.
+
+    Raises
+    ------
+    ValueError
+        If the solvents need more wells than the reservoir has.
+    """
+    wells = get_wells(description["reservoir"])
+    assigned = {}
+    for stage in stages:
+        if "solvent" not in stage:
+            continue
+        config = protocols[stage["protocol"]]
+        usable = description["reservoir_volume"] - config["minimum_volume"]
+        total = description[stage["volume"]] * len(targets[stage["target"]])
+        needed = math.ceil(total / usable)
+        if needed > len(wells):
+            raise ValueError(
+                "The reservoir is too small for the solvents. Use a larger "
+                "reservoir_volume or refill it between stages."
+            )
+        assigned[stage["protocol"]] = wells[:needed]
+        wells = wells[needed:]
+    return assigned
+
+
+def get_used_labware(stage):
+    """
+    Returns the labware used by a stage.
+    """
+    return {stage["target"], stage.get("source", "reservoir")}
+
+
+def build_stage(index, description, layout, racks, targets, reservoir):
+    """
+    Returns the move and substance information and the settings of a
+    stage on the shared deck.
+
+    Parameters
+    ----------
+    index : int
+        The index of the stage in `stages`.
+
+    description : dict
+        The plate description.
+
+    layout : dict
+        The deck slot of each labware of `roles`.
+
+    racks : dict
+        The deck slot of each tip rack, by load name.
+
+    targets : dict
+        The wells of the samples in each plate, from `get_targets`.
+
+    reservoir : dict
+        The reservoir wells of each top-up stage, from
+        `assign_reservoir`.
+
+    Returns
+    -------
+    move_info : list of dict
+        The contents of `move_commands.json`.
+
+    deck_info : dict
+        The contents of `substance_locations.json`.
+
+    overrides : dict
+        The contents of `protocol_settings.json`.
+    """
+    stage = stages[index]
+    target = stage["target"]
+    target_slot = layout[target]
+    volume = description[stage["volume"]]
+    if "solvent" in stage:
+        source = "reservoir"
+        deck_info = {
+            str(layout[source]): {
+                "name": "Solvent",
+                "type": description[source],
+                **{
+                    well: {
+                        "substance": stage["solvent"],
+                        "amount": description["reservoir_volume"],
+                    }
+                    for well in reservoir[stage["protocol"]]
+                },
+            }
+        }
+        move_info = [
+            {
+                "substance": stage["solvent"],
+                "location": targets[target],
+                "amount": volume,
+                "plate": str(target_slot),
+            }
+        ]
+    else:
+        source = stage["source"]
+        labware = {"name": "Stock", "type": description[source]}
+        if "solvent" in description:
+            labware["solvent"] = description["solvent"]
+        for well in targets[source]:
+            labware[well] = {
+                "substance": well,
+                "amount": description[stage["stock_volume"]],
+            }
+        deck_info = {str(layout[source]): labware}
+        move_info = [
+            {
+                "substance": well,
+                "location": [target_well],
+                "amount": volume,
+                "plate": str(target_slot),
+            }
+            for well, target_well in zip(targets[source], targets[target])
+        ]
+
+    # Labware stays on the deck until its last stage.
+    present = {
+        role
+        for later in stages[index:]
+        for role in get_used_labware(later)
+    }
+    extra_labware = {
+        str(layout[role]): description[role]
+        for role in sorted(present - {source, target})
+    }
+    config = protocols[stage["protocol"]]
+    mount_racks = {
+        mount: racks[settings["tiprack"]]
+        for mount, settings in get_pipettes(config).items()
+    }
+    for load_name, slot in racks.items():
+        if slot not in mount_racks.values():
+            extra_labware[str(slot)] = load_name
+    overrides = {
+        "plate": description[target],
+        "plate_slot": target_slot,
+        "extra_labware": extra_labware,
+    }
+    if "pipettes" in config:
+        overrides["pipettes"] = {
+            mount: {"tiprack_slot": slot}
+            for mount, slot in mount_racks.items()
+        }
+    else:
+        overrides["tiprack_slot"] = mount_racks[config["mount"]]
+    return move_info, deck_info, overrides
+
+
+def get_config(protocol, overrides, starting_tips=None):
+    """
+    Returns the settings of a stage, with the tip each pipette starts
+    from.
+    """
+    overrides = dict(overrides)
+    starting_tips = starting_tips or {}
+    if "pipettes" in overrides:
+        overrides["pipettes"] = {
+            mount: {
+                **settings,
+                "starting_tip": starting_tips.get(settings["tiprack_slot"], 0),
+            }
+            for mount, settings in overrides["pipettes"].items()
+        }
+    else:
+        overrides["starting_tip"] = starting_tips.get(
+            overrides["tiprack_slot"], 0
+        )
+    return overrides, update_config(protocols[protocol], overrides)
+
+
+def plan_workflow(description, layout, racks):
+    """
+    Plans and estimates the stages of a plate on one deck layout.
+
+    Notes
+    -----
+    Tip racks are shared by the stages, each starting from the first
+    tip left by the last. A rack is replaced when a stage needs more
+    tips than it has left.
+
+    Parameters
+    ----------
+    description : dict
+        The plate description.
+
+    layout : dict
+        The deck slot of each labware of `roles`.
+
+    racks : dict
+        The deck slot of each tip rack, by load name.
+
+    Returns
+    -------
+    plan : dict
+        The files and estimate of each stage, the manual `steps`, the
+        labware placements and the estimated robot and turnaround times
+        in s.
+
+    Raises
+    ------
+    RuntimeError
+        If the deck cannot supply a stage.
+    """
+    targets = get_targets(description)
+    reservoir = assign_reservoir(description, targets)
+    tips_used = {slot: 0 for slot in racks.values()}
+    steps = [
+        f"Place the {role} ({description[role]}) in slot {layout[role]}."
+        for role in roles
+    ] + [
+        f"Place a full {load_name} in slot {slot}."
+        for load_name, slot in racks.items()
+    ]
+    placements = len(steps)
+    planned = []
+    manual_s = 0.0
+    for index, stage in enumerate(stages):
+        move_info, deck_info, overrides = build_stage(
+            index, description, layout, racks, targets, reservoir
+        )
+        overrides, config = get_config(stage["protocol"], overrides, tips_used)
+        compiled = compile_moves(move_info, deck_info, config)
+        if compiled["shortfalls"]:
+            raise RuntimeError(
+                f"The deck cannot supply {stage['protocol']}. Missing "
+                f"volumes (uL): {compiled['shortfalls']}"
+            )
+        config = get_run_config(config, compiled)
+        result = estimate(compiled["moves"], deck_info, config, plan=compiled)
+        replaced = {
+            int(slot.split("_")[1])
+            for slot, tips in result["tips_per_rack"].items()
+            if tips_used[int(slot.split("_")[1])] + tips > tips_per_rack
+        }
+        if replaced:
+            for slot in sorted(replaced):
+                steps.append(f"Replace the tip rack in slot {slot}.")
+                placements += 1
+                tips_used[slot] = 0
+            overrides, config = get_config(
+                stage["protocol"], overrides, tips_used
+            )
+            compiled = compile_moves(move_info, deck_info, config)
+            config = get_run_config(config, compiled)
+            result = estimate(
+                compiled["moves"], deck_info, config, plan=compiled
+            )
+        if stage.get("solvent_removal"):
+            slot = layout["reaction_plate"]
+            steps.append(
+                f"Take the reaction_plate from slot {slot} to remove the "
+                f"solvent, and return it to slot {slot}."
+            )
+            placements += 1
+            manual_s += 60 * description.get("solvent_removal_min", 0)
+        steps.append(
+            f"Run {stage['protocol']} "
+            f"({result['total_s'] / 60:.1f} min)."
+        )
+        for slot, tips in result["tips_per_rack"].items():
+            tips_used[int(slot.split("_")[1])] += tips
+        # Plates no later stage uses can be taken away.
+        later = {
+            role for i in stages[index + 1:] for role in get_used_labware(i)
+        }
+        for role in sorted(get_used_labware(stage) - later):
+            steps.append(f"Take the {role} from slot {layout[role]}.")
+        planned.append(
+            {
+                "protocol": stage["protocol"],
+                "move_commands": move_info,
+                "substance_locations": deck_info,
+                "settings": overrides,
+                "estimate": result,
+            }
+        )
+    robot_s = sum(i["estimate"]["total_s"] for i in planned)
+    manual_s += (
+        len(stages) * manual_timings["protocol_start"]
+        + placements * manual_timings["labware_placement"]
+    )
+    # Each protocol run on its own deck places all of its labware.
+    separate_placements = 1 + sum(
+        len(get_labware(protocols[i["protocol"]]))
+        + len(i["substance_locations"])
+        for i in planned
+    )
+    return {
+        "layout": {role: layout[role] for role in roles},
+        "tip_racks": racks,
+        "stages": planned,
+        "steps": steps,
+        "placements": placements,
+        "separate_placements": separate_placements,
+        "robot_s": robot_s,
+        "turnaround_s": robot_s + manual_s,
+    }
+
+
+def get_racks(slots):
+    """
+    Returns the slot of the tip rack of each pipette used by the stages,
+    sharing racks between stages, and the slots left.
+    """
+    slots = list(slots)
+    racks = {}
+    for stage in stages:
+        config = protocols[stage["protocol"]]
+        for settings in get_pipettes(config).values():
+            if settings["tiprack"] not in racks:
+                racks[settings["tiprack"]] = slots.pop(0)
+    return racks, slots
+
+
+def optimise_workflow(description, slots=range(1, 9)):
+    """
+    Returns the plan of the deck layout with the shortest robot time.
+
+    Tip racks take the first `slots`, and every arrangement of the
+    labware of `roles` in the slots left is estimated.
+    """
+    racks, free = get_racks(slots)
+    best = None
+    for arrangement in permutations(free, len(roles)):
+        plan = plan_workflow(description, dict(zip(roles, arrangement)), racks)
+        if best is None or plan["robot_s"] < best["robot_s"]:
+            best = plan
+    return best
+
+
+def write_workflow(plan, output_dir, robot_dir):
+    """
+    Writes the files and script of each stage of a plan to its own
+    directory, named after its protocol.
+    """
+    output_dir = Path(output_dir)
+    for stage in plan["stages"]:
+        stage_dir = output_dir / stage["protocol"]
+        stage_dir.mkdir(parents=True, exist_ok=True)
+        for name, key in (
+            ("move_commands.json", "move_commands"),
+            ("substance_locations.json", "substance_locations"),
+            (settings_name, "settings"),
+        ):
+            with open(stage_dir / name, "w") as f:
+                json.dump(stage[key], f, indent=4)
+        with open(here / stage["protocol"] / "opentron_script.py") as f:
+            script = f.read()
+        script = script.replace(
+            "protocol_dir = None",
+            f'protocol_dir = "{Path(robot_dir) / stage["protocol"]}"',
+        )
+        with open(stage_dir / "opentron_script.py", "w") as f:
+            f.write(script)
+    summary = {
+        key: value for key, value in plan.items() if key != "stages"
+    }
+    summary["stages"] = [
+        {
+            "protocol": i["protocol"],
+            "time_s": i["estimate"]["total_s"],
+            "tips": i["estimate"]["counts"].get("tips", 0),
+            "aspirations": i["estimate"]["counts"].get("aspirations", 0),
+        }
+        for i in plan["stages"]
+    ]
+    with open(output_dir / "workflow_plan.json", "w") as f:
+        json.dump(summary, f, indent=4)
+
+
+def main(args):
+    with open(args.i) as f:
+        description = json.load(f)
+    plan = optimise_workflow(description, args.slots)
+    output_dir = Path(args.o or Path(args.i).parent / "workflow")
+    robot_dir = args.robot_dir or robot_code_path / output_dir.resolve().name
+    write_workflow(plan, output_dir, robot_dir)
+
+    print("Deck layout:")
+    for role, slot in plan["layout"].items():
+        print(f"{slot:>4}  {role} ({description[role]})")
+    for load_name, slot in plan["tip_racks"].items():
+        print(f"{slot:>4}  {load_name}")
+    print("Steps:")
+    for i, step in enumerate(plan["steps"]):
+        print(f"{i + 1:>4}. {step}")
+    print(
+        f"Labware placements: {plan['placements']} "
+        f"(on separate decks: {plan['separate_placements']})"
+    )
+    print(f"Robot time: {plan['robot_s'] / 60:.1f} min")
+    print(f"Plate turnaround: {plan['turnaround_s'] / 60:.1f} min")
+    return plan
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=(
+            "Plans the HRMS, top-up and NMR protocols of one plate on a "
+            "shared deck, and writes the files of each."
+        )
+    )
+    parser.add_argument(
+        "-i", help="Path to the plate description.", required=True,
+    )
+    parser.add_argument(
+        "-o",
+        help=(
+            "Directory to write the protocol directories to. Defaults to "
+            "`workflow` next to the plate description."
+        ),
+    )
+    parser.add_argument(
+        "-robot_dir",
+        help=(
+            "Directory the protocol directories are copied to on the "
+            "robot. Defaults to the name of the output directory in "
+            "/root/Opentrons_Code."
+        ),
+    )
+    parser.add_argument(
+        "-slots",
+        help=(
+            "Deck slots to use. Tip racks take the first ones, and the "
+            "plates and reservoir are arranged in the rest."
+        ),
+        nargs="+",
+        type=int,
+        default=list(range(1, 9)),
+    )
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,392 @@
+import argparse
+import hashlib
+import json
+from pathlib import Path
+
+from deck_geometry import load_definition
+from inventory import plan_inventory
+from liquid_classes import (
+    apply_liquid_classes,
+    choose_liquid_classes,
+    find_solvent,
+)
+from protocol_config import (
+    expand_moves,
+    get_capacity,
+    get_labware,
+    get_pipettes,
+    load_config,
+    load_protocol,
+    protocols,
+)
+from tip_planning import apply_tip_plan, plan_tips, tip_policies
+
+# Bump when the format of the compiled plans changes.
+compiler_version = 3
+
+# Directory of the compiled plans, inside the protocol directory.
+cache_dir_name = ".compiled"
+
+# Modules whose code decides the compiled plan.
+planning_modules = (
+    "deck_geometry.py",
+    "inventory.py",
+    "liquid_classes.py",
+    "multichannel.py",
+    "protocol_compiler.py",
+    "protocol_config.py",
+    "tip_planning.py",
+)
+
+
+def get_content_hash(*contents):
+    """
+    Returns a hash of JSON serialisable contents.
+    """
+    return hashlib.sha1(
+        json.dumps(contents, sort_keys=True).encode()
+    ).hexdigest()
+
+
+def get_code_hash():
+    """
+    Returns a hash of the code of the planning modules, so plans are
+    compiled again when it changes.
+    """
+    code_hash = hashlib.sha1()
+    here = Path(__file__).resolve().parent
+    for module in planning_modules:
+        code_hash.update((here / module).read_bytes())
+    return code_hash.hexdigest()
+
+
+def get_wells(load_name):
+    """
+    Returns the well names of a labware, or None if its definition is
+    not available offline.
+    """
+    try:
+        return set(load_definition(load_name)["wells"])
+    except KeyError:
+        return None
+
+
+def validate_protocol(move_info, deck_info, config):
+    """
+    Checks the move and substance information of a protocol.
+
+    Parameters
+    ----------
+    move_info : list of dict
+        The contents of `move_commands.json`.
+
+    deck_info : dict
+        The contents of `substance_locations.json`.
+
+    config : dict
+        The settings of the protocol.
+
+    Raises
+    ------
+    ValueError
+        If a labware is put in a slot already in use or has an unknown
+        solvent, a well does not exist, an amount is not a positive
+        whole number of uL, or a move has an unknown substance, target plate or tip policy.
+    """
+    errors = []
+    if config.get("tip_policy", "substance") not in tip_policies:
+        errors.append(f"Unknown tip policy {config['tip_policy']}.")
+    labware = get_labware(config)
+    tipracks = {
+        slot for slot, load_name in labware.items() if "tiprack" in load_name
+    }
+    substances = set()
+    # The wells of each labware, read once.
+    wells_of = {}
+
+    def get_labware_wells(load_name):
+        if load_name not in wells_of:
+            wells_of[load_name] = get_wells(load_name)
+        return wells_of[load_name]
+
+    for slot, info in deck_info.items():
+        if int(slot) in labware:
+            errors.append(f"Slot {slot} of the stocks is already in use.")
+            continue
+        if "type" not in info:
+            errors.append(f"Slot {slot} of the stocks has no type.")
+            continue
+        labware[int(slot)] = info["type"]
+        if "solvent" in info and find_solvent(info["solvent"]) is None:
+            errors.append(
+                f"Slot {slot} of the stocks has an unknown solvent {info['solvent']}."
+            )
+        wells = get_labware_wells(info["type"])
+        for well, substance in info.items():
+            if well in ("name", "type", "solvent"):
+                continue
+            if wells is not None and well not in wells:
+                errors.append(f"Stock well {slot}:{well} does not exist.")
+            if substance["amount"] < 0:
+                errors.append(f"Stock well {slot}:{well} has a negative amount.")
+            substances.add(substance["substance"])
+
+    for index, move in enumerate(move_info):
+        missing = {"substance", "location", "amount", "plate"} - set(move)
+        if missing:
+            errors.append(f"Move {index} has no {', '.join(sorted(missing))}.")
+            continue
+        if move["substance"] not in substances:
+            errors.append(
+                f"Move {index} uses {move['substance']}, which is not on the deck."
+            )
+        # Moves are made in whole uL, as by `expand_moves`.
+        amount = float(move["amount"])
+        if not amount.is_integer():
+            errors.append(
+                f"Move {index} has an amount which is not a whole number of uL."
+            )
+        elif amount <= 0:
+            errors.append(f"Move {index} has an amount which is not positive.")
+        if move.get("tip_policy", "substance") not in tip_policies:
+            errors.append(
+                f"Move {index} has an unknown tip policy {move['tip_policy']}."
+            )
+        plate = int(move["plate"])
+        if plate not in labware or plate in tipracks:
+            errors.append(f"Move {index} targets slot {plate}, which has no plate.")
+            continue
+        wells = get_labware_wells(labware[plate])
+        for location in move["location"]:
+            if wells is not None and location not in wells:
+                errors.append(
+                    f"Move {index} targets well {plate}:{location}, which does not exist."
+                )
+    if errors:
+        raise ValueError("Invalid protocol files:\n" + "\n".join(errors))
+
+
+def validate_aspirations(aspirations, config):
+    """
+    Checks that every aspiration is positive and fits in the tip of
+    its pipette with the air gap.
+
+    Raises
+    ------
+    ValueError
+        If an aspiration or one of its dispenses is empty, as
+        aspirating 0 uL fills the pipette, or an aspiration is above
+        the nominal volume of its pipette, such as more than 20 uL on
+        a p20.
+    """
+    errors = []
+    pipettes = get_pipettes(config)
+    for index, (substance, targets) in enumerate(aspirations):
+        settings = pipettes[targets[0][0]["mount"]]
+        amount = sum(i for _, i in targets)
+        if any(i <= 0 for _, i in targets):
+            errors.append(f"Aspiration {index} of {substance} is empty.")
+        elif amount + settings["air_gap"] > get_capacity(settings):
+            errors.append(
+                f"Aspiration {index} of {amount} uL {substance} does not fit "
+                f"in the {settings['pipette']} with its air gap."
+            )
+    if errors:
+        raise ValueError("Invalid aspirations:\n" + "\n".join(errors))
+
+
+def compile_moves(move_info, deck_info, config):
+    """
+    Returns the plan of the moves and stocks of a protocol.
+
+    Parameters
+    ----------
+    move_info : list of dict
+        The contents of `move_commands.json`.
+
+    deck_info : dict
+        The contents of `substance_locations.json`.
+
+    config : dict
+        The settings of the protocol.
+
+    Returns
+    -------
+    compiled : dict
+        The expanded `moves`, the `deck_info`, the plan made by
+        `inventory.plan_inventory`, the `liquid_classes` chosen by
+        `liquid_classes.choose_liquid_classes` and the `tips` planned by
+        `tip_planning.plan_tips`.
+
+    Raises
+    ------
+    ValueError
+        If the protocol files are invalid, or an aspiration does not
+        fit in its pipette with the air gap of its liquid class.
+    """
+    validate_protocol(move_info, deck_info, config)
+    moves = expand_moves(move_info)
+    plan = plan_inventory(moves, deck_info, config, check=False)
+    chosen = choose_liquid_classes(plan["aspirations"], deck_info, config)
+    # A liquid class can raise the air gap of a pipette, leaving less room
+    # in the tip, so the moves are chunked again with the settings used
+    # at run time.
+    class_config = apply_liquid_classes(config, chosen)
+    air_gaps = [
+        {mount: i["air_gap"] for mount, i in get_pipettes(j).items()}
+        for j in (config, class_config)
+    ]
+    if air_gaps[0] != air_gaps[1]:
+        plan = plan_inventory(moves, deck_info, class_config, check=False)
+    validate_aspirations(plan["aspirations"], class_config)
+    plan["liquid_classes"] = chosen
+    plan["tips"] = plan_tips(
+        plan["aspirations"], plan["sources"], deck_info, config
+    )
+    return {"moves": moves, "deck_info": deck_info, **plan}
+
+
+def get_run_config(config, compiled):
+    """
+    Returns the settings of a protocol with the liquid classes and tip
+    racks of its compiled plan.
+    """
+    config = apply_liquid_classes(config, compiled["liquid_classes"])
+    return apply_tip_plan(config, compiled["tips"])
+
+
+def compile_protocol(
+    protocol_dir, protocol_name=None, use_cache=True, check=True,
+):
+    """
+    Returns the compiled action list of a protocol directory.
+
+    Notes
+    -----
+    The files are validated, the moves expanded, chunked and given
+    their pipettes, a source well is assigned to every aspiration and
+    the liquid class of each pipette is chosen, by `compile_moves`.
+    The result is cached in `.compiled` in the protocol directory under
+    a hash of the files, the protocol settings and the planning code,
+    and reused by the engine, the estimator and the simulations until
+    any of these change.
+
+    Parameters
+    ----------
+    protocol_dir : str
+        The directory holding `move_commands.json` and
+        `substance_locations.json`.
+
+    protocol_name : str, optional
+        The name of the protocol settings to use. Defaults to the name
+        of the directory.
+
+    use_cache : bool
+        Toggles reading and writing the cached plan.
+
+    check : bool
+        Toggles raising an error if the deck cannot supply the plan.
+
+    Returns
+    -------
+    compiled : dict
+        The `hash` and `protocol` name, and the plan made by
+        `compile_moves`.
+
+    Raises
+    ------
+    ValueError
+        If the protocol files are invalid.
+
+    RuntimeError
+        If `check` and the deck cannot supply the plan, or has no free
+        slots for the tip racks it needs.
+    """
+    protocol_dir = Path(protocol_dir)
+    protocol_name = protocol_name or protocol_dir.resolve().name
+    config = load_config(protocol_dir, protocol_name)
+    move_info, deck_info = load_protocol(protocol_dir)
+    content_hash = get_content_hash(
+        move_info, deck_info, config, compiler_version, get_code_hash()
+    )
+    cache_path = protocol_dir / cache_dir_name / f"{content_hash}.json"
+
+    if use_cache and cache_path.is_file():
+        with open(cache_path) as f:
+            compiled = json.load(f)
+    else:
+        # Round trip through JSON, so fresh and cached plans are the same.
+        compiled = json.loads(
+            json.dumps(
+                {
+                    "hash": content_hash,
+                    "protocol": protocol_name,
+                    **compile_moves(move_info, deck_info, config),
+                }
+            )
+        )
+        if use_cache:
+            try:
+                cache_path.parent.mkdir(exist_ok=True)
+                with open(cache_path, "w") as f:
+                    json.dump(compiled, f)
+            except OSError:
+                pass
+
+    if check and compiled["shortfalls"]:
+        raise RuntimeError(
+            "The deck cannot supply the protocol. Missing volumes (uL): "
+            + ", ".join(
+                f"{i}: {j:g}" for i, j in compiled["shortfalls"].items()
+            )
+        )
+    if check and compiled["tips"]["racks_short"]:
+        raise RuntimeError(
+            f"The protocol needs {compiled['tips']['racks_short']} more tip "
+            "racks than there are free deck slots."
+        )
+    return compiled
+
+
+def main(args):
+    compiled = compile_protocol(
+        args.i, args.protocol, use_cache=not args.no_cache,
+    )
+    print(
+        f"Compiled {len(compiled['moves'])} moves into "
+        f"{len(compiled['aspirations'])} aspirations ({compiled['hash']})."
+    )
+    for mount, slots in compiled["tips"]["tiprack_slots"].items():
+        print(
+            f"{mount}: {compiled['tips']['tips'][mount]} tips from tip rack "
+            f"slots {', '.join(str(i) for i in slots)}."
+        )
+    return compiled
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=(
+            "Validates and compiles the moves of an Opentrons protocol, "
+            "caching the result."
+        )
+    )
+    parser.add_argument(
+        "-i", help="Path to the protocol directory.", required=True,
+    )
+    parser.add_argument(
+        "-protocol",
+        help=(
+            "Name of the protocol settings to use. Defaults to the name of "
+            "the protocol directory."
+        ),
+        choices=list(protocols),
+        default=None,
+    )
+    parser.add_argument(
+        "-no_cache",
+        help="Compile again without reading or writing the cache.",
+        action="store_true",
+    )
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,490 @@
+import json
+import math
+from itertools import groupby
+from pathlib import Path
+
+# Settings of each protocol, used by `protocol_engine.py` to run the
+# `opentron_script.py` of each protocol directory, and by the offline
+# tools to plan and estimate a protocol without the Opentrons stack.
+# The flow rate, swelling, air gap, blow out and gantry speed are
+# replaced by the liquid class of the solvents on the deck, if known
+# (`liquid_classes.py`), unless `"liquid_classes": False` is set.
+protocols = {
+    "NMR_transfer": {
+        "plate": "hackspacenmr_96_wellplate_600ul",
+        "plate_slot": 4,
+        "pipette": "p300_single_gen2",
+        "mount": "left",
+        "tiprack": "opentrons_96_tiprack_300ul",
+        "tiprack_slot": 2,
+        # Gantry speed of the X, Y and Z axes in mm/s, None for default.
+        "max_speed": 250,
+        # Aspirate and dispense flow rate in uL/s, None for default.
+        "flow_rate": 60,
+        "swell_volume": 100,
+        "swell_delay": 5,
+        "air_gap": 15,
+        "blow_out": False,
+        "minimum_volume": 10,
+        "pipette_max_volume": 220,
+        # Moves of one to two times pipette_max_volume are made in a
+        # single aspiration.
+        "single_chunk": True,
+    },
+    "HRMS_transfer": {
+        "plate": "aglient_54_wellplate_2000ul",
+        "plate_slot": 4,
+        "pipette": "p20_single_gen2",
+        "mount": "right",
+        "tiprack": "opentrons_96_tiprack_20ul",
+        "tiprack_slot": 2,
+        "max_speed": None,
+        "flow_rate": None,
+        "swell_volume": 3,
+        "swell_delay": 1,
+        "air_gap": 0,
+        "blow_out": False,
+        "minimum_volume": 500,
+        "pipette_max_volume": 20,
+        "single_chunk": True,
+    },
+    "Plate_example": {
+        "plate": "analyticalsales_48_wellplate_2000ul",
+        "plate_slot": 4,
+        "pipette": "p300_single_gen2",
+        "mount": "left",
+        "tiprack": "opentrons_96_tiprack_300ul",
+        "tiprack_slot": 2,
+        "max_speed": 250,
+        "flow_rate": 70,
+        "swell_volume": 100,
+        "swell_delay": 10,
+        "air_gap": 15,
+        "blow_out": False,
+        "minimum_volume": 400,
+        "pipette_max_volume": 220,
+        "single_chunk": False,
+        # Directory of the protocol on the robot, if not its name.
+        "robot_dir": "Plate1_example",
+    },
+    "solvent_topup_CDCl3": {
+        "plate": "analyticalsales_48_wellplate_2000ul",
+        "plate_slot": 4,
+        "pipette": "p300_single_gen2",
+        "mount": "left",
+        "tiprack": "opentrons_96_tiprack_300ul",
+        "tiprack_slot": 2,
+        "max_speed": 250,
+        "flow_rate": None,
+        "swell_volume": 100,
+        "swell_delay": 10,
+        "air_gap": 15,
+        "blow_out": False,
+        "minimum_volume": 3000,
+        "pipette_max_volume": 200,
+        "single_chunk": False,
+        # Moves of one substance share aspirations.
+        "distribute": True,
+    },
+    "solvent_topup_MeOHDCM": {
+        "plate": "aglient_54_wellplate_2000ul",
+        "plate_slot": 4,
+        "pipette": "p300_single_gen2",
+        "mount": "left",
+        "tiprack": "opentrons_96_tiprack_300ul",
+        "tiprack_slot": 2,
+        "max_speed": 250,
+        "flow_rate": None,
+        "swell_volume": 100,
+        "swell_delay": 10,
+        "air_gap": 15,
+        "blow_out": True,
+        "minimum_volume": 6000,
+        "pipette_max_volume": 200,
+        "single_chunk": False,
+        "robot_dir": "Solvent_TopUp_MeOHDCM",
+        # Moves of one substance share aspirations.
+        "distribute": True,
+    },
+    "HRMS_NMR_transfer": {
+        "plate": "hackspacenmr_96_wellplate_600ul",
+        "plate_slot": 4,
+        # Other target labware, by deck slot.
+        "extra_labware": {5: "aglient_54_wellplate_2000ul"},
+        "max_speed": 250,
+        "minimum_volume": 10,
+        "single_chunk": True,
+        # Settings of each pipette, by mount, overriding the settings
+        # above. Each move is made by the pipette chosen by
+        # `route_moves`.
+        "pipettes": {
+            "right": {
+                "pipette": "p20_single_gen2",
+                "tiprack": "opentrons_96_tiprack_20ul",
+                "tiprack_slot": 1,
+                "flow_rate": None,
+                "swell_volume": 3,
+                "swell_delay": 1,
+                "air_gap": 0,
+                "blow_out": False,
+                # The short p20 tips need a deeper stock.
+                "minimum_volume": 500,
+                "pipette_max_volume": 20,
+                "min_volume": 1,
+            },
+            "left": {
+                "pipette": "p300_single_gen2",
+                "tiprack": "opentrons_96_tiprack_300ul",
+                "tiprack_slot": 2,
+                "flow_rate": 60,
+                "swell_volume": 100,
+                "swell_delay": 5,
+                "air_gap": 15,
+                "blow_out": False,
+                "pipette_max_volume": 220,
+                "min_volume": 20,
+            },
+        },
+    },
+}
+
+# Name of the file of a protocol directory overriding its settings.
+settings_name = "protocol_settings.json"
+
+
+def load_protocol(protocol_dir):
+    """
+    Returns the move and substance information of a protocol directory.
+
+    Returns
+    -------
+    move_info : list of dict
+        The contents of `move_commands.json`.
+
+    deck_info : dict
+        The contents of `substance_locations.json`.
+    """
+    protocol_dir = Path(protocol_dir)
+    with open(protocol_dir / "move_commands.json") as f:
+        move_info = json.load(f)
+    with open(protocol_dir / "substance_locations.json") as f:
+        deck_info = json.load(f)
+    return move_info, deck_info
+
+
+def load_config(protocol_dir, protocol_name=None):
+    """
+    Returns the settings of a protocol directory.
+
+    Notes
+    -----
+    The settings in `protocols` are updated by the
+    `protocol_settings.json` of the directory, if it has one, such as
+    those written by `plate_workflow.py` to place the labware of each
+    stage on a shared deck. The settings of each pipette are updated
+    separately.
+
+    Parameters
+    ----------
+    protocol_dir : str
+        The protocol directory.
+
+    protocol_name : str, optional
+        The name of the protocol settings. Defaults to the name of the
+        directory.
+
+    Returns
+    -------
+    config : dict
+        The settings of the protocol.
+    """
+    protocol_dir = Path(protocol_dir)
+    config = protocols[protocol_name or protocol_dir.resolve().name]
+    path = protocol_dir / settings_name
+    if not path.is_file():
+        return config
+    with open(path) as f:
+        return update_config(config, json.load(f))
+
+
+def update_config(config, overrides):
+    """
+    Returns the settings of a protocol updated by `overrides`, with the
+    settings of each pipette updated separately.
+    """
+    overrides = dict(overrides)
+    pipettes = overrides.pop("pipettes", {})
+    config = {**config, **overrides}
+    if pipettes:
+        config["pipettes"] = {
+            mount: {**settings, **pipettes.get(mount, {})}
+            for mount, settings in config["pipettes"].items()
+        }
+    return config
+
+
+def expand_moves(move_info):
+    """
+    Returns one move per target well, in the order `run()` makes them.
+    """
+    moves = []
+    for substance in move_info:
+        for location in substance["location"]:
+            move = {
+                "substance": substance["substance"],
+                "location": location,
+                "amount": int(substance["amount"]),
+                "plate": int(substance["plate"]),
+            }
+            if "tip_policy" in substance:
+                move["tip_policy"] = substance["tip_policy"]
+            moves.append(move)
+    return moves
+
+
+def get_pipettes(config):
+    """
+    Returns the settings of each pipette of a protocol.
+
+    Parameters
+    ----------
+    config : dict
+        The settings of the protocol.
+
+    Returns
+    -------
+    pipettes : dict
+        The settings of the pipette on each mount, with the settings of
+        the protocol they do not override.
+    """
+    if "pipettes" not in config:
+        return {config["mount"]: config}
+    shared = {
+        key: value for key, value in config.items() if key != "pipettes"
+    }
+    return {
+        mount: {**shared, "mount": mount, **settings}
+        for mount, settings in config["pipettes"].items()
+    }
+
+
+def get_labware(config):
+    """
+    Returns the load name of the labware in each deck slot which is not
+    in `substance_locations.json`.
+    """
+    labware = {config["plate_slot"]: config["plate"]}
+    for slot, load_name in config.get("extra_labware", {}).items():
+        labware[int(slot)] = load_name
+    for settings in get_pipettes(config).values():
+        for slot in get_tiprack_slots(settings):
+            labware[slot] = settings["tiprack"]
+    return labware
+
+
+def get_tiprack_slots(settings):
+    """
+    Returns the deck slots of the tip racks of a pipette, in order.
+
+    The racks planned by `tip_planning.plan_tips` are in
+    `tiprack_slots`, otherwise the pipette has one rack in
+    `tiprack_slot`.
+    """
+    return settings.get("tiprack_slots", [settings["tiprack_slot"]])
+
+
+def route_moves(moves, config):
+    """
+    Returns the moves with the mount of the pipette making each one.
+
+    Notes
+    -----
+    A move is made by the single-channel pipette which needs the fewest
+    aspirations of at most `get_max_chunk`, among those whose
+    `min_volume` is not above the amount. Ties go to the pipette with the smallest `pipette_max_volume`, which
+    is the most accurate. Moves which already have a mount, such as the
+    column moves of `multichannel.group_columns`, keep it.
+
+    Parameters
+    ----------
+    moves : list of dict
+        The moves, with one target well each.
+
+    config : dict
+        The settings of the protocol.
+
+    Returns
+    -------
+    moves : list of dict
+        The moves, each with a `mount`.
+    """
+    pipettes = {
+        mount: settings
+        for mount, settings in get_pipettes(config).items()
+        if settings.get("channels", 1) == 1
+    }
+
+    def cost(mount, amount):
+        settings = pipettes[mount]
+        return (
+            amount < settings.get("min_volume", 0),
+            math.ceil(amount / get_max_chunk(settings)),
+            settings["pipette_max_volume"],
+        )
+
+    routed = []
+    for move in moves:
+        if "mount" not in move:
+            mount = min(pipettes, key=lambda i: cost(i, move["amount"]))
+            move = {**move, "mount": mount}
+        routed.append(move)
+    return routed
+
+
+def get_capacity(config):
+    """
+    Returns the nominal volume of a pipette in uL, from its model name
+    such as "p300_single_gen2".
+    """
+    return int(config["pipette"].split("_")[0][len("p"):])
+
+
+def get_max_chunk(config):
+    """
+    Returns the most a pipette aspirates at once in uL, within its
+    `pipette_max_volume` and leaving room in the tip for its air gap.
+    """
+    return min(
+        config["pipette_max_volume"], get_capacity(config) - config["air_gap"]
+    )
+
+
+def get_chunks(amount, config):
+    """
+    Returns the volumes a move is split into, as done by `run()`.
+
+    Notes
+    -----
+    With `single_chunk`, a move of one to two times the largest chunk
+    is made in a single aspiration, as long as it fits in the tip with
+    the air gap. Empty chunks are never aspirated, as aspirating 0 uL
+    fills the pipette.
+
+    Parameters
+    ----------
+    amount : int
+        The volume of the move in uL.
+
+    config : dict
+        The settings of the protocol.
+
+    Returns
+    -------
+    chunks : list of int
+        The volume of each aspiration.
+    """
+    pipette_max_volume = get_max_chunk(config)
+    num_moves = amount // pipette_max_volume
+    fits = amount + config["air_gap"] <= get_capacity(config)
+    if config["single_chunk"] and num_moves == 1 and fits:
+        num_moves = 0
+    chunks = [pipette_max_volume] * num_moves
+    chunks.append(amount - pipette_max_volume * num_moves)
+    return [i for i in chunks if i != 0]
+
+
+def pack_distribution(targets, pipette_max_volume):
+    """
+    Packs the moves of one substance into as few aspirations as
+    possible, as done by the distribute mode of `run()`.
+
+    Parameters
+    ----------
+    targets : list of tuple
+        The target and amount of each move, in order.
+
+    pipette_max_volume : int
+        Maximum amount aspirated at once in uL.
+
+    Returns
+    -------
+    aspirations : list of list of tuple
+        The target and amount dispensed from each aspiration. A move may
+        be split between two aspirations.
+    """
+    aspirations = []
+    space = 0
+    for target, amount in targets:
+        while amount > 0:
+            if space == 0:
+                aspirations.append([])
+                space = pipette_max_volume
+            amount_to_add = min(amount, space)
+            aspirations[-1].append((target, amount_to_add))
+            amount -= amount_to_add
+            space -= amount_to_add
+    return aspirations
+
+
+def get_aspirations(moves, config):
+    """
+    Returns every aspiration of a list of moves.
+
+    Moves are chunked with the settings of the pipette making them, as
+    chosen by `route_moves`.
+
+    Parameters
+    ----------
+    moves : list of dict
+        The moves, with one target well each.
+
+    config : dict
+        The settings of the protocol.
+
+    Returns
+    -------
+    aspirations : list of tuple
+        The substance of each aspiration, and the moves it is dispensed
+        to with the amount dispensed to each. The moves have the `mount`
+        of the pipette making them.
+    """
+    aspirations = []
+    pipettes = get_pipettes(config)
+    moves = route_moves(moves, config)
+    if config.get("distribute", False):
+        for (substance, mount), group in groupby(
+            moves, key=lambda x: (x["substance"], x["mount"])
+        ):
+            targets = [(move, move["amount"]) for move in group]
+            for aspiration in pack_distribution(
+                targets, get_max_chunk(pipettes[mount])
+            ):
+                aspirations.append((substance, aspiration))
+        return aspirations
+    for move in moves:
+        for chunk in get_chunks(move["amount"], pipettes[move["mount"]]):
+            aspirations.append((move["substance"], [(move, chunk)]))
+    return aspirations
+
+
+def get_draws(targets):
+    """
+    Returns the substance and volume drawn by each channel of an
+    aspiration.
+
+    Parameters
+    ----------
+    targets : list of tuple
+        The moves of an aspiration and the amount dispensed to each, as
+        made by `get_aspirations`.
+
+    Returns
+    -------
+    draws : list of tuple
+        The substance and volume aspirated by each channel.
+    """
+    amount = sum(i for _, i in targets)
+    move = targets[0][0]
+    if "channels" in move:
+        return [(channel["substance"], amount) for channel in move["channels"]]
+    return [(move["substance"], amount)]
@@ -0,0 +1,780 @@
+import json
+import os
+import time
+from collections import defaultdict
+from pathlib import Path
+from pprint import pprint
+
+from protocol_compiler import compile_protocol, get_run_config
+from protocol_config import (
+    get_draws,
+    get_labware,
+    get_pipettes,
+    get_tiprack_slots,
+    load_config,
+    protocols,
+)
+from tip_planning import tips_per_rack
+
+# Where the protocol directories are copied to on the robot.
+robot_code_path = Path("/root/Opentrons_Code")
+
+# Name of the progress journal written to the protocol directory.
+journal_name = "progress_journal.json"
+
+# Name of the event log written to the protocol directory.
+telemetry_name = "run_telemetry.jsonl"
+
+
+class Opentrons:
+    def __init__(
+        self, protocol, deck_info: dict, config: dict, telemetry=None,
+    ):
+        """
+        Initialise the Opentrons object.
+
+        Parameters
+        ----------
+        protocol : protocol_api.ProtocolContext
+            The protocol context for the current protocol.
+        deck_info : dict
+            Dictionary of deck information.
+            Contains information of substances and their quantities on the deck.
+        config : dict
+            The settings of the protocol, from `protocol_config.protocols`.
+        telemetry : RunTelemetry, optional
+            The event log the robot commands are recorded in.
+
+        Returns
+        -------
+        None
+        """
+        self.protocol = protocol
+        self.config = config
+        self.telemetry = telemetry
+        # Set gantry speeds
+        if config["max_speed"] is not None:
+            for axis in ("X", "Y", "Z"):
+                self.protocol.max_speeds[axis] = config["max_speed"]
+
+        self.labware = {}
+        for slot, load_name in get_labware(config).items():
+            self.labware[slot] = self.protocol.load_labware(load_name, slot)
+        self.plate = self.labware[config["plate_slot"]]
+        # Add substances to the deck
+        for deck_number in deck_info:
+            self.labware[int(deck_number)] = self.protocol.load_labware(
+                deck_info[deck_number]["type"], int(deck_number)
+            )
+        # Loading pipettes
+        self.settings = get_pipettes(config)
+        self.pipettes = {}
+        self.tipracks = {}
+        for mount, settings in self.settings.items():
+            tipracks = [self.labware[i] for i in get_tiprack_slots(settings)]
+            pipette = self.protocol.load_instrument(
+                settings["pipette"], mount, tip_racks=tipracks,
+            )
+            self.tipracks[mount] = tipracks
+            # Tip racks shared with earlier protocols start part way.
+            if settings.get("starting_tip"):
+                self.skip_tips(pipette, settings["starting_tip"])
+            if settings["flow_rate"] is not None:
+                pipette.flow_rate.aspirate = settings["flow_rate"]
+                pipette.flow_rate.dispense = settings["flow_rate"]
+            pipette.swelled = False
+            # Substance the current tip has been used for.
+            pipette.substance = None
+            self.pipettes[mount] = pipette
+        # For tracking substance amounts
+        self.substances = defaultdict(list)
+        for position in deck_info:
+            position_int = int(position)
+            for well_plate in deck_info[position]:
+                if well_plate in ("name", "type", "solvent"):
+                    continue
+                substance = deck_info[position][well_plate]
+                self.substances[substance["substance"]].append(
+                    {
+                        "position": self.labware[position_int][well_plate],
+                        "amount": substance["amount"],
+                        "slot": position_int,
+                        "well": well_plate,
+                    }
+                )
+
+    def command(self, category, target, name, *args, **kwargs):
+        """
+        Runs a command of a pipette or the protocol, recording it in the
+        telemetry.
+
+        Parameters
+        ----------
+        category : str
+            What the command is part of: "swell", "transfer" or "tip".
+        target : pipette or protocol_api.ProtocolContext
+            The object running the command.
+        name : str
+            The name of the command, such as "aspirate".
+        *args, **kwargs
+            The arguments of the command.
+
+        Returns
+        -------
+        The result of the command.
+        """
+        start = time.time()
+        result = getattr(target, name)(*args, **kwargs)
+        if self.telemetry is not None:
+            mount = getattr(target, "mount", None)
+            volume = kwargs.get("volume")
+            # The first argument of a pipette command is its volume.
+            if volume is None and mount is not None and args:
+                if isinstance(args[0], (int, float)):
+                    volume = args[0]
+            self.telemetry.record(
+                name, category, start, mount=mount, volume=volume,
+            )
+        return result
+
+    def swell_tip(self, pipette, position):
+        """
+        Swells the tip in the `stock` labware location at a specified location.
+
+        Notes
+        -----
+        Perform before a pipette is used for transfer.
+
+        Parameters
+        ----------
+        pipette : pipette
+            The pipette to be used.
+
+        position:
+            Position to swell the tip in.
+
+        Returns
+        -------
+        None
+
+        """
+        settings = self.settings[pipette.mount]
+        self.command(
+            "swell", pipette, "aspirate", settings["swell_volume"], position
+        )
+        self.command("swell", self.protocol, "delay", settings["swell_delay"])
+        self.command("swell", pipette, "move_to", position.top())
+        self.command(
+            "swell",
+            pipette,
+            "dispense",
+            settings["swell_volume"],
+            location=position,
+        )
+        pipette.swelled = True
+
+    def move_without_drip(self, position_to, position_from, pipette, amount):
+        """
+        Transfers substance from one location to another without dripping (hopefully).
+
+        Notes
+        -----
+        Ideally, the swell function will be used before this function is called to reduce the
+        probability of drips.
+
+        Parameters
+        ----------
+        position_to: position
+            Location of the target well plates to move substance to.
+        position_from: position
+            Location of the source well plates to move substance from.
+        pipette: pipette
+            The pipette to be used.
+        amount: float or int
+            Amount of substance to be moved. (in uL)
+
+        Returns
+        -------
+        None
+
+        """
+        settings = self.settings[pipette.mount]
+        self.command("transfer", pipette, "aspirate", amount, position_from)
+        if settings["air_gap"]:
+            self.command("transfer", pipette, "air_gap", settings["air_gap"])
+        self.command(
+            "transfer", pipette, "dispense", location=position_to.top(z=2)
+        )
+        if settings["blow_out"]:
+            self.command("transfer", pipette, "blow_out", position_to)
+
+    def distribute_without_drip(
+        self, positions_to, position_from, pipette, amounts
+    ):
+        """
+        Transfers substance from one location to several others with a
+        single aspiration.
+
+        Notes
+        -----
+        The air gap is dispensed with each amount and aspirated again
+        above the well before moving to the next one.
+
+        Parameters
+        ----------
+        positions_to: list of position
+            Locations of the target wells, in order.
+        position_from: position
+            Location of the source well plates to move substance from.
+        pipette: pipette
+            The pipette to be used.
+        amounts: list of float or int
+            Amount of substance dispensed into each target. (in uL)
+
+        Returns
+        -------
+        None
+
+        """
+        air_gap = self.settings[pipette.mount]["air_gap"]
+        self.command(
+            "transfer", pipette, "aspirate", sum(amounts), position_from
+        )
+        if air_gap:
+            self.command("transfer", pipette, "air_gap", air_gap)
+        for i, (position_to, amount) in enumerate(zip(positions_to, amounts)):
+            if i == len(amounts) - 1:
+                self.command(
+                    "transfer",
+                    pipette,
+                    "dispense",
+                    location=position_to.top(z=2),
+                )
+                if self.settings[pipette.mount]["blow_out"]:
+                    self.command("transfer", pipette, "blow_out", position_to)
+            else:
+                self.command(
+                    "transfer",
+                    pipette,
+                    "dispense",
+                    amount + air_gap,
+                    location=position_to.top(z=2),
+                )
+                if air_gap:
+                    self.command("transfer", pipette, "air_gap", air_gap)
+
+    def skip_tips(self, pipette, tips):
+        """
+        Starts the pipette from the tip after the first `tips` of its
+        racks.
+
+        Raises
+        ------
+        RuntimeError
+            If no tip is left in the loaded racks after the first `tips`.
+        """
+        tipracks = self.tipracks[pipette.mount]
+        if tips >= len(tipracks) * tips_per_rack:
+            raise RuntimeError(
+                f"Cannot skip {tips} tips of the {pipette.mount} pipette, "
+                f"only {len(tipracks)} tip racks are loaded."
+            )
+        rack = tips // tips_per_rack
+        pipette.starting_tip = tipracks[rack].wells()[tips % tips_per_rack]
+
+    def change_tip(self, pipette, substance_name, new_tip=None):
+        """
+        Gives the pipette a new tip if planned, or by default if its tip
+        was used for another substance. A pipette without a tip always
+        takes one. A new tip is swelled before its first transfer.
+        """
+        if new_tip is None:
+            new_tip = pipette.substance != substance_name
+        if not new_tip and pipette.substance is not None:
+            return
+        if pipette.substance is not None:
+            self.command("tip", pipette, "drop_tip")
+        self.command("tip", pipette, "pick_up_tip")
+        pipette.substance = substance_name
+        pipette.swelled = False
+
+    def get_source(self, amount, substance_name, pipette, well=None):
+        """
+        Returns the source well to aspirate an amount of substance from.
+
+        Notes
+        -----
+        Without a planned `well`, source wells are used in order and
+        retired once the amount would take them below the
+        `minimum_volume` of the pipette.
+
+        Parameters
+        ----------
+        amount : float or int
+            Amount of substance to be aspirated. (in uL)
+        substance_name : str
+            Name of the substance to be moved.
+        pipette: pipette
+            The pipette to be used.
+        well : tuple, optional
+            The (slot, well) planned by `inventory.plan_inventory`.
+
+        Returns
+        -------
+        source : dict
+            The `position` and remaining `amount` of the source well.
+        """
+        if substance_name not in self.substances:
+            pprint(self.substances)
+            raise RuntimeError(
+                f"Substance {substance_name} not found in deck. This could be due to the deck being empty, or the amount of {substance_name} needed exceeding the amount placed on the deck."
+            )
+        minimum_volume = self.settings[pipette.mount]["minimum_volume"]
+        wells = self.substances[substance_name]
+        if well is not None:
+            source = next(
+                i for i in wells if (i["slot"], i["well"]) == tuple(well)
+            )
+            if amount > source["amount"] - minimum_volume:
+                raise RuntimeError(
+                    f"Not enough {substance_name} left in {well}. Please check the deck and try again."
+                )
+            return source
+        while wells and amount > wells[0]["amount"] - minimum_volume:
+            print(
+                f"Amount of {substance_name} needed is greater than the amount in the well.\n"
+                f"Changing the well plate to move {substance_name} from."
+            )
+            wells.pop(0)
+        if len(wells) == 0:
+            raise RuntimeError(
+                f"No more {substance_name} left on the deck. Please check the deck and try again."
+            )
+        return wells[0]
+
+    def transfer(
+        self, substance_name, draws, positions_to, amounts, pipette,
+        sources=None, new_tip=None,
+    ):
+        """
+        Moves substance to one or more wells with a single aspiration.
+
+        Parameters
+        ----------
+        substance_name : str
+            Name of the substance to be moved. For a multi-channel
+            pipette, the names of the substance of each channel.
+        draws : list of tuple
+            The substance and amount aspirated by each channel, from
+            `protocol_config.get_draws`.
+        positions_to: list of position
+            Locations of the target wells, in order. For a multi-channel
+            pipette, the wells of its first channel.
+        amounts: list of float or int
+            Amount of substance moved to each target. (in uL)
+        pipette: pipette
+            The pipette to be used.
+        sources: list of tuple, optional
+            The (slot, well) of each draw, from `inventory.plan_inventory`.
+            Found by `get_source` if not given.
+        new_tip: bool, optional
+            Whether to take a new tip, from `tip_planning.plan_tips`.
+            Decided by `change_tip` if not given.
+
+        Returns
+        -------
+        None
+
+        """
+        self.change_tip(pipette, substance_name, new_tip)
+        if sources is None:
+            sources = [None] * len(draws)
+        source_wells = []
+        for (draw_substance, amount), well in zip(draws, sources):
+            source = self.get_source(amount, draw_substance, pipette, well)
+            source["amount"] -= amount
+            source_wells.append(source)
+        # A multi-channel pipette is positioned by its first channel.
+        position_from = source_wells[0]["position"]
+        # Perform swelling
+        if pipette.swelled != substance_name:
+            self.swell_tip(pipette=pipette, position=position_from)
+            pipette.swelled = substance_name
+        if len(positions_to) == 1:
+            self.move_without_drip(
+                position_to=positions_to[0],
+                position_from=position_from,
+                pipette=pipette,
+                amount=amounts[0],
+            )
+        else:
+            self.distribute_without_drip(
+                positions_to=positions_to,
+                position_from=position_from,
+                pipette=pipette,
+                amounts=amounts,
+            )
+
+
+    def get_remaining(self):
+        """
+        Returns the amount left in each source well, by "slot:well".
+        """
+        return {
+            f"{well['slot']}:{well['well']}": well["amount"]
+            for wells in self.substances.values()
+            for well in wells
+        }
+
+    def set_remaining(self, remaining):
+        """
+        Sets the amount left in each source well from `get_remaining`.
+        """
+        for wells in self.substances.values():
+            for well in wells:
+                key = f"{well['slot']}:{well['well']}"
+                if key in remaining:
+                    well["amount"] = remaining[key]
+
+
+class ProgressJournal:
+    """
+    Records the progress of a run, so an interrupted run can be resumed.
+
+    The journal is rewritten before and after every aspiration, and is
+    only valid for the protocol files and settings it was written for.
+    """
+
+    def __init__(self, path, content_hash, write=True):
+        """
+        Initialise the journal.
+
+        Parameters
+        ----------
+        path : pathlib.Path
+            The path of the journal file.
+
+        content_hash : str
+            The hash of the protocol files and settings being run.
+
+        write : bool
+            Toggles writing the journal, off when simulating.
+        """
+        self.path = Path(path)
+        self.content_hash = content_hash
+        self.write = write
+        self.state = {
+            "hash": content_hash,
+            "completed": 0,
+            "in_progress": None,
+            "amount_added": {},
+            "remaining": {},
+            "finished": False,
+        }
+
+    def load(self):
+        """
+        Returns the state of an interrupted run of the same protocol.
+        """
+        if not self.path.is_file():
+            raise RuntimeError(
+                f"No progress journal found at {self.path}, so the run cannot be resumed."
+            )
+        with open(self.path) as f:
+            state = json.load(f)
+        if state["hash"] != self.content_hash:
+            raise RuntimeError(
+                f"The progress journal {self.path} was written for different protocol files or settings, so the run cannot be resumed."
+            )
+        self.state = state
+        return state
+
+    def _write_state(self):
+        if not self.write:
+            return
+        self.state["updated"] = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+        # Write to a temporary file first, so a power loss cannot leave
+        # a partly written journal.
+        temp_path = self.path.with_name(f".{self.path.name}.tmp")
+        with open(temp_path, "w") as f:
+            json.dump(self.state, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+    def start(self, index, targets):
+        """
+        Records the aspiration about to be made and its targets.
+        """
+        self.state["in_progress"] = {
+            "aspiration": index,
+            "targets": [
+                [move["plate"], move["location"], amount]
+                for move, amount in targets
+            ],
+        }
+        self._write_state()
+
+    def complete(self, index, amount_added, remaining):
+        """
+        Records a completed aspiration, with the volume added to each
+        target well and the volume left in each source well.
+        """
+        self.state["completed"] = index + 1
+        self.state["in_progress"] = None
+        self.state["amount_added"] = amount_added
+        self.state["remaining"] = remaining
+        self._write_state()
+
+    def finish(self):
+        """
+        Records that the run has finished.
+        """
+        self.state["finished"] = True
+        self._write_state()
+
+
+class RunTelemetry:
+    """
+    Records the commands of a run as one JSON line each.
+
+    Every line has the `event` (the command), its `category`, the
+    `mount` and `volume` if any, the `aspiration` being made, the
+    `wall_time` it started at, its `protocol_time` in s since the start
+    of the run and its `duration` in s. Resumed runs are appended to
+    the same file, each starting with a "run_start" event.
+    """
+
+    def __init__(self, path, write=True):
+        """
+        Initialise the event log.
+
+        Parameters
+        ----------
+        path : pathlib.Path
+            The path of the event log.
+
+        write : bool
+            Toggles writing the event log, off when simulating.
+        """
+        self.path = Path(path)
+        self.write = write
+        self.aspiration = None
+        self.run_start = time.time()
+        self.file = None
+
+    def record(self, event, category, start, **details):
+        """
+        Writes an event which started at `start`, from `time.time`, and
+        has just ended.
+        """
+        if not self.write:
+            return
+        end = time.time()
+        if self.file is None:
+            self.file = open(self.path, "a")
+        line = {
+            "event": event,
+            "category": category,
+            **details,
+            "aspiration": self.aspiration,
+            "wall_time": time.strftime(
+                "%Y-%m-%dT%H:%M:%S", time.localtime(start)
+            ) + f".{int(start % 1 * 1000):03d}",
+            "protocol_time": round(start - self.run_start, 3),
+            "duration": round(end - start, 3),
+        }
+        self.file.write(json.dumps(line) + "\n")
+        # Flushed, not synced, so the log costs no robot time.
+        self.file.flush()
+
+    def start(self, content_hash, resume):
+        """
+        Records the start of a run.
+        """
+        self.run_start = time.time()
+        self.record(
+            "run_start", "run", self.run_start,
+            hash=content_hash, resume=resume,
+        )
+
+    def finish(self):
+        """
+        Records the end of a run and closes the event log.
+        """
+        self.record("run_end", "run", time.time())
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def get_protocol_dir(protocol_name, protocol_dir=None):
+    """
+    Returns the directory holding the JSON files of a protocol.
+
+    The working directory is used if it has a `substance_locations.json`,
+    otherwise the protocol directory on the robot, named by the
+    `robot_dir` of the protocol settings.
+    """
+    if protocol_dir is not None:
+        return Path(protocol_dir)
+    if Path("substance_locations.json").is_file():
+        return Path(".")
+    config = protocols[protocol_name]
+    return robot_code_path / config.get("robot_dir", protocol_name)
+
+
+def run_protocol(
+    protocol,
+    protocol_name,
+    protocol_dir=None,
+    resume=False,
+    skip_interrupted=False,
+):
+    """
+    Runs the moves of a protocol directory.
+
+    Notes
+    -----
+    The moves are run from the plan compiled, and cached, by
+    `protocol_compiler.compile_protocol`, which stops the run before
+    anything moves if the files are invalid or the deck cannot supply
+    them. The pipettes use the liquid classes chosen for the solvents
+    on the deck, and the tips and tip racks planned for the tip policy
+    of the moves. Progress is written to `progress_journal.json` in the protocol
+    directory after every aspiration, and every command to
+    `run_telemetry.jsonl`. With `resume`, the source volumes
+    and volumes added are restored from the journal and the completed
+    aspirations are skipped. The aspiration interrupted by the stop is
+    repeated, unless `skip_interrupted`, and its target wells are
+    printed so they can be checked. The tips taken before the stop are
+    skipped, and each pipette takes a new tip for its first aspiration.
+
+    Parameters
+    ----------
+    protocol : protocol_api.ProtocolContext
+        The protocol context for the current protocol.
+
+    protocol_name : str
+        The name of the protocol settings in `protocol_config.protocols`.
+
+    protocol_dir : str, optional
+        The directory holding `move_commands.json` and
+        `substance_locations.json`. Found by `get_protocol_dir` if not
+        given.
+
+    resume : bool
+        Toggles resuming an interrupted run from its progress journal.
+
+    skip_interrupted : bool
+        Toggles skipping, rather than repeating, the aspiration which
+        was interrupted.
+
+    Returns
+    -------
+    ot : Opentrons
+        The Opentrons object, with the remaining substance amounts.
+    """
+    protocol_dir = get_protocol_dir(protocol_name, protocol_dir)
+    plan = compile_protocol(protocol_dir, protocol_name)
+    config = get_run_config(load_config(protocol_dir, protocol_name), plan)
+    telemetry = RunTelemetry(
+        path=protocol_dir / telemetry_name,
+        write=not protocol.is_simulating(),
+    )
+    ot = Opentrons(
+        protocol=protocol,
+        deck_info=plan["deck_info"],
+        config=config,
+        telemetry=telemetry,
+    )
+
+    journal = ProgressJournal(
+        path=protocol_dir / journal_name,
+        content_hash=plan["hash"],
+        write=not protocol.is_simulating(),
+    )
+    amount_added = defaultdict(lambda: 0)
+    positions_added = defaultdict(str)
+    new_tips = list(plan["tips"]["new_tip"])
+    start = 0
+    if resume:
+        state = journal.load()
+        start = state["completed"]
+        ot.set_remaining(state["remaining"])
+        amount_added.update(state["amount_added"])
+        interrupted = state["in_progress"]
+        if interrupted is not None:
+            print(
+                f"Aspiration {interrupted['aspiration']} was interrupted. Check the wells (plate, well, amount):"
+            )
+            pprint(interrupted["targets"])
+            if skip_interrupted:
+                start += 1
+        # Tips taken before the stop are not used again, including any
+        # taken for the interrupted aspiration.
+        taken = start
+        if interrupted is not None:
+            taken = interrupted["aspiration"] + 1
+        mounts = [targets[0][0]["mount"] for _, targets in plan["aspirations"]]
+        for mount, pipette in ot.pipettes.items():
+            # The pipette holds no tip after a restart, so it takes one
+            # for its first aspiration even if the plan reuses a tip.
+            first = next(
+                (i for i in range(start, len(mounts)) if mounts[i] == mount),
+                None,
+            )
+            if first is None:
+                continue
+            new_tips[first] = True
+            channels = ot.settings[mount].get("channels", 1)
+            skipped = ot.settings[mount].get("starting_tip", 0)
+            skipped += channels * sum(
+                new_tips[i] for i in range(taken) if mounts[i] == mount
+            )
+            needed = skipped + channels * sum(
+                new_tips[i]
+                for i in range(start, len(mounts))
+                if mounts[i] == mount
+            )
+            if needed > len(ot.tipracks[mount]) * tips_per_rack:
+                raise RuntimeError(
+                    f"Resuming needs {needed} tips of the {mount} pipette, "
+                    f"more than the {len(ot.tipracks[mount]) * tips_per_rack} "
+                    "in its tip racks."
+                )
+            ot.skip_tips(pipette, skipped)
+        print(f"Resuming from aspiration {start}.")
+    telemetry.start(plan["hash"], resume)
+    for index, ((substance, targets), sources) in enumerate(
+        zip(plan["aspirations"], plan["sources"])
+    ):
+        if index < start:
+            continue
+        journal.start(index, targets)
+        telemetry.aspiration = index
+        ot.transfer(
+            substance_name=substance,
+            draws=get_draws(targets),
+            positions_to=[
+                ot.labware[move["plate"]].wells(move["location"])[0]
+                for move, _ in targets
+            ],
+            amounts=[amount for _, amount in targets],
+            pipette=ot.pipettes[targets[0][0]["mount"]],
+            sources=sources,
+            new_tip=new_tips[index],
+        )
+        for move, amount in targets:
+            for channel in move.get("channels", [move]):
+                amount_added[
+                    f"{channel['plate']}:{channel['location']}"
+                ] += amount
+        journal.complete(index, dict(amount_added), ot.get_remaining())
+    journal.finish()
+    telemetry.finish()
+    for move in plan["moves"]:
+        positions_added[move["location"]] += move["substance"] + " "
+    pprint(dict(amount_added))
+    pprint(dict(positions_added))
+    return ot
@@ -1,17 +1,250 @@
 from opentrons.simulate import simulate, format_runlog
 import argparse
+import json
+import os
+import re
+import sys
+from collections import Counter, defaultdict
+from multiprocessing import Pool
+from pathlib import Path
+
+from deck_geometry import get_deck
+from multichannel import get_channel_wells
+from protocol_config import protocols
+
+here = Path(__file__).resolve().parent
+
+# Command names of the run log, by the first word of their text.
+command_names = {
+    "Aspirating": "aspirate",
+    "Dispensing": "dispense",
+    "Picking": "pick_up_tip",
+    "Dropping": "drop_tip",
+    "Returning": "return_tip",
+    "Blowing": "blow_out",
+    "Air": "air_gap",
+    "Moving": "move_to",
+    "Delaying": "delay",
+    "Pausing": "pause",
+    "Mixing": "mix",
+    "Touching": "touch_tip",
+    "Transferring": "transfer",
+    "Distributing": "distribute",
+    "Consolidating": "consolidate",
+    "Homing": "home",
+}
+
+aspirate_pattern = re.compile(
+    r"Aspirating (?P<volume>[\d.]+) uL from (?P<well>[A-Z]+\d+) of .* "
+    r"on (?P<slot>\d+)"
+)
 
 
 def run_simulation(path):
-    protocol_file = open(path)
-    runlog, _bundle = simulate(protocol_file)
-    # print(format_runlog(runlog))
+    """
+    Simulates an Opentrons script and returns its run log.
+    """
+    with open(path) as protocol_file:
+        runlog, _bundle = simulate(
+            protocol_file,
+            custom_labware_paths=[str(here / "Custom_labware")],
+        )
+    return runlog
+
+
+def get_command_name(entry):
+    """
+    Returns the name of a command of the run log.
+    """
+    text = entry["payload"].get("text", "")
+    word = text.split(" ", 1)[0]
+    return command_names.get(word, word.lower())
+
+
+def parse_runlog(runlog, deck_info, config):
+    """
+    Counts the commands, tips and volume of each substance of a run log.
+
+    Notes
+    -----
+    Aspirations are credited to the substance of their source well in
+    `substance_locations.json`. Aspirations made by air gaps, or from
+    wells which hold no substance, are not counted. A multi-channel
+    aspiration is credited to the well under each nozzle.
+
+    Parameters
+    ----------
+    runlog : list of dict
+        The run log made by `opentrons.simulate.simulate`.
+
+    deck_info : dict
+        The contents of `substance_locations.json`.
+
+    config : dict
+        The settings of the protocol.
+
+    Returns
+    -------
+    summary : dict
+        The number of each `commands`, the number of `tips` picked up
+        and the volume `aspirated` of each substance in uL.
+    """
+    commands = Counter()
+    aspirated = defaultdict(float)
+    deck = None
+    # The command enclosing each level of the run log.
+    parents = {}
+    for entry in runlog:
+        name = get_command_name(entry)
+        commands[name] += 1
+        parents[entry["level"]] = name
+        if name != "aspirate" or parents.get(entry["level"] - 1) == "air_gap":
+            continue
+        match = aspirate_pattern.match(entry["payload"].get("text", ""))
+        if match is None:
+            continue
+        slot, well = match["slot"], match["well"]
+        instrument = entry["payload"].get("instrument")
+        channels = getattr(instrument, "channels", 1)
+        wells = [well]
+        if channels > 1 and slot in deck_info:
+            deck = deck or get_deck(deck_info, config)
+            wells = get_channel_wells(deck, slot, well, channels) or wells
+        for i in wells:
+            source = deck_info.get(slot, {}).get(i)
+            if isinstance(source, dict):
+                aspirated[source["substance"]] += float(match["volume"])
+    return {
+        "commands": dict(commands),
+        "tips": commands["pick_up_tip"],
+        "aspirated": dict(aspirated),
+    }
+
+
+def simulate_layout(job):
+    """
+    Simulates a script on one plate layout.
+
+    Parameters
+    ----------
+    job : tuple of str
+        The path to the `opentron_script.py` and to the directory of the
+        `move_commands.json` and `substance_locations.json` to run it
+        with.
+
+    Returns
+    -------
+    result : dict
+        The script and layout, the summary made by `parse_runlog` and
+        any `errors` raised by the simulation.
+    """
+    script, layout = job
+    script = Path(script).resolve()
+    layout = Path(layout).resolve()
+    result = {
+        "script": str(script),
+        "layout": str(layout),
+        "commands": {},
+        "tips": 0,
+        "aspirated": {},
+        "errors": [],
+    }
+    # The scripts find the engine and the JSON files from here.
+    if str(here) not in sys.path:
+        sys.path.append(str(here))
+    os.chdir(layout)
+    try:
+        with open(layout / "substance_locations.json") as f:
+            deck_info = json.load(f)
+        config = protocols.get(script.parent.name, {})
+        result.update(parse_runlog(run_simulation(script), deck_info, config))
+    except Exception as error:
+        result["errors"].append(f"{type(error).__name__}: {error}")
+    return result
+
+
+def get_jobs(scripts, layouts=None):
+    """
+    Returns every combination of script and plate layout to simulate.
+
+    A path to a directory is taken as its `opentron_script.py`. Without
+    `layouts`, each script is run with the files of its own directory.
+    """
+    scripts = [
+        Path(i) / "opentron_script.py" if Path(i).is_dir() else Path(i)
+        for i in scripts
+    ]
+    if not layouts:
+        return [(str(i), str(i.parent)) for i in scripts]
+    return [(str(i), str(j)) for i in scripts for j in layouts]
+
+
+def main(args):
+    jobs = get_jobs(args.i, args.layouts)
+    if len(jobs) == 1 and args.log:
+        script, layout = jobs[0]
+        sys.path.append(str(here))
+        os.chdir(layout)
+        print(format_runlog(run_simulation(Path(script).resolve())))
+        return None
+
+    with Pool(processes=args.p) as pool:
+        results = pool.map(simulate_layout, jobs)
+
+    print(
+        f"{'script':<40}{'layout':<30}{'commands':>10}{'tips':>6}"
+        f"{'volume (uL)':>13}{'errors':>8}"
+    )
+    for result in results:
+        script = Path(result["script"])
+        print(
+            f"{script.parent.name + '/' + script.name:<40}"
+            f"{Path(result['layout']).name:<30}"
+            f"{sum(result['commands'].values()):>10}{result['tips']:>6}"
+            f"{sum(result['aspirated'].values()):>13.1f}"
+            f"{len(result['errors']):>8}"
+        )
+        for error in result["errors"]:
+            print(f"    {error}")
+    if args.o is not None:
+        with open(args.o, "w") as f:
+            json.dump(results, f, indent=4)
+    return results
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
-        description="Simulate an Opentrons experiment."
+        description="Simulate Opentrons experiments."
+    )
+    parser.add_argument(
+        "-i",
+        help=(
+            "Paths to the Opentron simulation scripts, or to the protocol "
+            "directories holding them."
+        ),
+        nargs="+",
+        required=True,
+    )
+    parser.add_argument(
+        "-layouts",
+        help=(
+            "Directories of move_commands.json and substance_locations.json "
+            "to simulate every script with. Defaults to the directory of "
+            "each script."
+        ),
+        nargs="*",
+        default=None,
+    )
+    parser.add_argument(
+        "-p", help="Number of processes.", type=int, default=os.cpu_count(),
+    )
+    parser.add_argument(
+        "-o", help="Path to a JSON file of the comparison report.",
+    )
+    parser.add_argument(
+        "-log",
+        help="Print the run log of a single simulation.",
+        action="store_true",
     )
-    parser.add_argument("-i", help="Path to the Opentron simulation script.")
     args = parser.parse_args()
-    run_simulation(args.i)
+    main(args)
@@ -0,0 +1,146 @@
+import math
+
+from protocol_config import get_labware, get_pipettes, get_tiprack_slots
+
+# When a pipette takes a new tip, from the least to the most tips used.
+# "substance": when the substance changes, "source": also when the
+# source well changes, "always": for every aspiration.
+tip_policies = ("substance", "source", "always")
+
+tips_per_rack = 96
+
+# Deck slots which can hold labware. Slot 12 holds the trash.
+deck_slots = range(1, 12)
+
+
+def get_tip_policy(move, config):
+    """
+    Returns the tip policy of a move, the strictest of its channels.
+
+    A move uses the `tip_policy` of its entry in `move_commands.json`,
+    otherwise the `tip_policy` of the protocol, otherwise "substance".
+    """
+    default = config.get("tip_policy", "substance")
+    return max(
+        (i.get("tip_policy", default) for i in move.get("channels", [move])),
+        key=tip_policies.index,
+    )
+
+
+def get_new_tips(aspirations, sources, config):
+    """
+    Returns whether each aspiration is made with a new tip.
+
+    Parameters
+    ----------
+    aspirations : list of tuple
+        The aspirations, as made by `protocol_config.get_aspirations`.
+
+    sources : list of list
+        The source wells of the draws of each aspiration, as planned by
+        `inventory.plan_inventory`.
+
+    config : dict
+        The settings of the protocol.
+
+    Returns
+    -------
+    new_tips : list of bool
+        True if the aspiration is made with a new tip.
+    """
+    new_tips = []
+    last = {}
+    for (substance, targets), wells in zip(aspirations, sources):
+        mount = targets[0][0]["mount"]
+        policy = max(
+            (get_tip_policy(move, config) for move, _ in targets),
+            key=tip_policies.index,
+        )
+        wells = [tuple(i) if i is not None else None for i in wells]
+        previous = last.get(mount)
+        new_tip = (
+            previous is None
+            or policy == "always"
+            or previous[0] != substance
+            or (policy == "source" and previous[1] != wells)
+        )
+        last[mount] = (substance, wells)
+        new_tips.append(new_tip)
+    return new_tips
+
+
+def plan_tips(aspirations, sources, deck_info, config):
+    """
+    Plans the tips and tip racks of a protocol.
+
+    Notes
+    -----
+    Each pipette takes `tiprack_slot` as its first rack. Racks for the
+    tips beyond it, counted from its `starting_tip`, are put in the free
+    deck slots in turn.
+
+    Parameters
+    ----------
+    aspirations : list of tuple
+        The aspirations, as made by `protocol_config.get_aspirations`.
+
+    sources : list of list
+        The source wells of the draws of each aspiration, as planned by
+        `inventory.plan_inventory`.
+
+    deck_info : dict
+        The contents of `substance_locations.json`.
+
+    config : dict
+        The settings of the protocol.
+
+    Returns
+    -------
+    tips : dict
+        Whether each aspiration takes a `new_tip`, the `tips` used by
+        each mount, the `tiprack_slots` of each mount and the number of
+        `racks_short` of free slots.
+    """
+    pipettes = get_pipettes(config)
+    new_tips = get_new_tips(aspirations, sources, config)
+    tips = {mount: 0 for mount in pipettes}
+    for (_, targets), new_tip in zip(aspirations, new_tips):
+        if new_tip:
+            mount = targets[0][0]["mount"]
+            tips[mount] += pipettes[mount].get("channels", 1)
+
+    used = set(get_labware(config)) | {int(i) for i in deck_info}
+    free = [i for i in deck_slots if i not in used]
+    tiprack_slots = {}
+    racks_short = 0
+    for mount, settings in pipettes.items():
+        needed = math.ceil(
+            (settings.get("starting_tip", 0) + tips[mount]) / tips_per_rack
+        )
+        slots = get_tiprack_slots(settings)
+        extra = max(0, needed - len(slots))
+        racks_short += max(0, extra - len(free))
+        tiprack_slots[mount] = slots + free[:extra]
+        free = free[extra:]
+    return {
+        "new_tip": new_tips,
+        "tips": tips,
+        "tiprack_slots": tiprack_slots,
+        "racks_short": racks_short,
+    }
+
+
+def apply_tip_plan(config, tips):
+    """
+    Returns the settings of a protocol with the tip racks planned by
+    `plan_tips`.
+    """
+    config = dict(config)
+    if "pipettes" not in config:
+        config["tiprack_slots"] = tips["tiprack_slots"][config["mount"]]
+        return config
+    config["pipettes"] = {
+        mount: {**settings, "tiprack_slots": tips["tiprack_slots"][mount]}
+        for mount, settings in config["pipettes"].items()
+    }
+    return config